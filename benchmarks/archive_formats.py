@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Archive every fixture page in each format and report CPU time and bytes stored per format
+
+CPU time includes the browser processes (they are counted once the browser has exited).
+"auto" is the format picked per page by muninn-web-page-downloader when nothing is configured. It loads each page
+once in the browser and either keeps its readable text as markdown or captures it as PDF.
+
+Usage:
+./benchmarks/archive_formats.py
+./benchmarks/archive_formats.py --urls-file webpages.txt
+"""
+import asyncio
+import resource
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import Counter
+from functools import partial
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+from render_pages import PAGES_DIR, DelayingRequestHandler
+
+from common_utils import setup_logging
+from web_archive import ARCHIVE_FORMATS, AUTO, FILE_EXTENSIONS, fetch_readable_page
+from webpage_to_pdf import RenderService
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--urls-file", type=Path, help="Archive these urls (one per line) instead of the fixtures")
+    parser.add_argument("--render-tabs", type=int, default=2, help="Number of pages to render concurrently")
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose")
+    return parser.parse_args()
+
+
+def cpu_time_including_children() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+async def archive_page(render_service: RenderService, url: str, archive_format: str, output_dir: Path, i: int):
+    if archive_format == "markdown":
+        _, readable = await asyncio.to_thread(fetch_readable_page, url)
+        if readable:
+            (output_dir / f"{i}{FILE_EXTENSIONS['markdown']}").write_text(readable.markdown, encoding="utf-8")
+        return archive_format
+
+    # auto loads the page once in the browser and returns the readable page when markdown is picked
+    output_file = output_dir / f"{i}{FILE_EXTENSIONS['pdf' if archive_format == AUTO else archive_format]}"
+    result = await render_service.render(url, output_file, archive_format=archive_format)
+    if result.readable:
+        (output_dir / f"{i}{FILE_EXTENSIONS['markdown']}").write_text(result.readable.markdown, encoding="utf-8")
+    return result.archive_format
+
+
+async def archive_all(urls: List[str], archive_format: str, output_dir: Path, render_tabs: int) -> Counter:
+    # The browser is only launched when a page needs one
+    async with RenderService(tabs=render_tabs) as render_service:
+        chosen_formats = await asyncio.gather(
+            *(archive_page(render_service, url, archive_format, output_dir, i) for i, url in enumerate(urls))
+        )
+    return Counter(chosen_formats)
+
+
+def main(args):
+    server = None
+    if args.urls_file:
+        urls = [line.strip() for line in args.urls_file.read_text().splitlines() if line.strip()]
+    else:
+        handler = partial(DelayingRequestHandler, directory=PAGES_DIR.as_posix())
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = [f"http://127.0.0.1:{server.server_port}/{page.name}" for page in sorted(PAGES_DIR.glob("*.html"))]
+
+    print(f"{'Format':<10}{'Pages':>6}{'Wall (s)':>10}{'CPU (s)':>10}{'KB stored':>11}{'KB/page':>9}  Chosen")
+    try:
+        for archive_format in ARCHIVE_FORMATS + (AUTO,):
+            with tempfile.TemporaryDirectory() as output_dir:
+                wall_start, cpu_start = time.perf_counter(), cpu_time_including_children()
+                chosen = asyncio.run(archive_all(urls, archive_format, Path(output_dir), args.render_tabs))
+                wall, cpu = time.perf_counter() - wall_start, cpu_time_including_children() - cpu_start
+                stored_kb = sum(f.stat().st_size for f in Path(output_dir).iterdir()) / 1024
+            print(
+                f"{archive_format:<10}{len(urls):>6}{wall:>10.2f}{cpu:>10.2f}{stored_kb:>11.0f}"
+                f"{stored_kb / len(urls):>9.1f}  {dict(chosen)}"
+            )
+    finally:
+        if server:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.verbose)
+    main(args)
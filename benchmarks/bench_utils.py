@@ -0,0 +1,32 @@
+"""
+Helpers shared by the benchmark scripts
+"""
+import importlib.util
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+if REPO_ROOT.as_posix() not in sys.path:
+    sys.path.insert(0, REPO_ROOT.as_posix())
+
+
+def load_script(script_name: str):
+    """Import one of the top level scripts, including the ones with a hyphen in their name"""
+    script_path = REPO_ROOT / script_name
+    module_name = script_path.stem.replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextmanager
+def timer():
+    timings = {}
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    yield timings
+    timings["wall"] = time.perf_counter() - wall_start
+    timings["cpu"] = time.process_time() - cpu_start
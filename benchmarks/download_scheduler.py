@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Throughput of muninn-web-page-downloader's PoliteScheduler with simulated downloads
+
+Each simulated download takes --latency-in-secs. Pages are spread over --domains domains, with
+--skew of them on the first (busiest) domain. Reports pages/sec for each global concurrency limit
+and the highest concurrency and shortest gap between starts seen for any single domain.
+
+Usage:
+./benchmarks/download_scheduler.py -n 60 --domains 6 --latency-in-secs 0.5
+"""
+import asyncio
+import random
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict
+
+from bench_utils import load_script
+
+downloader = load_script("muninn-web-page-downloader.py")
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--pages", type=int, default=60, help="Number of simulated pages")
+    parser.add_argument("--domains", type=int, default=6, help="Number of distinct domains")
+    parser.add_argument("--skew", type=float, default=0.3, help="Share of pages on the busiest domain")
+    parser.add_argument("--latency-in-secs", type=float, default=0.5, help="Time taken by one download")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--max-per-domain", type=int, default=2)
+    parser.add_argument("--domain-delay-in-secs", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def simulated_urls(pages: int, domains: int, skew: float):
+    busiest = int(pages * skew)
+    urls = [f"https://site0.test/page-{i}" for i in range(busiest)]
+    urls += [f"https://site{1 + i % max(domains - 1, 1)}.test/page-{i}" for i in range(pages - busiest)]
+    random.Random(7).shuffle(urls)
+    return urls
+
+
+async def run(args, urls, concurrency: int):
+    scheduler = downloader.PoliteScheduler(concurrency, args.max_per_domain, args.domain_delay_in_secs)
+    active = defaultdict(int)
+    peak = defaultdict(int)
+    starts = defaultdict(list)
+
+    async def download(url: str):
+        domain = url.split("/")[2]
+        async with scheduler.slot(url):
+            starts[domain].append(time.monotonic())
+            active[domain] += 1
+            peak[domain] = max(peak[domain], active[domain])
+            await asyncio.sleep(args.latency_in_secs)
+            active[domain] -= 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(download(url) for url in urls))
+    elapsed = time.perf_counter() - start
+    gaps = [b - a for times in starts.values() for a, b in zip(sorted(times), sorted(times)[1:])]
+    return elapsed, max(peak.values()), min(gaps, default=0)
+
+
+def main(args):
+    urls = simulated_urls(args.pages, args.domains, args.skew)
+    print(f"{'Concurrency':>11}{'Wall (s)':>10}{'Pages/sec':>11}{'Peak/domain':>13}{'Min gap (s)':>13}")
+    for concurrency in args.concurrency:
+        elapsed, peak_per_domain, min_gap = asyncio.run(run(args, urls, concurrency))
+        print(f"{concurrency:>11}{elapsed:>10.2f}{len(urls) / elapsed:>11.2f}{peak_per_domain:>13}{min_gap:>13.2f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
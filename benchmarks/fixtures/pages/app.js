@@ -0,0 +1 @@
+document.addEventListener("DOMContentLoaded", () => document.body.dataset.ready = "true");
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Check and time the --mirror-mode of muninn-git-repo-downloader.py against a local repo cloned over file://
+
+A repo with --files files is created in a temporary directory and served as <base_url>/<owner>/<repo>.
+The first snapshot clones the mirror, the second one finds nothing new, and after a new commit
+the third one only fetches that commit. A fork at the same commit then gets a snapshot of its own
+without the upstream one being replaced. Each snapshot zip is checked for the GitHub archive layout
+and the pull request ref of the repo (refs/pull/1/head) must never reach the mirror.
+
+Usage:
+./benchmarks/git_mirror.py
+./benchmarks/git_mirror.py --files 5000
+"""
+import tempfile
+import zipfile
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+
+from bench_utils import timer
+
+from github_api import RepoMirrors, RepoSnapshots, run_git
+
+OWNER, FORK_OWNER, REPO = "muninn", "fork-owner", "mirror-check"
+COMMITTER = ("-c", "user.name=check", "-c", "user.email=check@localhost")
+
+
+def build_repo(repo_dir: Path, files: int):
+    repo_dir.mkdir(parents=True)
+    run_git("init", "-q", "-b", "main", repo_dir)
+    for i in range(files):
+        source_file = repo_dir / f"pkg{i % 20}" / f"module_{i}.py"
+        source_file.parent.mkdir(exist_ok=True)
+        source_file.write_text(f'"""Module {i}"""\n\n\ndef function_{i}():\n    return {i}\n')
+    commit(repo_dir, "Initial commit")
+    # A pull request like GitHub's: a commit only reachable from refs/pull/<n>/head
+    tree = run_git("-C", repo_dir, "rev-parse", "HEAD^{tree}")
+    pull_commit = run_git("-C", repo_dir, *COMMITTER, "commit-tree", tree, "-p", "HEAD", "-m", "Pull request")
+    run_git("-C", repo_dir, "update-ref", "refs/pull/1/head", pull_commit)
+
+
+def commit(repo_dir: Path, message: str):
+    run_git("-C", repo_dir, "add", "-A")
+    run_git("-C", repo_dir, *COMMITTER, "commit", "-q", "-m", message)
+
+
+def check_layout(zip_file: Path, sha: str) -> bool:
+    """Every member is inside the single <repo>-<sha> folder like a GitHub archive"""
+    with zipfile.ZipFile(zip_file) as archive:
+        return all(name.startswith(f"{REPO}-{sha}/") for name in archive.namelist())
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=500, help="Number of files in the repo")
+    return parser.parse_args()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        repos_dir = tmp_dir / "repos"
+        repo_dir = repos_dir / OWNER / REPO
+        build_repo(repo_dir, args.files)
+        mirrors = RepoMirrors(tmp_dir / "mirrors", base_url=repos_dir.as_uri())
+        snapshots = RepoSnapshots(tmp_dir / "snapshots")
+
+        print(f"{'Run':<24}{'New snapshot':>14}{'Layout ok':>12}{'Snapshots':>12}{'PR refs':>10}{'Wall (s)':>10}")
+        runs = [("clone", OWNER), ("unchanged", OWNER), ("new commit", OWNER), ("fork", FORK_OWNER)]
+        for run, owner in runs + [("upstream unchanged", OWNER), ("fork unchanged", FORK_OWNER)]:
+            if run == "new commit":
+                (repo_dir / "CHANGELOG.md").write_text("New commit\n")
+                commit(repo_dir, "Add changelog")
+            if run == "fork":
+                run_git("clone", "-q", repo_dir, repos_dir / FORK_OWNER / REPO)
+            with timer() as timings:
+                zip_file, is_new = snapshots.snapshot_from_mirror(owner, REPO, mirrors)
+            sha = run_git("-C", repo_dir, "rev-parse", "HEAD")
+            layout_ok = zip_file.name == f"{owner}__{REPO}-{sha[:12]}.zip" and check_layout(zip_file, sha)
+            stored = len(snapshots.snapshots_of(owner, REPO))
+            pull_refs = len(run_git("-C", mirrors.mirror_path(owner, REPO), "for-each-ref", "refs/pull").splitlines())
+            print(f"{run:<24}{str(is_new):>14}{str(layout_ok):>12}{stored:>12}{pull_refs:>10}{timings['wall']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Build a context from a synthetic monorepo zip with tele_github_context_builder and report the time taken,
+the bytes written to disk (besides the context itself) and the peak memory allocated
+
+The zip has --files source files spread over packages plus a docs folder of markdown files, laid out like
+a GitHub archive. "extract + walk" is the previous approach (extractall, os.walk, join into one string, rmtree)
+for comparison. The context is written into a compressed zip member, as sent by the bot.
+
+Usage:
+./benchmarks/github_context.py
+./benchmarks/github_context.py --files 50000 --folder docs --types .md
+./benchmarks/github_context.py --folder "" --types .py .md --max-tokens 100000
+"""
+import io
+import os
+import random
+import shutil
+import tempfile
+import tracemalloc
+import zipfile
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+
+from bench_utils import timer
+
+from tele_github_context_builder import ContextWriter, collect_files, estimate_tokens
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20000, help="Number of source files in the repo")
+    parser.add_argument("--docs", type=int, default=200, help="Number of markdown files in the docs folder")
+    parser.add_argument("--file-kb", type=int, default=4, help="Size of each file")
+    parser.add_argument("--folder", default="docs", help="Folder to build the context from")
+    parser.add_argument("--types", nargs="+", default=[".md"], help="File types to include")
+    parser.add_argument("--max-tokens", type=int, help="Token budget of each part of the context")
+    return parser.parse_args()
+
+
+def build_repo_zip(zip_path: Path, files: int, docs: int, file_kb: int):
+    rng = random.Random(7)
+    words = ["def", "return", "import", "class", "self", "value", "config", "render", "async", "await", "data"]
+
+    def text() -> str:
+        lines = (" ".join(rng.choice(words) for _ in range(10)) for _ in range(file_kb * 1024 // 60))
+        return "\n".join(lines) + "\n"
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for i in range(files):
+            zip_file.writestr(f"monorepo-0123456789ab/packages/pkg{i % 50}/src/module_{i}.py", text())
+        for i in range(docs):
+            zip_file.writestr(f"monorepo-0123456789ab/docs/guide/page_{i}.md", text())
+
+
+def open_member(context_zip: zipfile.ZipFile):
+    def open_part(name: str):
+        return io.TextIOWrapper(context_zip.open(name, "w"), encoding="utf-8")
+
+    return open_part
+
+
+def extract_and_walk(zip_path: Path, folder_path: str, file_types, context_zip: zipfile.ZipFile, _) -> tuple:
+    extract_dir = Path(tempfile.mkdtemp(dir=zip_path.parent))
+    with zipfile.ZipFile(zip_path) as zip_file:
+        zip_file.extractall(extract_dir)
+    written = sum(f.stat().st_size for f in extract_dir.rglob("*") if f.is_file())
+    context = []
+    for root, _, files in os.walk(extract_dir / "monorepo-0123456789ab" / folder_path):
+        for file in files:
+            if any(file.endswith(ft) for ft in file_types):
+                context.append(f"File: {file}\n\n{Path(root, file).read_text(encoding='utf-8')}\n\n")
+    with open_member(context_zip)("context.txt") as output:
+        output.write("\n".join(context))
+    shutil.rmtree(extract_dir)
+    return len(context), 1, written
+
+
+def stream_from_zip(zip_path: Path, folder_path: str, file_types, context_zip: zipfile.ZipFile, max_tokens) -> tuple:
+    with ContextWriter(open_member(context_zip), "context.txt", max_tokens) as writer:
+        collect_files(zip_path, folder_path, file_types, writer)
+    return writer.files, len(writer.part_names), 0
+
+
+def measure(approach, zip_path: Path, args) -> tuple:
+    tracemalloc.start()
+    with timer() as timings:
+        with zipfile.ZipFile(zip_path.with_name("context.zip"), "w", zipfile.ZIP_DEFLATED) as context_zip:
+            collected, parts, written = approach(zip_path, args.folder, args.types, context_zip, args.max_tokens)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return collected, parts, timings, written, peak
+
+
+def token_estimate_throughput(zip_path: Path) -> tuple:
+    with zipfile.ZipFile(zip_path) as zip_file:
+        texts = [zip_file.read(member).decode("utf-8") for member in zip_file.infolist()]
+    with timer() as timings:
+        tokens = sum(estimate_tokens(text) for text in texts)
+    return sum(len(text) for text in texts), tokens, timings["wall"]
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_path = Path(work_dir) / "monorepo.zip"
+        build_repo_zip(zip_path, args.files, args.docs, args.file_kb)
+        print(f"Repo zip: {args.files + args.docs} files, {zip_path.stat().st_size / 1024 / 1024:.1f} MB")
+        print(
+            f"{'Approach':<18}{'Files':>7}{'Parts':>7}{'Wall (s)':>10}{'CPU (s)':>10}{'MB written':>12}{'Peak MB':>9}"
+        )
+        for name, approach in (("extract + walk", extract_and_walk), ("stream from zip", stream_from_zip)):
+            collected, parts, timings, written, peak = measure(approach, zip_path, args)
+            print(
+                f"{name:<18}{collected:>7}{parts:>7}{timings['wall']:>10.2f}{timings['cpu']:>10.2f}"
+                f"{written / 2**20:>12.1f}{peak / 2**20:>9.1f}"
+            )
+
+        characters, tokens, seconds = token_estimate_throughput(zip_path)
+        print(
+            f"Token estimate of the whole repo: {tokens} tokens from {characters / 2**20:.1f} MB "
+            f"in {seconds:.2f}s ({characters / 2**20 / seconds:.0f} MB/s)"
+        )
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare images/sec of the in-process tesserocr engine against spawning the tesseract cli per image
+
+Usage:
+./benchmarks/ocr_engines.py -i ~/OutputDir/tele-bookmarks/web-to-pdf -n 50
+"""
+import logging
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+
+from bench_utils import timer
+
+from common_utils import setup_logging
+from ocr_engine import TesseractCliEngine, TesserocrEngine
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--images-dir", type=Path, required=True, help="Directory with png/jpg images")
+    parser.add_argument("-n", "--count", type=int, default=50, help="Maximum number of images to convert")
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose")
+    return parser.parse_args()
+
+
+def available_engines():
+    engines = [TesseractCliEngine()]
+    try:
+        engines.append(TesserocrEngine())
+    except ImportError:
+        logging.warning("tesserocr is not installed. Only benchmarking tesseract cli")
+    return engines
+
+
+def main(args):
+    images = sorted(p for p in args.images_dir.iterdir() if p.suffix.lower() in (".png", ".jpg", ".jpeg"))
+    images = images[: args.count]
+    if not images:
+        print(f"No images found in {args.images_dir}")
+        return
+
+    print(f"{'Engine':<28}{'Images':>8}{'Wall (s)':>10}{'Images/sec':>12}")
+    for engine in available_engines():
+        with timer() as timings:
+            for image in images:
+                engine.image_to_text(image)
+        print(f"{engine.version:<28}{len(images):>8}{timings['wall']:>10.2f}{len(images) / timings['wall']:>12.2f}")
+        engine.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.verbose)
+    main(args)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Measure OCR time and accuracy with and without image preprocessing on the labelled samples in fixtures/ocr
+
+Usage:
+./benchmarks/ocr_preprocessing.py
+./benchmarks/ocr_preprocessing.py --deskew --ocr-engine cli
+"""
+import difflib
+import json
+import tempfile
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict
+from pathlib import Path
+
+from bench_utils import REPO_ROOT
+
+from common_utils import setup_logging
+from image_preprocess import preprocess_image
+from ocr_engine import create_ocr_engine
+
+SAMPLES_DIR = REPO_ROOT / "benchmarks" / "fixtures" / "ocr"
+
+
+def accuracy(expected: str, actual: str) -> float:
+    return difflib.SequenceMatcher(None, " ".join(expected.lower().split()), " ".join(actual.lower().split())).ratio()
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--samples-dir", type=Path, default=SAMPLES_DIR, help="Images with a labels.json")
+    parser.add_argument("-e", "--ocr-engine", choices=["auto", "tesserocr", "cli"], default="auto")
+    parser.add_argument("--deskew", action="store_true", default=False, help="Include the deskew stage")
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose")
+    return parser.parse_args()
+
+
+def main(args):
+    labels = json.loads((args.samples_dir / "labels.json").read_text())
+    ocr_engine = create_ocr_engine(args.ocr_engine)
+    stage_timings = defaultdict(float)
+    totals = defaultdict(float)
+
+    print(f"{'Sample':<24}{'Raw (s)':>9}{'Raw acc':>9}{'Prep (s)':>10}{'Prep acc':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for image_name, expected_text in labels.items():
+            image_file_path = args.samples_dir / image_name
+
+            start = time.perf_counter()
+            raw_text = ocr_engine.image_to_text(image_file_path)
+            raw_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            preprocessed_image_path = Path(tmp_dir) / f"{image_file_path.stem}.png"
+            for stage, duration in preprocess_image(
+                image_file_path, preprocessed_image_path, straighten=args.deskew
+            ).items():
+                stage_timings[stage] += duration
+            preprocessed_text = ocr_engine.image_to_text(preprocessed_image_path)
+            preprocessed_time = time.perf_counter() - start
+
+            raw_accuracy, preprocessed_accuracy = accuracy(expected_text, raw_text), accuracy(
+                expected_text, preprocessed_text
+            )
+            totals["raw_time"] += raw_time
+            totals["raw_accuracy"] += raw_accuracy
+            totals["preprocessed_time"] += preprocessed_time
+            totals["preprocessed_accuracy"] += preprocessed_accuracy
+            print(
+                f"{image_name:<24}{raw_time:>9.2f}{raw_accuracy:>9.2f}{preprocessed_time:>10.2f}{preprocessed_accuracy:>10.2f}"
+            )
+
+    samples = len(labels)
+    print(
+        f"{'Average':<24}{totals['raw_time'] / samples:>9.2f}{totals['raw_accuracy'] / samples:>9.2f}"
+        f"{totals['preprocessed_time'] / samples:>10.2f}{totals['preprocessed_accuracy'] / samples:>10.2f}"
+    )
+    print(f"Engine: {ocr_engine.version}")
+    print("Mean preprocessing time per stage:")
+    for stage, duration in stage_timings.items():
+        print(f"  {stage:<14}{duration / samples * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.verbose)
+    main(args)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Size of the outline (code_outline.outline_of) of the source files in a folder compared to the full files
+
+Reports, per file type, the (estimated) tokens of the full files and of their outlines, the reduction and
+the time taken to build the outlines. Files in a language without an outline are left out.
+
+Usage:
+./benchmarks/outline_size.py
+./benchmarks/outline_size.py --folder ~/projects/some-repo --show some-repo/src/main.ts
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict
+from pathlib import Path
+
+from bench_utils import timer
+
+from code_outline import OUTLINE_EXTENSIONS, outline_of
+from tele_github_context_builder import estimate_tokens
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default=".", help="Folder with the source files")
+    parser.add_argument("--show", help="Print the outline of this file")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.show:
+        print(outline_of(args.show, Path(args.show).read_text(encoding="utf-8")))
+        return
+
+    totals = defaultdict(lambda: [0, 0, 0, 0.0])
+    for path in Path(args.folder).expanduser().rglob("*"):
+        if path.suffix.lower() not in OUTLINE_EXTENSIONS or not path.is_file():
+            continue
+        try:
+            text = path.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError):
+            continue
+        with timer() as timings:
+            outline = outline_of(path.name, text)
+        total = totals[path.suffix.lower()]
+        total[0] += 1
+        total[1] += estimate_tokens(text)
+        total[2] += estimate_tokens(outline)
+        total[3] += timings["wall"]
+
+    print(f"{'Type':<8}{'Files':>7}{'Full tokens':>13}{'Outline tokens':>16}{'Smaller':>9}{'Outline (s)':>13}")
+    for suffix, (files, full_tokens, outline_tokens, seconds) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        reduction = full_tokens / max(outline_tokens, 1)
+        print(f"{suffix:<8}{files:>7}{full_tokens:>13}{outline_tokens:>16}{reduction:>8.1f}x{seconds:>13.2f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
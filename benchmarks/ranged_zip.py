@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Build a context from one folder of a large repo zip served over HTTP, either by downloading the whole zip
+or by reading it with range requests (RangeHttpFile), and report the bytes transferred and the time taken
+
+The zip is the synthetic monorepo of github_context.py. It is served from a local HTTP server that supports
+range requests. The last row turns range support off on the server to show the fallback to a full download.
+
+Usage:
+./benchmarks/ranged_zip.py
+./benchmarks/ranged_zip.py --files 50000 --folder docs --types .md
+"""
+import io
+import re
+import tempfile
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from bench_utils import timer
+from github_context import build_repo_zip
+
+from common_utils import RangeHttpFile, download_to_file
+from tele_github_context_builder import ContextWriter, collect_files
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    supports_ranges = True
+    bytes_sent = 0
+    bytes_lock = threading.Lock()
+
+    def do_GET(self):
+        requested_range = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not (self.supports_ranges and requested_range):
+            return super().do_GET()
+
+        data = Path(self.translate_path(self.path)).read_bytes()
+        start, end = int(requested_range.group(1)), min(int(requested_range.group(2)), len(data) - 1)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start : end + 1])
+        self.count_bytes(end - start + 1)
+
+    def copyfile(self, source, outputfile):
+        data = source.read()
+        try:
+            outputfile.write(data)
+        except BrokenPipeError:
+            # RangeHttpFile.open() hangs up as soon as it sees that the server ignored the range
+            return
+        self.count_bytes(len(data))
+
+    @classmethod
+    def count_bytes(cls, size: int):
+        with cls.bytes_lock:
+            cls.bytes_sent += size
+
+    def log_message(self, *_):
+        pass
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20000, help="Number of source files in the repo")
+    parser.add_argument("--docs", type=int, default=200, help="Number of markdown files in the docs folder")
+    parser.add_argument("--file-kb", type=int, default=4, help="Size of each file")
+    parser.add_argument("--folder", default="docs", help="Folder to build the context from")
+    parser.add_argument("--types", nargs="+", default=[".md"], help="File types to include")
+    return parser.parse_args()
+
+
+def build_context(zip_file, args) -> int:
+    output = io.StringIO()
+    with ContextWriter(lambda _: output, "context.txt") as writer:
+        collect_files(zip_file, args.folder, args.types, writer)
+    return writer.files
+
+
+def full_download(url: str, work_dir: Path, args) -> int:
+    target_file = work_dir / "downloaded.zip"
+    download_to_file(url, target_file)
+    files = build_context(target_file, args)
+    target_file.unlink()
+    return files
+
+
+def ranged(url: str, work_dir: Path, args) -> int:
+    remote_zip = RangeHttpFile.open(url)
+    if remote_zip is None:
+        return full_download(url, work_dir, args)
+    with remote_zip:
+        files = build_context(remote_zip, args)
+    print(f"  {remote_zip.raw.requests} range requests")
+    return files
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_path = Path(work_dir) / "monorepo.zip"
+        build_repo_zip(zip_path, args.files, args.docs, args.file_kb)
+        zip_size = zip_path.stat().st_size
+        print(f"Repo zip: {args.files + args.docs} files, {zip_size / 2**20:.1f} MB")
+
+        handler = partial(RangeRequestHandler, directory=work_dir)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/{zip_path.name}"
+        rows = []
+        try:
+            for name, fetch, supports_ranges in (
+                ("full download", full_download, True),
+                ("ranged", ranged, True),
+                ("ranged, no server support", ranged, False),
+            ):
+                RangeRequestHandler.supports_ranges = supports_ranges
+                RangeRequestHandler.bytes_sent = 0
+                with timer() as timings:
+                    files = fetch(url, Path(work_dir), args)
+                rows.append((name, files, timings["wall"], RangeRequestHandler.bytes_sent))
+        finally:
+            server.shutdown()
+
+        print(f"{'Approach':<28}{'Files':>7}{'Wall (s)':>10}{'MB sent':>10}{'% of zip':>10}")
+        for name, files, wall, bytes_sent in rows:
+            print(f"{name:<28}{files:>7}{wall:>10.2f}{bytes_sent / 2**20:>10.2f}{bytes_sent / zip_size:>10.1%}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
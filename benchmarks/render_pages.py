@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Render the fixture pages (lazy images, infinite scroll, late DOM updates, ads and trackers) through RenderService
+and report how long each page took until it was captured and how many bytes the server sent
+
+Pages are served from a local HTTP server. Any request with ?delay=<ms> is answered after that delay
+to simulate slow images and API calls, and ?size=<bytes> returns a synthetic body of that size
+(fonts, videos, third party scripts).
+
+Usage:
+./benchmarks/render_pages.py -r 3
+./benchmarks/render_pages.py -r 3 --compare-interception
+"""
+import asyncio
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from bench_utils import REPO_ROOT, timer
+
+from common_utils import setup_logging
+from request_interceptor import AssetCache, Blocklist
+from webpage_to_pdf import RENDER_BUDGET_IN_SECS, RenderService
+
+PAGES_DIR = REPO_ROOT / "benchmarks" / "fixtures" / "pages"
+
+
+class DelayingRequestHandler(SimpleHTTPRequestHandler):
+    bytes_sent = 0
+    bytes_lock = threading.Lock()
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        time.sleep(int(query.get("delay", ["0"])[0]) / 1000)
+        if "size" in query:
+            self.send_synthetic_body(int(query["size"][0]))
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        time.sleep(int(parse_qs(urlparse(self.path).query).get("delay", ["0"])[0]) / 1000)
+        self.send_response(204)
+        self.end_headers()
+
+    def send_synthetic_body(self, size: int):
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(urlparse(self.path).path))
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(b"/" * size)
+        self.count_bytes(size)
+
+    def copyfile(self, source, outputfile):
+        data = source.read()
+        outputfile.write(data)
+        self.count_bytes(len(data))
+
+    @classmethod
+    def count_bytes(cls, size: int):
+        with cls.bytes_lock:
+            cls.bytes_sent += size
+
+    def log_message(self, *_):
+        pass
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Number of times each page is rendered")
+    parser.add_argument("--render-tabs", type=int, default=1, help="Number of pages to render concurrently")
+    parser.add_argument("--render-budget-in-secs", type=int, default=RENDER_BUDGET_IN_SECS)
+    parser.add_argument(
+        "--compare-interception",
+        action="store_true",
+        default=False,
+        help="Render every page with and without request blocking and asset caching",
+    )
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose")
+    return parser.parse_args()
+
+
+def benchmark_blocklist() -> Blocklist:
+    # Fixture pages request their third party scripts through localhost
+    bundled = Blocklist.from_file()
+    return Blocklist(bundled.domains | {"localhost"}, bundled.resource_types)
+
+
+async def render_page(render_service: RenderService, page_url: str, output_file: Path, budget: int) -> float:
+    start = time.perf_counter()
+    await render_service.render(page_url, output_file, budget)
+    return time.perf_counter() - start
+
+
+async def render_all(args, base_url: str, output_dir: Path, render_service: RenderService):
+    page_names = sorted(p.name for p in PAGES_DIR.glob("*.html"))
+    pages = [
+        (page_name, f"{base_url}/{page_name}", output_dir / f"{Path(page_name).stem}-{attempt}.pdf")
+        for attempt in range(args.rounds)
+        for page_name in page_names
+    ]
+    async with render_service:
+        # Launch the browser before timing so that the first page isn't penalised
+        await render_service.open_tab()
+        await render_service.close_tab(None)
+        DelayingRequestHandler.bytes_sent = 0
+        with timer() as timings:
+            durations = await asyncio.gather(
+                *(
+                    render_page(render_service, page_url, output_file, args.render_budget_in_secs)
+                    for _, page_url, output_file in pages
+                )
+            )
+
+    print(f"{'Page':<28}{'Renders':>8}{'Mean (s)':>10}{'Max (s)':>10}")
+    for page_name in page_names:
+        page_durations = [duration for (name, _, _), duration in zip(pages, durations) if name == page_name]
+        print(
+            f"{page_name:<28}{len(page_durations):>8}"
+            f"{sum(page_durations) / len(page_durations):>10.2f}{max(page_durations):>10.2f}"
+        )
+    kb_per_page = DelayingRequestHandler.bytes_sent / 1024 / len(pages)
+    print(f"Total: {len(pages)} renders in {timings['wall']:.2f}s, {kb_per_page:.0f} KB served per page")
+    if render_service.request_counts:
+        print(f"Requests: {dict(render_service.request_counts)}")
+
+
+def main(args):
+    handler = partial(DelayingRequestHandler, directory=PAGES_DIR.as_posix())
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with tempfile.TemporaryDirectory() as output_dir, tempfile.TemporaryDirectory() as asset_cache_dir:
+            if args.compare_interception:
+                print("Without request interception")
+                render_service = RenderService(tabs=args.render_tabs)
+                asyncio.run(render_all(args, base_url, Path(output_dir), render_service))
+                print()
+            print("With request blocking and asset cache")
+            render_service = RenderService(
+                tabs=args.render_tabs,
+                blocklist=benchmark_blocklist(),
+                asset_cache=AssetCache(Path(asset_cache_dir)),
+            )
+            asyncio.run(render_all(args, base_url, Path(output_dir), render_service))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.verbose)
+    main(args)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+In-memory stand-in for an S3 compatible server (like a local MinIO) to check remote_storage.S3Storage offline
+
+The server supports CreateBucket, PutObject and GetObject. Unknown buckets return 404 NoSuchBucket and
+failure_rate of the uploads return 503 SlowDown. Run on its own, it checks that an upload round trips,
+that 503s are retried and that a missing bucket fails without retries.
+storage_throughput.py --storage-backend s3 --s3-stand-in benchmarks the S3 backend against it.
+
+Usage:
+./benchmarks/s3_stand_in.py
+"""
+import os
+import random
+import tempfile
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from bench_utils import timer
+
+from remote_storage import S3Storage
+
+
+class S3StandInHandler(BaseHTTPRequestHandler):
+    # boto3 sends "Expect: 100-continue" and waits a second for the answer unless the server speaks HTTP/1.1
+    protocol_version = "HTTP/1.1"
+    buckets = {}
+    failure_rate = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def bucket_and_key(self):
+        bucket, _, key = self.path.split("?", 1)[0].lstrip("/").partition("/")
+        return bucket, key
+
+    def send_error_xml(self, status: int, code: str):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self.send_body(status, body.encode(), "application/xml")
+
+    def send_body(self, status: int, body: bytes = b"", content_type: str = "application/octet-stream"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"stand-in"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        bucket, key = self.bucket_and_key()
+        with self.lock:
+            type(self).requests += 1
+            if not key:
+                self.buckets.setdefault(bucket, {})
+                return self.send_body(200)
+            if bucket not in self.buckets:
+                return self.send_error_xml(404, "NoSuchBucket")
+            if random.random() < self.failure_rate:
+                return self.send_error_xml(503, "SlowDown")
+            self.buckets[bucket][key] = body
+        self.send_body(200)
+
+    def do_GET(self):
+        bucket, key = self.bucket_and_key()
+        with self.lock:
+            type(self).requests += 1
+            body = self.buckets.get(bucket, {}).get(key)
+        if body is None:
+            return self.send_error_xml(404, "NoSuchKey")
+        self.send_body(200, body)
+
+    def log_message(self, *_):
+        pass
+
+
+def start_s3_stand_in(bucket: str, failure_rate: float = 0) -> ThreadingHTTPServer:
+    """Starts the server on a free port with an empty bucket. Its url is http://127.0.0.1:{server.server_port}"""
+    # Any credentials are accepted, boto3 only needs some to sign the requests
+    for name, value in (("AWS_ACCESS_KEY_ID", "stand-in"), ("AWS_SECRET_ACCESS_KEY", "stand-in")):
+        os.environ.setdefault(name, value)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    S3StandInHandler.buckets = {bucket: {}}
+    S3StandInHandler.failure_rate = failure_rate
+    S3StandInHandler.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), S3StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--attempts", type=int, default=3, help="S3Storage max_attempts")
+    return parser.parse_args()
+
+
+def check(name: str, storage: S3Storage, local_file: Path, failure_rate: float):
+    S3StandInHandler.failure_rate = failure_rate
+    S3StandInHandler.requests = 0
+    with timer() as timings:
+        try:
+            result = storage.upload_with_retries(local_file, "check")
+        except Exception as e:
+            result = f"{type(e).__name__}"
+    print(f"{name:<24}{result:<40}{S3StandInHandler.requests:>10}{timings['wall']:>10.2f}")
+
+
+def main(args):
+    server = start_s3_stand_in("bench")
+    endpoint_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_file = Path(tmp_dir) / "bookmark.txt"
+            local_file.write_bytes(random.randbytes(4096))
+            storage = S3Storage("bench", endpoint_url, max_attempts=args.attempts, retry_delay_in_secs=0.01)
+            missing_bucket = S3Storage("missing", endpoint_url, max_attempts=args.attempts, retry_delay_in_secs=0.01)
+
+            print(f"{'Check':<24}{'Result':<40}{'Requests':>10}{'Wall (s)':>10}")
+            check("upload", storage, local_file, 0)
+            stored = storage.client.get_object(Bucket="bench", Key="tele-bookmarks/check.txt")["Body"].read()
+            print(f"{'round trip':<24}{str(stored == local_file.read_bytes()):<40}")
+            # botocore retries 503s itself before S3Storage gets a TransientStorageError to retry
+            check("503 on every request", storage, local_file, 1)
+            check("missing bucket (404)", missing_bucket, local_file, 0)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark muninn-storage upload throughput and retry behaviour on a synthetic backlog, entirely offline
+
+Usage:
+./benchmarks/storage_throughput.py -n 500 --latency-in-ms 20 --failure-rate 0.05
+./benchmarks/storage_throughput.py -n 500 --max-kb 64 --latency-in-ms 20 --bundle-small-files
+./benchmarks/storage_throughput.py -n 200 --storage-backend s3 --s3-bucket bench --s3-endpoint-url http://localhost:9000
+./benchmarks/storage_throughput.py -n 200 --storage-backend s3 --s3-stand-in --failure-rate 0.05
+"""
+import logging
+import random
+import tempfile
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from datetime import datetime
+from pathlib import Path
+
+from bench_utils import load_script, timer
+from py_executable_checklist.workflow import run_workflow
+from s3_stand_in import S3StandInHandler, start_s3_stand_in
+
+from common_utils import setup_logging, table_from
+from remote_storage import LocalDirectoryStorage, S3Storage
+
+muninn_storage = load_script("muninn-storage.py")
+
+
+def create_synthetic_backlog(work_dir: Path, database_file_path: Path, count: int, min_kb: int, max_kb: int) -> int:
+    archive_dir = work_dir / "archive"
+    archive_dir.mkdir()
+    total_bytes = 0
+    with table_from(database_file_path) as db_table:
+        for i in range(count):
+            local_file = archive_dir / f"bookmark-{i:05d}{random.choice(['.pdf', '.txt', '.zip'])}"
+            file_size = random.randint(min_kb, max_kb) * 1024
+            local_file.write_bytes(random.randbytes(file_size))
+            total_bytes += file_size
+            db_table.insert(
+                {
+                    "source": "WebPage",
+                    "note": f"https://example.com/{i}",
+                    "created_at": datetime.now(),
+                    "content": local_file.as_posix(),
+                    "remote_file_id": None,
+                }
+            )
+    return total_bytes
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--count", type=int, default=200, help="Number of archived files in the backlog")
+    parser.add_argument("--min-kb", type=int, default=2, help="Smallest synthetic file size in KB")
+    parser.add_argument("--max-kb", type=int, default=512, help="Largest synthetic file size in KB")
+    parser.add_argument("--storage-backend", choices=["local", "s3"], default="local")
+    parser.add_argument("--latency-in-ms", type=float, default=0, help="Simulated latency per upload (local only)")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0, help="Simulated transient failures (local or s3 stand-in)"
+    )
+    parser.add_argument("--bundle-small-files", action="store_true", default=False, help="Enable bundling mode")
+    parser.add_argument("--bundle-threshold-kb", type=int, default=256, help="Bundle files smaller than this")
+    parser.add_argument("--bundle-max-mb", type=int, default=50, help="Maximum size of a single bundle")
+    parser.add_argument("--s3-bucket", help="Bucket to upload to when benchmarking s3")
+    parser.add_argument("--s3-endpoint-url", help="Endpoint of the S3 compatible server, eg. local MinIO")
+    parser.add_argument(
+        "--s3-stand-in", action="store_true", default=False, help="Upload to an in-memory S3 server (s3_stand_in.py)"
+    )
+    parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose")
+    return parser.parse_args()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        database_file_path = work_dir / "bench.db"
+        total_bytes = create_synthetic_backlog(work_dir, database_file_path, args.count, args.min_kb, args.max_kb)
+
+        stand_in = None
+        if args.storage_backend == "s3" and args.s3_stand_in:
+            stand_in = start_s3_stand_in(args.s3_bucket or "bench", args.failure_rate)
+            endpoint_url = f"http://127.0.0.1:{stand_in.server_port}"
+            storage = S3Storage(args.s3_bucket or "bench", endpoint_url=endpoint_url, retry_delay_in_secs=0.05)
+        elif args.storage_backend == "s3":
+            storage = S3Storage(args.s3_bucket, endpoint_url=args.s3_endpoint_url, retry_delay_in_secs=0.05)
+        else:
+            storage = LocalDirectoryStorage(
+                work_dir / "remote",
+                latency_in_secs=args.latency_in_ms / 1000,
+                failure_rate=args.failure_rate,
+                max_attempts=5,
+                retry_delay_in_secs=0.05,
+            )
+
+        context = {
+            "database_file_path": database_file_path,
+            "storage": storage,
+            "bundle_small_files": args.bundle_small_files,
+            "bundle_threshold_kb": args.bundle_threshold_kb,
+            "bundle_max_mb": args.bundle_max_mb,
+            "verbose": args.verbose,
+        }
+        with timer() as timings:
+            run_workflow(
+                context,
+                [
+                    muninn_storage.SelectPendingBookmarksToUpload,
+                    muninn_storage.PackSmallFilesIntoBundles,
+                    muninn_storage.UploadBundles,
+                    muninn_storage.UploadWebPagesToGDrive,
+                ],
+            )
+
+        if stand_in:
+            stand_in.shutdown()
+        with table_from(database_file_path) as db_table:
+            uploaded = db_table.count(remote_file_id={"!=": None})
+
+    print(f"Backend          : {storage.name}")
+    print(f"Files uploaded   : {uploaded}/{args.count}")
+    print(f"Bytes uploaded   : {total_bytes / 1024 / 1024:.2f} MB")
+    print(f"Wall time        : {timings['wall']:.2f} s")
+    print(
+        f"Throughput       : {uploaded / timings['wall']:.1f} files/s, {total_bytes / 1024 / 1024 / timings['wall']:.2f} MB/s"
+    )
+    if isinstance(storage, LocalDirectoryStorage):
+        print(f"Upload attempts  : {storage.attempts} ({storage.failures} simulated failures retried)")
+        print(f"Remote calls/item: {storage.attempts / args.count:.3f}")
+    if stand_in:
+        print(f"S3 requests      : {S3StandInHandler.requests} (including the retries of botocore)")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.verbose)
+    logging.info("Running storage benchmark with %s", args)
+    main(args)
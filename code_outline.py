@@ -0,0 +1,149 @@
+"""
+Outline of source files for compact LLM context
+
+Only the module docstring (or leading comment), class/function signatures and type declarations are kept.
+Python files are parsed with ast. Other languages use a lightweight regex grammar that keeps declaration lines.
+Files in other languages have no outline (None) and are used as they are
+"""
+import ast
+import os
+import re
+from typing import Dict, List, Optional
+
+# Declaration lines per language. Bodies ({ ... }) are dropped by only keeping the matching line
+JS_TS_DECLARATIONS = re.compile(
+    r"^\s*(?:export\s+)?(?:default\s+)?(?:declare\s+)?(?:abstract\s+)?"
+    r"(?:(?:async\s+)?function\b|class\b|interface\b|enum\b|type\s+\w+|namespace\b|module\s+[\w\"']"
+    r"|(?:const|let|var)\s+\w+\s*(?::[^=]+)?=\s*(?:async\s+)?(?:\([^)]*\)|\w+)\s*(?::[^=]+)?=>)"
+    r"|^\s+(?:(?:public|private|protected|static|readonly|async|get|set|override|abstract)\s+)*"
+    r"(?!(?:if|for|while|switch|catch|return|function|new|else)\b)\w+\s*(?:<[^>]*>)?\((?:(?!=>)[^;])*\)\s*(?::[^{;]+)?\s*\{\s*$"
+)
+# Interface methods are the indented lines (gofmt uses tabs) with a result type
+GO_DECLARATIONS = re.compile(r"^(?:func|type)\b|^\t[A-Za-z_]\w*\([^)]*\)\s+[\w\[\]*(][^{]*$")
+RUST_DECLARATIONS = re.compile(
+    r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+|const\s+|unsafe\s+|extern\s+\"[^\"]+\"\s+)*"
+    r"(?:fn|struct|enum|trait|impl|type|mod|union)\b"
+)
+JVM_DECLARATIONS = re.compile(
+    r"^\s*(?:@\w+\s+)*(?:(?:public|private|protected|internal|static|final|abstract|sealed|open|override|suspend"
+    r"|data|inline|virtual|async|partial|readonly)\s+)*"
+    r"(?:(?:class|interface|enum|record|object|struct|fun|def|trait)\b"
+    r"|(?!(?:return|new|else|throw)\b)[\w<>\[\],.?]+\s+\w+\s*"
+    r"\((?:[^;]*\)\s*(?:throws\s+[\w.,\s]+)?\s*\{?|[^;)]*)\s*$)"
+)
+RUBY_DECLARATIONS = re.compile(r"^\s*(?:def|class|module)\b")
+PYTHON_DECLARATIONS = re.compile(r"^\s*(?:async\s+def|def|class)\b")
+C_DECLARATIONS = re.compile(
+    r"^(?:typedef|struct|enum|union|class|namespace|template)\b"
+    r"|^(?!(?:return|if|for|while|switch|else)\b)[A-Za-z_][\w\s\*&:<>,]*\s[\*&]*\w[\w:~]*\s*\([^;]*\)\s*(?:const\s*)?[;{]?\s*$"
+)
+
+REGEX_GRAMMARS: Dict[str, re.Pattern] = {
+    **dict.fromkeys((".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx", ".mts", ".cts"), JS_TS_DECLARATIONS),
+    ".go": GO_DECLARATIONS,
+    ".rs": RUST_DECLARATIONS,
+    **dict.fromkeys((".java", ".kt", ".kts", ".scala", ".cs", ".swift", ".dart"), JVM_DECLARATIONS),
+    ".rb": RUBY_DECLARATIONS,
+    **dict.fromkeys((".c", ".h", ".cc", ".cpp", ".hpp", ".hh", ".cxx"), C_DECLARATIONS),
+}
+OUTLINE_EXTENSIONS = (".py", ".pyi") + tuple(REGEX_GRAMMARS)
+MAX_HEADER_LINES = 20
+MAX_SIGNATURE_LINES = 20
+
+
+def first_paragraph(docstring: str) -> str:
+    return docstring.strip().split("\n\n", 1)[0].strip()
+
+
+def docstring_lines(node, indent: str) -> List[str]:
+    lines = [f"{indent}{line}" for line in first_paragraph(ast.get_docstring(node) or "").splitlines()]
+    if not lines:
+        return []
+    lines[0] = f'{indent}"""{lines[0].lstrip()}'
+    lines[-1] += '"""'
+    return lines
+
+
+def function_signature(node, indent: str) -> List[str]:
+    decorators = [f"{indent}@{ast.unparse(decorator)}" for decorator in node.decorator_list]
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+    signature = f"{indent}{prefix} {node.name}({ast.unparse(node.args)}){returns}:"
+    body = docstring_lines(node, indent + "    ")
+    return decorators + [signature] + (body or [f"{indent}    ..."])
+
+
+def python_outline_of(body: List[ast.stmt], indent: str = "") -> List[str]:
+    lines = []
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            lines.extend(function_signature(node, indent))
+        elif isinstance(node, ast.ClassDef):
+            lines.extend(f"{indent}@{ast.unparse(decorator)}" for decorator in node.decorator_list)
+            bases = [ast.unparse(base) for base in node.bases] + [ast.unparse(keyword) for keyword in node.keywords]
+            lines.append(f"{indent}class {node.name}({', '.join(bases)}):" if bases else f"{indent}class {node.name}:")
+            members = docstring_lines(node, indent + "    ") + python_outline_of(node.body, indent + "    ")
+            lines.extend(members or [f"{indent}    ..."])
+        elif isinstance(node, ast.AnnAssign):
+            # Annotated module/class attributes are the type declarations of Python
+            lines.append(f"{indent}{ast.unparse(node.target)}: {ast.unparse(node.annotation)}")
+        elif type(node).__name__ == "TypeAlias":
+            lines.append(f"{indent}{ast.unparse(node)}")
+        elif isinstance(node, ast.If) and ast.unparse(node.test) == "TYPE_CHECKING":
+            lines.extend(python_outline_of(node.body, indent))
+    return lines
+
+
+def python_outline(text: str) -> Optional[str]:
+    try:
+        module = ast.parse(text)
+    except (SyntaxError, ValueError):
+        # e.g. Python 2 files
+        return regex_outline(text, PYTHON_DECLARATIONS)
+    lines = docstring_lines(module, "") + python_outline_of(module.body)
+    return "\n".join(lines)
+
+
+def leading_comment(lines: List[str]) -> List[str]:
+    """The licence/module comment at the top of the file, which usually describes the module"""
+    header = []
+    in_block = False
+    for line in lines:
+        stripped = line.strip()
+        if (
+            in_block
+            or stripped.startswith(("//", "/*", "#", "*"))
+            and not stripped.startswith(("#include", "#[", "#!["))
+        ):
+            header.append(line.rstrip())
+            in_block = (in_block or stripped.startswith("/*")) and "*/" not in stripped
+        elif stripped or header:
+            break
+    return header[:MAX_HEADER_LINES]
+
+
+def regex_outline(text: str, grammar: re.Pattern) -> str:
+    lines = text.splitlines()
+    outline = leading_comment(lines)
+    # Signatures split over several lines continue until their parentheses are closed
+    open_parentheses = continuation_lines = 0
+    for line in lines:
+        if open_parentheses > 0 and continuation_lines < MAX_SIGNATURE_LINES:
+            continuation_lines += 1
+        elif grammar.match(line):
+            open_parentheses = continuation_lines = 0
+        else:
+            open_parentheses = 0
+            continue
+        outline.append(line.rstrip().rstrip("{").rstrip())
+        open_parentheses += line.count("(") - line.count(")")
+    return "\n".join(outline)
+
+
+def outline_of(path: str, text: str) -> Optional[str]:
+    """Outline of a source file, or None when its language isn't supported"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".py", ".pyi"):
+        return python_outline(text)
+    grammar = REGEX_GRAMMARS.get(extension)
+    return regex_outline(text, grammar) if grammar else None
@@ -1,5 +1,7 @@
 import base64
 import functools
+import hashlib
+import io
 import json
 import logging
 import os
@@ -7,13 +9,16 @@ import random
 import re
 import shutil
 import string
+import tempfile
 import time
 import uuid
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 from pathlib import Path
-from typing import Dict, List, Type
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Type
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import dataset
 import requests
@@ -25,6 +30,8 @@ GDRIVE_SCOPES = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 
 def setup_logging(verbosity):
     logging_level = logging.WARNING
@@ -52,6 +59,12 @@ def create_dir(output_dir, delete_existing=False):
         path.mkdir()
 
 
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def random_string(length):
     return "".join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
@@ -70,10 +83,145 @@ def fetch_html_page(page_url):
     return page.text
 
 
+class DownloadError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def download_to_file(
+    url: str,
+    target_file: Path,
+    max_size_bytes: Optional[int] = None,
+    allowed_content_types: Optional[Iterable[str]] = None,
+    chunk_size: int = 1024 * 1024,
+    timeout: int = 30,
+    headers: Optional[Dict[str, str]] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """
+    Stream url into target_file in chunks and return the number of bytes written.
+    The response is written to a temporary file next to target_file and only renamed once it is complete,
+    so target_file never contains an error page or a partial download.
+    on_progress is called with the bytes written so far after each chunk. Raising from it abandons the download.
+    Raises DownloadError for error responses, unexpected content types and downloads over max_size_bytes
+    """
+    with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise DownloadError(f"{url} returned {response.status_code}", response.status_code)
+
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if allowed_content_types and content_type not in allowed_content_types:
+            raise DownloadError(f"{url} returned unexpected content type {content_type}")
+
+        content_length = int(response.headers.get("content-length") or 0)
+        if max_size_bytes and content_length > max_size_bytes:
+            raise DownloadError(f"{url} is {content_length} bytes, more than the limit of {max_size_bytes}")
+
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=target_file.parent, prefix=f".{target_file.name}.", delete=False) as f:
+            temp_file = Path(f.name)
+            try:
+                written = 0
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    written += len(chunk)
+                    # Content-Length is missing for chunked responses so the size is checked while streaming too
+                    if max_size_bytes and written > max_size_bytes:
+                        raise DownloadError(f"{url} is larger than the limit of {max_size_bytes} bytes")
+                    f.write(chunk)
+                    if on_progress:
+                        on_progress(written)
+            except BaseException:
+                f.close()
+                temp_file.unlink(missing_ok=True)
+                raise
+
+    os.replace(temp_file, target_file)
+    return written
+
+
+class RangeHttpFile(io.RawIOBase):
+    """
+    Read-only, seekable file backed by HTTP range requests, so that ZipFile can read the central directory
+    and single members of a remote zip without downloading all of it.
+    Use RangeHttpFile.open(), which returns None when the server doesn't support range requests
+    """
+
+    def __init__(self, url: str, size: int, session: requests.Session, timeout: int = 30):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.session = session
+        self.timeout = timeout
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    @classmethod
+    def open(
+        cls, url: str, session: Optional[requests.Session] = None, timeout: int = 30, buffer_size: int = 64 * 1024
+    ) -> Optional[io.BufferedReader]:
+        session = session or requests.Session()
+        with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout) as response:
+            content_range = response.headers.get("content-range", "")
+            if response.status_code != 206 or not re.fullmatch(r"bytes 0-0/\d+", content_range):
+                logging.info("%s doesn't support range requests (%s)", url, response.status_code)
+                return None
+            # Redirects (e.g. to a CDN) are only followed once
+            raw = cls(response.url, int(content_range.rsplit("/", 1)[1]), session, timeout)
+        return io.BufferedReader(raw, buffer_size)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, start + offset)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        headers = {"Range": f"bytes={self.position}-{end - 1}"}
+        response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status_code != 206:
+            raise DownloadError(f"{self.url} returned {response.status_code} for a range request", response.status_code)
+        data = response.content
+        buffer[: len(data)] = data
+        self.position += len(data)
+        self.bytes_fetched += len(data)
+        self.requests += 1
+        return len(data)
+
+
 def html_parser_from(page_html):
     return BeautifulSoup(page_html, "html.parser")
 
 
+TRACKING_QUERY_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid", "ref_src")
+
+
+def normalised_url(url: str) -> str:
+    """Lower case scheme/host, no fragment, trailing slash or tracking parameters"""
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(TRACKING_QUERY_PARAMS)
+    ]
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(sorted(query)), ""))
+
+
+def url_hash(url: str, length: int = 12) -> str:
+    return hashlib.sha256(normalised_url(url).encode("utf-8")).hexdigest()[:length]
+
+
 def get_telegram_api_url(method, token):
     return f"https://api.telegram.org/bot{token}/{method}"
 
@@ -98,6 +246,74 @@ def send_message_to_telegram(bot_token, chat_id, message, format="Markdown", dis
     requests.post(get_telegram_api_url("sendMessage", bot_token), data=data)
 
 
+def paragraphs_from(lines: Iterable[str]) -> Iterator[str]:
+    paragraph = []
+    for line in lines:
+        if line.strip():
+            paragraph.append(line.rstrip("\n"))
+        elif paragraph:
+            yield "\n".join(paragraph)
+            paragraph = []
+    if paragraph:
+        yield "\n".join(paragraph)
+
+
+def pack_into_messages(parts: Iterable[str], separator: str, max_length: int) -> Iterator[str]:
+    message = ""
+    for part in parts:
+        candidate = f"{message}{separator}{part}" if message else part
+        if len(candidate) <= max_length:
+            message = candidate
+            continue
+        if message:
+            yield message
+        message = part
+    if message:
+        yield message
+
+
+def pieces_of(paragraph: str, max_length: int) -> Iterator[str]:
+    if len(paragraph) <= max_length:
+        yield paragraph
+        return
+    # Paragraph doesn't fit in a single message so break it at line boundaries (or mid-line for very long lines)
+    lines = (line[i : i + max_length] for line in paragraph.split("\n") for i in range(0, len(line), max_length))
+    yield from pack_into_messages(lines, "\n", max_length)
+
+
+def split_into_messages(lines: Iterable[str], max_length: int = TELEGRAM_MESSAGE_LIMIT) -> Iterator[str]:
+    """Lazily group lines into messages under the size limit, splitting at paragraph boundaries where possible"""
+    pieces = (piece for paragraph in paragraphs_from(lines) for piece in pieces_of(paragraph, max_length))
+    yield from pack_into_messages(pieces, "\n\n", max_length)
+
+
+class RateLimiter:
+    """
+    Blocks until a call is allowed: at most max_calls in any period_in_secs and at least min_interval_in_secs apart
+    Defaults follow Telegram's limits for sending to a group
+    """
+
+    def __init__(self, max_calls: int = 20, period_in_secs: float = 60, min_interval_in_secs: float = 1):
+        self.max_calls = max_calls
+        self.period_in_secs = period_in_secs
+        self.min_interval_in_secs = min_interval_in_secs
+        self.calls: deque = deque()
+
+    def wait(self):
+        now = time.monotonic()
+        while self.calls and now - self.calls[0] >= self.period_in_secs:
+            self.calls.popleft()
+
+        delay = 0.0
+        if self.calls:
+            delay = self.min_interval_in_secs - (now - self.calls[-1])
+        if len(self.calls) >= self.max_calls:
+            delay = max(delay, self.period_in_secs - (now - self.calls[0]))
+        if delay > 0:
+            time.sleep(delay)
+        self.calls.append(time.monotonic())
+
+
 def decode(src):
     logging.info(f"Decoding {src}")
     src_in_bytes_base64 = bytes(src, encoding="utf-8")
@@ -204,11 +420,11 @@ def verified_chat_id(chat_id):
 
 
 @contextmanager
-def table_from(database_file_path: Path):
+def table_from(database_file_path: Path, table_name: str = "bookmarks"):
     db_connection_string = f"sqlite:///{database_file_path.as_posix()}"
     db = dataset.connect(db_connection_string)
-    bookmarks_table = db.create_table("bookmarks")
-    yield bookmarks_table
+    db_table = db.create_table(table_name)
+    yield db_table
     db.close()
 
 
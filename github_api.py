@@ -0,0 +1,370 @@
+"""
+GitHub repo snapshots, shared by the scripts that download repos
+
+DefaultBranchResolver -> Default branch of a repo from a single GitHub API request (GITHUB_TOKEN is used when set).
+                         Falls back to `git ls-remote --symref` when the API is unavailable or rate limited.
+                         Branch names rarely change so they are cached on disk for a week
+RepoSnapshots         -> Zip archives stored as <owner>__<repo>-<sha12>.zip with a .json file of metadata.
+                         The head commit is checked before downloading (a conditional request, so unchanged repos
+                         don't count against the API rate limit) and only new commits are downloaded.
+                         Older snapshots of a repo are removed once there are more than `keep` of them
+RepoMirrors           -> Bare mirrors of repos for the alternative mirror mode. Updating a mirror only fetches
+                         new commits and snapshots are made locally with `git archive`
+"""
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from common_utils import download_to_file
+
+DEFAULT_BRANCH_CACHE_FILE = Path.home().joinpath("OutputDir", "tele-bookmarks", "github-default-branches.json")
+BRANCH_CACHE_TTL_IN_SECS = 7 * 24 * 60 * 60
+DEFAULT_MIRROR_DIR = Path.home().joinpath("OutputDir", "tele-bookmarks", "git-mirrors")
+GITHUB_URL = "https://github.com"
+# Only branches are fetched, so the transfer doesn't include the pull requests (refs/pull/*) of busy GitHub repos
+MIRROR_FETCH_REFSPEC = "+refs/heads/*:refs/heads/*"
+
+
+class GitHubError(Exception):
+    pass
+
+
+class RepoNotFound(GitHubError):
+    pass
+
+
+def parse_repo(url: str) -> Tuple[str, str]:
+    """(owner, repo) from any GitHub url of the repo, including /tree/<branch>/<path> links"""
+    path_parts = urlparse(url.strip()).path.strip("/").split("/")
+    if len(path_parts) < 2 or not all(path_parts[:2]):
+        raise GitHubError(f"Not a GitHub repository url: {url}")
+    owner, repo = path_parts[0], path_parts[1]
+    return owner, repo[: -len(".git")] if repo.endswith(".git") else repo
+
+
+def repo_url(owner: str, repo: str, base_url: str = GITHUB_URL) -> str:
+    return f"{base_url.rstrip('/')}/{owner}/{repo}"
+
+
+def archive_url(owner: str, repo: str, branch: str) -> str:
+    return f"{repo_url(owner, repo)}/archive/refs/heads/{branch}.zip"
+
+
+def commit_archive_url(owner: str, repo: str, sha: str) -> str:
+    return f"{repo_url(owner, repo)}/archive/{sha}.zip"
+
+
+def api_headers() -> Dict[str, str]:
+    headers = {"Accept": "application/vnd.github+json"}
+    token = os.getenv("GITHUB_TOKEN")
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+def default_branch_from_api(owner: str, repo: str, timeout: int = 10) -> str:
+    response = requests.get(f"https://api.github.com/repos/{owner}/{repo}", headers=api_headers(), timeout=timeout)
+    if response.status_code == 404:
+        raise RepoNotFound(f"{owner}/{repo} not found")
+    response.raise_for_status()
+    return response.json()["default_branch"]
+
+
+def default_branch_from_git(owner: str, repo: str, timeout: int = 30) -> str:
+    # Prints "ref: refs/heads/<branch>\tHEAD" followed by the commit of HEAD
+    result = subprocess.run(
+        ["git", "ls-remote", "--symref", repo_url(owner, repo), "HEAD"],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+    )
+    for line in result.stdout.splitlines():
+        if line.startswith("ref: refs/heads/") and line.endswith("\tHEAD"):
+            return line[len("ref: refs/heads/") : -len("\tHEAD")]
+    raise GitHubError(f"Unable to find the default branch of {owner}/{repo}: {result.stderr.strip()}")
+
+
+def run_git(*args, timeout: int = 60 * 60) -> str:
+    result = subprocess.run(
+        ["git", *map(str, args)],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+    )
+    if result.returncode != 0:
+        raise GitHubError(f"git {' '.join(map(str, args))} failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+
+def head_commit_from_api(owner: str, repo: str, branch: str, etag: Optional[str] = None, timeout: int = 10):
+    """
+    (sha, etag) of the head of branch. sha is None when it still matches etag.
+    Responses to conditional requests that return 304 don't count against the rate limit
+    """
+    headers = {**api_headers(), "Accept": "application/vnd.github.sha"}
+    if etag:
+        headers["If-None-Match"] = etag
+    response = requests.get(
+        f"https://api.github.com/repos/{owner}/{repo}/commits/{branch}", headers=headers, timeout=timeout
+    )
+    if response.status_code == 304:
+        return None, etag
+    if response.status_code in (404, 422):
+        raise GitHubError(f"{owner}/{repo} has no branch {branch}")
+    response.raise_for_status()
+    return response.text.strip(), response.headers.get("ETag")
+
+
+def head_commit_from_git(owner: str, repo: str, branch: str, timeout: int = 30) -> str:
+    result = subprocess.run(
+        ["git", "ls-remote", repo_url(owner, repo), f"refs/heads/{branch}"],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+    )
+    for line in result.stdout.splitlines():
+        sha, _, ref = line.partition("\t")
+        if ref == f"refs/heads/{branch}":
+            return sha
+    raise GitHubError(f"Unable to find the head of {owner}/{repo}@{branch}: {result.stderr.strip()}")
+
+
+def head_commit(owner: str, repo: str, branch: str, etag: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    try:
+        return head_commit_from_api(owner, repo, branch, etag)
+    except requests.RequestException as e:
+        logging.info("GitHub API lookup failed for %s/%s (%s). Trying git ls-remote", owner, repo, e)
+        try:
+            return head_commit_from_git(owner, repo, branch), None
+        except (OSError, subprocess.SubprocessError) as git_error:
+            raise GitHubError(f"Unable to find the head of {owner}/{repo}@{branch}: {git_error}") from e
+
+
+class DefaultBranchResolver:
+    def __init__(self, cache_file: Path = DEFAULT_BRANCH_CACHE_FILE, ttl_in_secs: int = BRANCH_CACHE_TTL_IN_SECS):
+        self.cache_file = cache_file
+        self.ttl_in_secs = ttl_in_secs
+        self.lock = threading.Lock()
+        self.cache = self.load_cache()
+
+    def load_cache(self) -> Dict[str, dict]:
+        try:
+            return json.loads(self.cache_file.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.warning("Ignoring unreadable branch cache %s", self.cache_file)
+            return {}
+
+    def save_cache(self):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_file.parent, suffix=".tmp", delete=False) as f:
+            json.dump(self.cache, f, indent=2, sort_keys=True)
+        os.replace(f.name, self.cache_file)
+
+    def cached_branch(self, key: str) -> Optional[str]:
+        entry = self.cache.get(key)
+        if entry and time.time() - entry["resolved_at"] < self.ttl_in_secs:
+            return entry["branch"]
+        return None
+
+    def default_branch(self, owner: str, repo: str) -> str:
+        key = f"{owner}/{repo}".lower()
+        with self.lock:
+            branch = self.cached_branch(key)
+        if branch:
+            return branch
+
+        try:
+            branch = default_branch_from_api(owner, repo)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logging.info("GitHub API lookup failed for %s (%s). Trying git ls-remote", key, e)
+            try:
+                branch = default_branch_from_git(owner, repo)
+            except (OSError, subprocess.SubprocessError) as git_error:
+                raise GitHubError(f"Unable to find the default branch of {key}: {git_error}") from e
+
+        logging.info("Default branch of %s is %s", key, branch)
+        with self.lock:
+            self.cache[key] = {"branch": branch, "resolved_at": time.time()}
+            self.save_cache()
+        return branch
+
+    def forget(self, owner: str, repo: str):
+        """Drop a cached branch, e.g. after its archive returned 404 because the branch was renamed"""
+        with self.lock:
+            if self.cache.pop(f"{owner}/{repo}".lower(), None):
+                self.save_cache()
+
+
+class RepoSnapshots:
+    def __init__(self, output_dir: Path, keep: int = 2, branch_resolver: Optional[DefaultBranchResolver] = None):
+        self.output_dir = output_dir
+        self.keep = keep
+        self.branch_resolver = branch_resolver or DefaultBranchResolver()
+
+    def snapshot_path(self, owner: str, repo: str, sha: str) -> Path:
+        # The owner keeps forks of a repo at the same commit from sharing (and pruning) each other's snapshot
+        return self.output_dir / f"{owner}__{repo}-{sha[:12]}.zip"
+
+    def snapshots_of(self, owner: str, repo: str) -> List[dict]:
+        """Metadata of the stored snapshots of a repo, newest first"""
+        full_name = f"{owner}/{repo}".lower()
+        snapshots = []
+        # <repo>-<sha12>.json are the snapshots from before the owner was part of the name
+        metadata_files = {*self.output_dir.glob(f"{owner}__{repo}-*.json"), *self.output_dir.glob(f"{repo}-*.json")}
+        for metadata_file in metadata_files:
+            try:
+                metadata = json.loads(metadata_file.read_text())
+            except (OSError, ValueError):
+                logging.warning("Ignoring unreadable snapshot metadata %s", metadata_file)
+                continue
+            if metadata.get("repo") == full_name and Path(metadata["zip_file"]).exists():
+                snapshots.append(metadata)
+        return sorted(snapshots, key=lambda metadata: metadata["downloaded_at"], reverse=True)
+
+    def latest(self, owner: str, repo: str) -> Tuple[str, Optional[dict]]:
+        """
+        Default branch of the repo and the metadata of its latest snapshot if it is still current.
+        Only the head commit is looked up, nothing is downloaded
+        """
+        branch = self.branch_resolver.default_branch(owner, repo)
+        stored = [metadata for metadata in self.snapshots_of(owner, repo) if metadata["branch"] == branch]
+        newest = stored[0] if stored else None
+        try:
+            sha, etag = head_commit(owner, repo, branch, newest.get("etag") if newest else None)
+        except GitHubError:
+            # The cached default branch may have been renamed or deleted
+            self.branch_resolver.forget(owner, repo)
+            raise
+        if sha is None:
+            return branch, newest
+        current = next((metadata for metadata in stored if metadata["sha"] == sha), None)
+        if current:
+            current["etag"] = etag
+            current["checked_at"] = datetime.now().isoformat()
+            self.write_metadata(current)
+            return branch, current
+        return branch, {"repo": f"{owner}/{repo}".lower(), "branch": branch, "sha": sha, "etag": etag}
+
+    def write_metadata(self, metadata: dict):
+        Path(metadata["zip_file"]).with_suffix(".json").write_text(json.dumps(metadata, indent=2, sort_keys=True))
+
+    def snapshot(
+        self,
+        owner: str,
+        repo: str,
+        download: Optional[Callable[[str, Path], int]] = None,
+        latest: Optional[Tuple[str, dict]] = None,
+    ) -> Tuple[Path, bool]:
+        """
+        Path of a zip file of the head of the default branch and whether it was downloaded just now.
+        download(url, target_file) fetches a commit archive and returns its size in bytes.
+        latest is what latest() returned when the head commit was already looked up
+        """
+        branch, metadata = latest or self.latest(owner, repo)
+        if "zip_file" in metadata:
+            logging.info("%s/%s is unchanged at %s", owner, repo, metadata["sha"][:12])
+            return Path(metadata["zip_file"]), False
+
+        sha = metadata["sha"]
+        target_file = self.snapshot_path(owner, repo, sha)
+        # The archive of the commit rather than the branch, so the zip always matches the recorded sha
+        size = (download or download_to_file)(commit_archive_url(owner, repo, sha), target_file)
+        self.add(owner, repo, metadata, target_file, size)
+        logging.info("Downloaded %s/%s at %s (%.0f KB)", owner, repo, sha[:12], size / 1024)
+        return target_file, True
+
+    def snapshot_from_mirror(self, owner: str, repo: str, mirrors: "RepoMirrors") -> Tuple[Path, bool]:
+        """Same as snapshot() but the mirror of the repo is updated and archived instead of downloading a zip"""
+        branch, sha = mirrors.update(owner, repo)
+        current = next((metadata for metadata in self.snapshots_of(owner, repo) if metadata["sha"] == sha), None)
+        if current:
+            logging.info("%s/%s is unchanged at %s", owner, repo, sha[:12])
+            return Path(current["zip_file"]), False
+
+        target_file = self.snapshot_path(owner, repo, sha)
+        size = mirrors.archive(owner, repo, sha, target_file)
+        metadata = {"repo": f"{owner}/{repo}".lower(), "branch": branch, "sha": sha, "etag": None}
+        self.add(owner, repo, metadata, target_file, size)
+        logging.info("Archived %s/%s at %s from its mirror (%.0f KB)", owner, repo, sha[:12], size / 1024)
+        return target_file, True
+
+    def add(self, owner: str, repo: str, metadata: dict, zip_file: Path, size: int):
+        now = datetime.now().isoformat()
+        metadata = {**metadata, "zip_file": zip_file.as_posix(), "size": size, "downloaded_at": now, "checked_at": now}
+        self.write_metadata(metadata)
+        self.prune(self.snapshots_of(owner, repo))
+
+    def prune(self, snapshots: Iterable[dict]):
+        for metadata in list(snapshots)[self.keep :]:
+            zip_file = Path(metadata["zip_file"])
+            logging.info("Removing old snapshot %s", zip_file)
+            zip_file.unlink(missing_ok=True)
+            zip_file.with_suffix(".json").unlink(missing_ok=True)
+
+
+class RepoMirrors:
+    """
+    Bare mirrors of repos cloned from base_url/<owner>/<repo>.
+    base_url can be any url git clones from, e.g. file:///srv/git for local repos
+    """
+
+    def __init__(self, mirror_dir: Path = DEFAULT_MIRROR_DIR, base_url: str = GITHUB_URL):
+        self.mirror_dir = mirror_dir
+        self.base_url = base_url
+
+    def mirror_path(self, owner: str, repo: str) -> Path:
+        return self.mirror_dir / owner.lower() / f"{repo.lower()}.git"
+
+    def update(self, owner: str, repo: str) -> Tuple[str, str]:
+        """Clone or fetch the mirror of the repo and return the (branch, sha) of its HEAD"""
+        mirror_path = self.mirror_path(owner, repo)
+        if (mirror_path / "HEAD").exists():
+            logging.info("Fetching new commits of %s/%s", owner, repo)
+            # Set again so that mirrors cloned with --mirror stop fetching pull requests too
+            run_git("-C", mirror_path, "config", "remote.origin.fetch", MIRROR_FETCH_REFSPEC)
+            run_git("-C", mirror_path, "fetch", "--prune", "origin")
+        else:
+            logging.info("Cloning a mirror of %s/%s into %s", owner, repo, mirror_path)
+            mirror_path.parent.mkdir(parents=True, exist_ok=True)
+            # --bare only clones branches and tags. --mirror would also clone refs/pull/* of GitHub repos
+            run_git("clone", "--bare", repo_url(owner, repo, self.base_url), mirror_path)
+            run_git("-C", mirror_path, "config", "remote.origin.fetch", MIRROR_FETCH_REFSPEC)
+        branch = run_git("-C", mirror_path, "symbolic-ref", "--short", "HEAD")
+        return branch, run_git("-C", mirror_path, "rev-parse", "HEAD")
+
+    def archive(self, owner: str, repo: str, sha: str, target_file: Path) -> int:
+        """Write a zip of the commit laid out like the GitHub archive (a single <repo>-<sha> folder)"""
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=target_file.parent, prefix=f".{target_file.name}.", delete=False) as f:
+            temp_file = Path(f.name)
+        try:
+            run_git(
+                "-C",
+                self.mirror_path(owner, repo),
+                "archive",
+                "--format=zip",
+                f"--prefix={repo}-{sha}/",
+                "-o",
+                temp_file,
+                sha,
+            )
+        except BaseException:
+            temp_file.unlink(missing_ok=True)
+            raise
+        os.replace(temp_file, target_file)
+        return target_file.stat().st_size
@@ -0,0 +1,133 @@
+"""
+Prepare photos for OCR
+
+Stages run in order on NumPy arrays and each one is timed:
+grayscale -> dark mode to light -> downscale to target DPI -> crop uniform borders -> deskew (optional)
+-> adaptive binarization
+"""
+import time
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+# Telegram strips metadata so most photos are phone screenshots without DPI information
+ASSUMED_SOURCE_DPI = 450
+TARGET_DPI = 300
+
+
+def to_grayscale(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image.astype(np.float32)
+    # ITU-R 601-2 luma transform, same as Pillow's "L" mode
+    return image[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def to_dark_text_on_light(image: np.ndarray) -> np.ndarray:
+    """Invert dark mode screenshots so that the later stages can always assume dark text on a light background"""
+    return 255 - image if image.mean() < 128 else image
+
+
+def downscale(image: np.ndarray, source_dpi: float, target_dpi: float = TARGET_DPI) -> np.ndarray:
+    scale = target_dpi / source_dpi
+    if scale >= 1:
+        return image
+    height, width = image.shape
+    resized = Image.fromarray(image).resize((round(width * scale), round(height * scale)), Image.Resampling.BOX)
+    return np.asarray(resized, dtype=np.float32)
+
+
+def crop_uniform_borders(image: np.ndarray, tolerance: float = 12, padding: int = 10) -> np.ndarray:
+    """Remove rows and columns at the edges that don't contain anything but background"""
+    rows_with_content = np.flatnonzero(np.ptp(image, axis=1) > tolerance)
+    columns_with_content = np.flatnonzero(np.ptp(image, axis=0) > tolerance)
+    if rows_with_content.size == 0 or columns_with_content.size == 0:
+        return image
+
+    top = max(rows_with_content[0] - padding, 0)
+    bottom = min(rows_with_content[-1] + padding + 1, image.shape[0])
+    left = max(columns_with_content[0] - padding, 0)
+    right = min(columns_with_content[-1] + padding + 1, image.shape[1])
+    return image[top:bottom, left:right]
+
+
+def skew_angle(image: np.ndarray, max_angle: float = 5, step: float = 0.5) -> float:
+    """Find the rotation where text lines line up best, ie. the row profile has the highest variance"""
+    preview = Image.fromarray(255 - image).convert("L")
+    preview.thumbnail((800, 800))
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step, step):
+        row_profile = np.asarray(preview.rotate(angle, resample=Image.Resampling.NEAREST), dtype=np.float32).sum(axis=1)
+        score = float(np.var(row_profile))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def deskew(image: np.ndarray) -> np.ndarray:
+    angle = skew_angle(image)
+    if abs(angle) < 0.5:
+        return image
+    rotated = Image.fromarray(image).rotate(angle, resample=Image.Resampling.BILINEAR, expand=True, fillcolor=255)
+    return np.asarray(rotated, dtype=np.float32)
+
+
+def adaptive_binarize(image: np.ndarray, sensitivity: float = 0.15) -> np.ndarray:
+    """
+    Bradley-Roth thresholding: a pixel is text if it is darker than the mean of its neighbourhood
+    """
+    window = max(15, min(image.shape) // 16) | 1
+    half = window // 2
+    padded = np.pad(image, half + 1, mode="edge").astype(np.float64)
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+
+    height, width = image.shape
+    window_sum = (
+        integral[window : window + height, window : window + width]
+        - integral[:height, window : window + width]
+        - integral[window : window + height, :width]
+        + integral[:height, :width]
+    )
+    local_mean = window_sum / (window * window)
+    return np.where(image < local_mean * (1 - sensitivity), 0, 255).astype(np.uint8)
+
+
+def source_dpi_of(image: Image.Image) -> float:
+    dpi = image.info.get("dpi")
+    return float(dpi[0]) if dpi and dpi[0] > 1 else ASSUMED_SOURCE_DPI
+
+
+def preprocess_image(
+    image_file_path: Path,
+    output_file_path: Path,
+    target_dpi: float = TARGET_DPI,
+    crop_borders: bool = True,
+    straighten: bool = False,
+) -> Dict[str, float]:
+    """Write an OCR friendly copy of the image and return the time (in secs) spent in each stage"""
+    timings: Dict[str, float] = {}
+
+    def timed(stage_name: str, stage, *stage_args) -> np.ndarray:
+        start = time.perf_counter()
+        result = stage(*stage_args)
+        timings[stage_name] = time.perf_counter() - start
+        return result
+
+    with Image.open(image_file_path) as source_image:
+        source_dpi = source_dpi_of(source_image)
+        image = timed("load", lambda: np.asarray(source_image.convert("RGB")))
+
+    image = timed("grayscale", to_grayscale, image)
+    image = timed("polarity", to_dark_text_on_light, image)
+    image = timed("downscale", downscale, image, source_dpi, target_dpi)
+    if crop_borders:
+        image = timed("crop_borders", crop_uniform_borders, image)
+    if straighten:
+        image = timed("deskew", deskew, image)
+    image = timed("binarize", adaptive_binarize, image)
+
+    start = time.perf_counter()
+    Image.fromarray(image).save(output_file_path, dpi=(target_dpi, target_dpi))
+    timings["save"] = time.perf_counter() - start
+    return timings
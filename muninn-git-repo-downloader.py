@@ -1,23 +1,48 @@
 #!/usr/bin/env python3
 """
 Download the snapshot of GitHub repos as a zip file and save it to local file system
+
+Snapshots are stored per commit as <owner>__<repo>-<sha12>.zip. The head of the default branch is checked first
+and the archive is only downloaded when it has new commits. Use --refresh to check repos that were already downloaded.
+
+With --mirror-mode a bare mirror of each repo is kept in --mirror-dir instead. Refreshing it only fetches
+the new commits and the snapshot zip is made locally with `git archive`. Better for large, busy repos.
+--mirror-base-url clones the mirrors from another git host instead of GitHub (benchmarks/git_mirror.py uses file://)
+Archives are streamed to disk and only renamed into place once complete and valid,
+so memory use doesn't depend on the size of the repo
 """
 import logging
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from pathlib import Path
-from typing import Dict, List, Type, Union
+from typing import Dict, List, Optional, Tuple, Type, Union
 
-import requests
 from dotenv import load_dotenv
 from py_executable_checklist.workflow import WorkflowBase
 
-from common_utils import run_in_background, setup_logging, table_from
+from common_utils import (
+    DownloadError,
+    download_to_file,
+    run_in_background,
+    setup_logging,
+    table_from,
+)
+from github_api import (
+    DEFAULT_MIRROR_DIR,
+    GITHUB_URL,
+    RepoMirrors,
+    RepoNotFound,
+    RepoSnapshots,
+    parse_repo,
+)
 from tele_bookmark_bot import GitHub
 
 load_dotenv()
 
 OUTPUT_DIR = Path.home().joinpath("OutputDir", "tele-bookmarks", "web-to-pdf")
 
+ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed", "application/octet-stream")
+NOT_DOWNLOADED = "Not downloaded"
+
 
 class SelectPendingBookmarksToDownload(WorkflowBase):
     """
@@ -25,46 +50,59 @@ class SelectPendingBookmarksToDownload(WorkflowBase):
     """
 
     database_file_path: Path
+    refresh: bool
 
     def execute(self) -> dict:
         with table_from(self.database_file_path) as db_table:
             logging.info("Selecting next batch of GH repos to download from %s table", db_table.name)
-            github_repos = db_table.find(source=GitHub.__name__, content=None)
-            bookmarked_repos = {gh_repo["id"]: gh_repo["note"] for gh_repo in github_repos}
+            if self.refresh:
+                # Every downloaded repo is checked for new commits
+                github_repos = [
+                    gh_repo for gh_repo in db_table.find(source=GitHub.__name__) if gh_repo["content"] != NOT_DOWNLOADED
+                ]
+            else:
+                github_repos = db_table.find(source=GitHub.__name__, content=None)
+            bookmarked_repos = {gh_repo["id"]: (gh_repo["note"], gh_repo["content"]) for gh_repo in github_repos}
 
         return {"bookmarked_repos": bookmarked_repos}
 
 
 class DownloadGitRepo(WorkflowBase):
     """
-    Download selected web pages to local directory and update database
+    Download snapshots of the selected repos that changed since they were last downloaded and update database
     """
 
-    bookmarked_repos: Dict[str, str]
+    bookmarked_repos: Dict[str, Tuple[str, Optional[str]]]
     database_file_path: Path
-
-    def download_file(self, file_name: str, file_url: str) -> Union[Path, str]:
-        target_file = OUTPUT_DIR / f"{file_name}.zip"
-        if target_file.exists():
-            return target_file
-
-        url = file_url + "main.zip"
-        response = requests.get(url)
-        if response.status_code != 200:
-            url = file_url + "master.zip"
-            response = requests.get(url)
-
-        with open(target_file, "wb") as file:
-            file.write(response.content)
-
-        if target_file.exists():
-            return target_file
-        else:
-            logging.error("Failed to download zip for %s", file_url)
-            return "Not downloaded"
-
-    def build_zip_file_path_from(self, gh_repo_url) -> str:
-        return gh_repo_url + "/archive/refs/heads/"
+    max_download_mb: int
+    keep_snapshots: int
+    mirror_mode: bool
+    mirror_dir: Path
+    mirror_base_url: str
+
+    def download_archive(self, url: str, target_file: Path) -> int:
+        return download_to_file(
+            url,
+            target_file,
+            max_size_bytes=self.max_download_mb * 1024 * 1024,
+            allowed_content_types=ZIP_CONTENT_TYPES,
+            timeout=60,
+        )
+
+    def download_file(self, gh_repo: str) -> Tuple[Union[Path, str], bool]:
+        """Latest snapshot of the repo (or why there isn't one) and whether it was downloaded just now"""
+        try:
+            if self.mirror_mode:
+                return self.snapshots.snapshot_from_mirror(*parse_repo(gh_repo), self.mirrors)
+            return self.snapshots.snapshot(*parse_repo(gh_repo), download=self.download_archive)
+        except RepoNotFound as e:
+            logging.error(f"Not downloading {gh_repo}: {e}")
+        except DownloadError as e:
+            if e.status_code is not None:
+                raise
+            # Too large or not a zip file. Retrying won't change that
+            logging.error(f"Not downloading {gh_repo}: {e}")
+        return NOT_DOWNLOADED, False
 
     def content_from(self, downloaded_file_path_or_error: Union[Path, str]) -> str:
         if isinstance(downloaded_file_path_or_error, Path):
@@ -73,15 +111,27 @@ class DownloadGitRepo(WorkflowBase):
             return downloaded_file_path_or_error
 
     def execute(self):
-        logging.info("Downloading [%s] web pages", len(self.bookmarked_repos))
-        for db_id, gh_repo in self.bookmarked_repos.items():
-            logging.info(f"Downloading {gh_repo}")
-            repo_zip_file = self.build_zip_file_path_from(gh_repo)
-            target_file_name = Path(gh_repo).name
-            local_zip_file = self.download_file(target_file_name, repo_zip_file)
+        logging.info("Checking [%s] GH repos for new commits", len(self.bookmarked_repos))
+        self.snapshots = RepoSnapshots(OUTPUT_DIR, keep=self.keep_snapshots)
+        self.mirrors = RepoMirrors(self.mirror_dir, self.mirror_base_url)
+        downloaded = 0
+        for db_id, (gh_repo, current_content) in self.bookmarked_repos.items():
+            logging.info(f"Checking {gh_repo}")
+            try:
+                local_zip_file, is_new = self.download_file(gh_repo)
+            except Exception as e:
+                # Network and server errors are left as they are and tried again on the next run
+                logging.error(f"Unable to download {gh_repo}: {e}")
+                continue
+            downloaded += is_new
+            content = self.content_from(local_zip_file)
+            if content == current_content or (current_content and content == NOT_DOWNLOADED):
+                continue
             logging.info(f"Updating database with local id {db_id} -> download file: {local_zip_file}")
             with table_from(self.database_file_path) as db_table:
-                db_table.update({"id": str(db_id), "content": self.content_from(local_zip_file)}, ["id"])
+                # The new snapshot hasn't been uploaded yet, so muninn-storage picks it up again
+                db_table.update({"id": str(db_id), "content": content, "remote_file_id": None}, ["id"])
+        logging.info("Downloaded %s of %s GH repos", downloaded, len(self.bookmarked_repos))
 
 
 def workflow() -> List[Type[WorkflowBase]]:
@@ -94,6 +144,33 @@ def workflow() -> List[Type[WorkflowBase]]:
 def parse_args():
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-d", "--database-file-path", type=Path, required=True, help="Path to database file")
+    parser.add_argument(
+        "--max-download-mb", type=int, default=500, help="Skip repos with an archive larger than this (in MB)"
+    )
+    parser.add_argument(
+        "--keep-snapshots", type=int, default=2, help="Number of snapshots to keep for each repo (newest first)"
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        action="store_true",
+        default=False,
+        help="Check every downloaded repo for new commits instead of only the pending ones",
+    )
+    parser.add_argument(
+        "--mirror-mode",
+        action="store_true",
+        default=False,
+        help="Keep a bare mirror of each repo and fetch new commits instead of downloading zip archives",
+    )
+    parser.add_argument(
+        "--mirror-dir", type=Path, default=DEFAULT_MIRROR_DIR, help="Directory for the bare mirrors of --mirror-mode"
+    )
+    parser.add_argument(
+        "--mirror-base-url",
+        default=GITHUB_URL,
+        help="Clone the mirrors of --mirror-mode from <url>/<owner>/<repo>, e.g. file:///srv/git or git://localhost",
+    )
     parser.add_argument(
         "-b", "--batch", action="store_true", default=False, help="Run in batch mode (no scheduling, just run once)"
     )
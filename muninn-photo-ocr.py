@@ -1,20 +1,28 @@
 import logging
 import os
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import time
+from argparse import ArgumentParser, BooleanOptionalAction, RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import telegram
 from dotenv import load_dotenv
-from py_executable_checklist.workflow import WorkflowBase, run_command
+from py_executable_checklist.workflow import WorkflowBase
 
 from common_utils import (
+    RateLimiter,
+    available_cpus,
     retry,
     run_in_background,
     send_message_to_telegram,
     setup_logging,
+    split_into_messages,
     table_from,
 )
+from image_preprocess import preprocess_image
+from ocr_cache import OcrCache, ocr_settings
+from ocr_engine import OcrEngine, create_ocr_engine, ocr_engine_version
 from tele_bookmark_bot import PhotoOcr
 
 # Common functions across steps
@@ -22,19 +30,56 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_CHAT_ID = os.getenv("GROUP_CHAT_ID")
+NOT_CONVERTED = "Not converted"
+
+# Each worker handles one image at a time, so stop tesseract's OpenMP threads competing across the pool.
+# OpenMP reads it once, when tesserocr is first imported. That happens in this process before the workers are forked
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+# One engine per worker process so that the model stays loaded across images
+worker_ocr_engine: Optional[OcrEngine] = None
+
+
+def init_ocr_worker(engine_name: str, timeout_in_secs: int):
+    global worker_ocr_engine
+    worker_ocr_engine = create_ocr_engine(engine_name, timeout_in_secs=timeout_in_secs)
+
+
+def convert_image(image_file_path: Path, preprocess: bool, straighten: bool) -> Tuple[Path, str]:
+    text_path = image_file_path.with_suffix(".txt")
+    if not preprocess:
+        text_path.write_text(worker_ocr_engine.image_to_text(image_file_path))
+        return text_path, worker_ocr_engine.version
+
+    preprocessed_image_path = image_file_path.with_suffix(".ocr.png")
+    try:
+        timings = preprocess_image(image_file_path, preprocessed_image_path, straighten=straighten)
+        logging.debug("Preprocessed %s: %s", image_file_path, {k: f"{v * 1000:.1f}ms" for k, v in timings.items()})
+        text_path.write_text(worker_ocr_engine.image_to_text(preprocessed_image_path))
+    finally:
+        preprocessed_image_path.unlink(missing_ok=True)
+    return text_path, worker_ocr_engine.version
 
 
 class FetchNextAvailableBookmarkFromDatabase(WorkflowBase):
     """
-    Fetch next bookmark with PhotoOcr source without a fileId
+    Fetch next batch of bookmarks (oldest first) with PhotoOcr source without a fileId.
+    Photos that failed before come after the ones that haven't been tried
     """
 
     database_file_path: Path
+    ocr_batch_size: int
 
     def execute(self) -> dict:
         with table_from(self.database_file_path) as db_table:
             logging.info("Selecting next batch of photos to convert to text from %s table", db_table.name)
-            photos = db_table.find(source=PhotoOcr.__name__, remote_file_id=None)
+            photos = db_table.find(
+                source=PhotoOcr.__name__,
+                remote_file_id=None,
+                order_by=["ocr_attempts", "created_at", "id"],
+                _limit=self.ocr_batch_size,
+            )
             local_photos = {photo["id"]: Path(photo["content"]) for photo in photos}
 
         return {"local_photos": local_photos}
@@ -42,27 +87,129 @@ class FetchNextAvailableBookmarkFromDatabase(WorkflowBase):
 
 class ConvertImageToText(WorkflowBase):
     """
-    Convert image to text using tesseract
+    Convert images to text using a pool of tesseract workers
     """
 
     local_photos: Dict[str, Path]
     database_file_path: Path
+    ocr_engine: str
+    ocr_workers: int
+    ocr_timeout_in_secs: int
+    preprocess: bool
+    deskew: bool
+    ocr_cache_size: int
+    ocr_time_budget_in_secs: int
+    max_ocr_attempts: int
 
     def execute(self) -> dict:
-        logging.info("Converting %s Photos", len(self.local_photos))
         converted_files = []
+        if not self.local_photos:
+            return {"converted_files": converted_files}
+
+        deadline = time.monotonic() + self.ocr_time_budget_in_secs
+        # Fails here when the engine isn't installed, before any photo gets a failed attempt for it
+        engine_version = ocr_engine_version(self.ocr_engine)
+
+        ocr_cache = None
+        if self.ocr_cache_size:
+            ocr_cache = OcrCache(
+                self.database_file_path,
+                engine_version,
+                ocr_settings(self.preprocess, self.deskew),
+                max_entries=self.ocr_cache_size,
+            )
+        photos_to_convert = {}
+        fingerprints = {}
         for db_id, image_file_path in self.local_photos.items():
-            image_name = image_file_path.stem
-            text_path = image_file_path.parent / f"{image_name}"
-            tesseract_command = f"tesseract {image_file_path} {text_path} --oem 1 -l eng"
-            run_command(tesseract_command)
-            text_path_with_suffix = text_path.with_suffix(".txt")
-            logging.info(f"Updating database with local id {db_id} -> remote file id: {text_path_with_suffix}")
-            with table_from(self.database_file_path) as db_table:
-                db_table.update({"id": db_id, "remote_file_id": text_path_with_suffix.as_posix()}, ["id"])
-            converted_files.append(text_path_with_suffix)
+            if not ocr_cache:
+                photos_to_convert[db_id] = image_file_path
+                continue
+            try:
+                fingerprints[db_id] = ocr_cache.fingerprint(image_file_path)
+            except OSError as e:
+                logging.warning("Unable to fingerprint %s: %s", image_file_path, e)
+                photos_to_convert[db_id] = image_file_path
+                continue
+            cached_text = ocr_cache.lookup(fingerprints[db_id])
+            if cached_text is None:
+                photos_to_convert[db_id] = image_file_path
+                continue
+            text_path = image_file_path.with_suffix(".txt")
+            text_path.write_text(cached_text)
+            self.save_converted(db_id, text_path)
+            converted_files.append(text_path)
+
+        if ocr_cache:
+            logging.info("OCR cache hit rate: %.0f%% (%s hits)", ocr_cache.hit_rate * 100, ocr_cache.hits)
+
+        if photos_to_convert:
+            converted_files.extend(self.convert(photos_to_convert, ocr_cache, fingerprints, deadline))
+
+        if ocr_cache:
+            ocr_cache.evict()
         return {"converted_files": converted_files}
 
+    def convert(
+        self, photos_to_convert: Dict[str, Path], ocr_cache: Optional[OcrCache], fingerprints: dict, deadline: float
+    ) -> List[Path]:
+        converted_files = []
+        handled = set()
+
+        def save_result(future):
+            handled.add(future)
+            db_id = pending_ocr[future]
+            try:
+                text_path_with_suffix, engine_version = future.result()
+            except Exception as e:
+                # Anything that goes wrong with one image (e.g. a corrupt or huge file) only fails that photo
+                self.record_failure(db_id, photos_to_convert[db_id], f"{e.__class__.__name__}: {e}")
+                return
+
+            self.save_converted(db_id, text_path_with_suffix)
+            if db_id in fingerprints:
+                ocr_cache.store(fingerprints[db_id], text_path_with_suffix.read_text(), engine_version)
+            converted_files.append(text_path_with_suffix)
+
+        workers = min(self.ocr_workers, len(photos_to_convert))
+        logging.info("Converting %s Photos using %s workers", len(photos_to_convert), workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_ocr_worker,
+            initargs=(self.ocr_engine, self.ocr_timeout_in_secs),
+        ) as executor:
+            pending_ocr = {
+                executor.submit(convert_image, image_file_path, self.preprocess, self.deskew): db_id
+                for db_id, image_file_path in photos_to_convert.items()
+            }
+            try:
+                for future in as_completed(pending_ocr, timeout=max(deadline - time.monotonic(), 0)):
+                    save_result(future)
+            except TimeoutError:
+                left_for_next_run = sum(future.cancel() for future in pending_ocr)
+                logging.warning("OCR time budget used up. Leaving %s photos for the next run", left_for_next_run)
+                # Photos already being converted are allowed to finish
+                for future in as_completed([f for f in pending_ocr if not f.cancelled() and f not in handled]):
+                    save_result(future)
+        return converted_files
+
+    def record_failure(self, db_id: str, image_file_path: Path, error: str):
+        with table_from(self.database_file_path) as db_table:
+            photo = db_table.find_one(id=db_id)
+            attempts = (photo.get("ocr_attempts") or 0) + 1
+            failure = {"id": db_id, "ocr_attempts": attempts, "last_error": error}
+            if attempts >= self.max_ocr_attempts:
+                # Out of the next batches for good, so that failing photos can't hold up the newer ones
+                logging.error(f"Giving up on {image_file_path} after {attempts} attempts: {error}")
+                failure["remote_file_id"] = NOT_CONVERTED
+            else:
+                logging.warning(f"Attempt {attempts} for {image_file_path} failed: {error}")
+            db_table.update(failure, ["id"])
+
+    def save_converted(self, db_id: str, text_path_with_suffix: Path):
+        logging.info(f"Updating database with local id {db_id} -> remote file id: {text_path_with_suffix}")
+        with table_from(self.database_file_path) as db_table:
+            db_table.update({"id": db_id, "remote_file_id": text_path_with_suffix.as_posix()}, ["id"])
+
 
 class SendTextToTelegram(WorkflowBase):
     """
@@ -73,9 +220,13 @@ class SendTextToTelegram(WorkflowBase):
 
     def execute(self):
         logging.info("Sending OCR text for %s Photos", len(self.converted_files))
+        rate_limiter = RateLimiter()
         for converted_text_file_path in self.converted_files:
-            converted_text = converted_text_file_path.read_text()
-            self.send_message_with_retries(converted_text)
+            with open(converted_text_file_path, encoding="utf-8") as converted_text_file:
+                # Long OCR output goes out as several messages, split at paragraphs to stay under Telegram's limit
+                for message in split_into_messages(converted_text_file):
+                    rate_limiter.wait()
+                    self.send_message_with_retries(message)
 
     @retry(telegram.error.TimedOut, tries=3)
     def send_message_with_retries(self, converted_text):
@@ -93,6 +244,46 @@ def workflow():
 def parse_args():
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-d", "--database-file-path", type=Path, required=True, help="Path to database file")
+    parser.add_argument(
+        "-e",
+        "--ocr-engine",
+        choices=["auto", "tesserocr", "cli"],
+        default="auto",
+        help="auto uses the in-process tesserocr engine when installed and falls back to the tesseract cli",
+    )
+    parser.add_argument(
+        "-w", "--ocr-workers", type=int, default=available_cpus(), help="Number of images to convert in parallel"
+    )
+    parser.add_argument(
+        "--ocr-timeout-in-secs", type=int, default=120, help="Give up on an image if OCR takes longer than this"
+    )
+    parser.add_argument(
+        "--preprocess",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Downscale, crop and binarize photos before OCR",
+    )
+    parser.add_argument(
+        "--deskew", action="store_true", default=False, help="Straighten rotated photos while preprocessing"
+    )
+    parser.add_argument(
+        "--ocr-cache-size",
+        type=int,
+        default=5000,
+        help="Number of OCR results to keep for repeated photos (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--ocr-batch-size", type=int, default=50, help="Maximum number of photos (oldest first) to convert per run"
+    )
+    parser.add_argument(
+        "--max-ocr-attempts", type=int, default=3, help="Stop converting a photo after this many failures"
+    )
+    parser.add_argument(
+        "--ocr-time-budget-in-secs",
+        type=int,
+        default=300,
+        help="Stop starting new conversions after this long and leave the rest for the next run",
+    )
     parser.add_argument(
         "-b", "--batch", action="store_true", default=False, help="Run in batch mode (no scheduling, just run once)"
     )
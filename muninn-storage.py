@@ -1,27 +1,41 @@
 #!/usr/bin/env python3
 """
-Copy local files to GDrive remote storage
+Copy local files to remote storage (GDrive by default, S3 compatible or a local directory)
+
+With --bundle-small-files, files below the size threshold are packed into compressed zip bundles
+and each bundle is uploaded as a single object.
+The bundle_manifest table maps a bookmark id to the remote bundle and the member path inside it.
 """
 import logging
-import mimetypes
 import os
+import shutil
+import tempfile
+import zipfile
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 from dotenv import load_dotenv
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
 from py_executable_checklist.workflow import WorkflowBase
 
 from common_utils import GDRIVE_SCOPES, run_in_background, setup_logging, table_from
+from remote_storage import (
+    GDriveStorage,
+    LocalDirectoryStorage,
+    S3Storage,
+    StorageBackend,
+)
 from tele_bookmark_bot import Document, GitHub, WebPage
 
 load_dotenv()
 
 GDRIVE_REMOTE_FOLDER_ID = os.getenv("GDRIVE_REMOTE_FOLDER_ID")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
 
 logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
 
@@ -55,6 +69,42 @@ class RefreshTokenIfExpired(WorkflowBase):
         return {"google_service": google_service}
 
 
+class CreateGDriveStorage(WorkflowBase):
+    """
+    Use GDrive folder as remote storage
+    """
+
+    google_service: Any
+
+    def execute(self) -> dict:
+        return {"storage": GDriveStorage(self.google_service, GDRIVE_REMOTE_FOLDER_ID)}
+
+
+class CreateS3Storage(WorkflowBase):
+    """
+    Use S3 compatible bucket as remote storage
+    """
+
+    s3_bucket: str
+    s3_endpoint_url: str
+
+    def execute(self) -> dict:
+        logging.info("Using S3 bucket %s (endpoint: %s)", self.s3_bucket, self.s3_endpoint_url or "AWS")
+        return {"storage": S3Storage(self.s3_bucket, endpoint_url=self.s3_endpoint_url)}
+
+
+class CreateLocalDirectoryStorage(WorkflowBase):
+    """
+    Use local directory as remote storage
+    """
+
+    local_storage_dir: Path
+
+    def execute(self) -> dict:
+        logging.info("Using local directory %s", self.local_storage_dir)
+        return {"storage": LocalDirectoryStorage(self.local_storage_dir)}
+
+
 class SelectPendingBookmarksToUpload(WorkflowBase):
     """
     Select next batch of files to upload from database
@@ -75,24 +125,77 @@ class SelectPendingBookmarksToUpload(WorkflowBase):
         return {"local_files": local_archived_files}
 
 
+class PackSmallFilesIntoBundles(WorkflowBase):
+    """
+    Pack small files into compressed bundles so that each bundle costs a single upload
+    """
+
+    local_files: Dict[str, Path]
+    bundle_small_files: bool
+    bundle_threshold_kb: int
+    bundle_max_mb: int
+
+    def execute(self) -> dict:
+        if not self.bundle_small_files:
+            return {"bundles": {}}
+
+        threshold_bytes = self.bundle_threshold_kb * 1024
+        small_files = {}
+        large_files = {}
+        for db_id, local_file in self.local_files.items():
+            if local_file.exists() and local_file.stat().st_size < threshold_bytes:
+                small_files[db_id] = local_file
+            else:
+                large_files[db_id] = local_file
+
+        bundles = self.pack(small_files) if small_files else {}
+        logging.info("Packed %s small files into %s bundles", len(small_files), len(bundles))
+        return {"local_files": large_files, "bundles": bundles}
+
+    def pack(self, small_files: Dict[str, Path]) -> Dict[Path, Dict[str, str]]:
+        bundle_dir = Path(tempfile.mkdtemp(prefix="muninn-bundles-"))
+        bundle_prefix = f"bundle-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        max_bundle_bytes = self.bundle_max_mb * 1024 * 1024
+
+        bundles: Dict[Path, Dict[str, str]] = {}
+        bundle, bundle_size = None, 0
+        try:
+            for db_id, local_file in small_files.items():
+                if bundle is None or bundle_size >= max_bundle_bytes:
+                    if bundle:
+                        bundle.close()
+                    bundle_path = bundle_dir / f"{bundle_prefix}-{len(bundles):03d}.zip"
+                    bundle, bundle_size = zipfile.ZipFile(bundle_path, "w", zipfile.ZIP_DEFLATED), 0
+                    bundles[bundle_path] = {}
+
+                member_path = f"{db_id}/{local_file.name}"
+                bundle.write(local_file, arcname=member_path)
+                bundle_size += bundle.getinfo(member_path).compress_size
+                bundles[bundle_path][db_id] = member_path
+        except Exception:
+            shutil.rmtree(bundle_dir, ignore_errors=True)
+            raise
+        finally:
+            if bundle:
+                bundle.close()
+        return bundles
+
+
 class UploadWebPagesToGDrive(WorkflowBase):
     """
-    Upload selected web pages to GDrive
+    Upload selected web pages to remote storage
     """
 
-    google_service: Any
+    storage: StorageBackend
     local_files: Dict[str, Path]
     database_file_path: Path
 
     def execute(self):
-        logging.info("Uploading %s web pages to GDrive", len(self.local_files))
+        logging.info("Uploading %s web pages to %s", len(self.local_files), self.storage.name)
         for db_id, local_file in self.local_files.items():
-            logging.info("Uploading %s to GDrive", local_file)
-            file_metadata = {"name": local_file.stem, "parents": [GDRIVE_REMOTE_FOLDER_ID]}
+            logging.info("Uploading %s to %s", local_file, self.storage.name)
             try:
-                media = MediaFileUpload(local_file.as_posix(), mimetype=mimetypes.guess_type(local_file.as_posix())[0])
-                file = self.google_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
-                uploaded_file_id = file.get("id")
+                uploaded_file_id = self.storage.upload_with_retries(local_file, local_file.stem)
                 print(f"Updating database with local id {db_id} -> remote file id: {uploaded_file_id}")
                 with table_from(self.database_file_path) as db_table:
                     db_table.update({"id": db_id, "remote_file_id": uploaded_file_id}, ["id"])
@@ -101,11 +204,56 @@ class UploadWebPagesToGDrive(WorkflowBase):
                 raise e
 
 
-def workflow():
-    return [
-        ReadTokenFromFile,
-        RefreshTokenIfExpired,
+class UploadBundles(WorkflowBase):
+    """
+    Upload bundles of small files and record where each bookmark ended up.
+    Runs straight after PackSmallFilesIntoBundles so that the bundles are always removed, even when an upload fails
+    """
+
+    storage: StorageBackend
+    bundles: Dict[Path, Dict[str, str]]
+    database_file_path: Path
+
+    def execute(self):
+        if not self.bundles:
+            return
+
+        logging.info("Uploading %s bundles to %s", len(self.bundles), self.storage.name)
+        try:
+            for bundle_path, members in self.bundles.items():
+                uploaded_file_id = self.storage.upload_with_retries(bundle_path, bundle_path.stem)
+                print(f"Updating database with {len(members)} bookmarks -> remote bundle id: {uploaded_file_id}")
+                with table_from(self.database_file_path, "bundle_manifest") as manifest_table:
+                    manifest_table.insert_many(self.manifest_rows(bundle_path, uploaded_file_id, members))
+                with table_from(self.database_file_path) as db_table:
+                    for db_id in members:
+                        db_table.update({"id": db_id, "remote_file_id": uploaded_file_id}, ["id"])
+        finally:
+            shutil.rmtree(next(iter(self.bundles)).parent, ignore_errors=True)
+
+    def manifest_rows(self, bundle_path: Path, uploaded_file_id: str, members: Dict[str, str]) -> List[dict]:
+        return [
+            {
+                "bookmark_id": db_id,
+                "bundle_name": bundle_path.name,
+                "bundle_remote_file_id": uploaded_file_id,
+                "member_path": member_path,
+                "created_at": datetime.now(),
+            }
+            for db_id, member_path in members.items()
+        ]
+
+
+def workflow(storage_backend="gdrive"):
+    storage_steps = {
+        "gdrive": [ReadTokenFromFile, RefreshTokenIfExpired, CreateGDriveStorage],
+        "s3": [CreateS3Storage],
+        "local": [CreateLocalDirectoryStorage],
+    }
+    return storage_steps[storage_backend] + [
         SelectPendingBookmarksToUpload,
+        PackSmallFilesIntoBundles,
+        UploadBundles,
         UploadWebPagesToGDrive,
     ]
 
@@ -114,8 +262,28 @@ def parse_args():
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-d", "--database-file-path", type=Path, required=True, help="Path to database file")
     parser.add_argument(
-        "-t", "--token-file", type=Path, required=True, help="Token file for authenticated GDrive access"
+        "-s",
+        "--storage-backend",
+        choices=["gdrive", "s3", "local"],
+        default="gdrive",
+        help="Remote storage to upload files to",
+    )
+    parser.add_argument("-t", "--token-file", type=Path, help="Token file for authenticated GDrive access")
+    parser.add_argument("--s3-bucket", default=S3_BUCKET, help="Bucket name when using S3 storage")
+    parser.add_argument(
+        "--s3-endpoint-url", default=S3_ENDPOINT_URL, help="Endpoint for S3 compatible storage (eg. local MinIO)"
+    )
+    parser.add_argument("--local-storage-dir", type=Path, help="Target directory when using local storage")
+    parser.add_argument(
+        "--bundle-small-files",
+        action="store_true",
+        default=False,
+        help="Pack small files into compressed bundles and upload each bundle as a single object",
+    )
+    parser.add_argument(
+        "--bundle-threshold-kb", type=int, default=256, help="Files smaller than this are packed into bundles"
     )
+    parser.add_argument("--bundle-max-mb", type=int, default=50, help="Maximum size of a single bundle")
     parser.add_argument(
         "-b", "--batch", action="store_true", default=False, help="Run in batch mode (no scheduling, just run once)"
     )
@@ -127,7 +295,14 @@ def parse_args():
         dest="verbose",
         help="Increase verbosity of logging output. Display context variables between each step run",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.storage_backend == "gdrive" and not args.token_file:
+        parser.error("--token-file is required when using gdrive storage")
+    if args.storage_backend == "s3" and not args.s3_bucket:
+        parser.error("--s3-bucket (or S3_BUCKET environment variable) is required when using s3 storage")
+    if args.storage_backend == "local" and not args.local_storage_dir:
+        parser.error("--local-storage-dir is required when using local storage")
+    return args
 
 
 if __name__ == "__main__":
@@ -135,4 +310,4 @@ if __name__ == "__main__":
     args = parse_args()
     setup_logging(args.verbose)
     context = args.__dict__
-    run_in_background(context, workflow())
+    run_in_background(context, workflow(args.storage_backend))
@@ -1,29 +1,92 @@
 #!/usr/bin/env python3
 """
 Download web page using puppeteer and save it to local file system
+
+Pages are archived as PDF, gzipped MHTML/HTML or readable markdown (see web_archive.py).
+The format comes from the bookmark's archive_format, then --archive-format-for DOMAIN=FORMAT,
+and is otherwise picked from the content of the page
+
+Failed pages are retried with exponential backoff (render_attempts/next_attempt_at columns).
+After --max-render-attempts failures a bookmark is moved to the dead_letter download_state.
+List those with --list-dead-letters
+
+Downloads run concurrently through PoliteScheduler: a global limit, plus a limit and a minimum delay
+per domain so that a batch of bookmarks from one site doesn't hammer it
 """
+import asyncio
 import logging
+import sys
+import time
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Type, Union
+from typing import Dict, List, Optional, Type
+from urllib.parse import urlparse
 
 from dotenv import load_dotenv
-from py_executable_checklist.workflow import WorkflowBase, run_command
+from py_executable_checklist.workflow import WorkflowBase
 from slug import slug
 
-from common_utils import (
-    fetch_html_page,
-    html_parser_from,
-    run_in_background,
-    setup_logging,
-    table_from,
-)
+from common_utils import run_in_background, setup_logging, table_from, url_hash
 from tele_bookmark_bot import WebPage
+from web_archive import (
+    ARCHIVE_FORMATS,
+    AUTO,
+    FILE_EXTENSIONS,
+    ReadablePage,
+    configured_format_for,
+    fetch_readable_page,
+    parse_domain_formats,
+)
+from webpage_to_pdf import (
+    RENDER_BUDGET_IN_SECS,
+    RenderService,
+    add_request_interception_args,
+    request_interception_from,
+)
 
 load_dotenv()
 
 OUTPUT_DIR = Path.home().joinpath("OutputDir", "tele-bookmarks", "web-to-pdf")
 
+DEAD_LETTER = "dead_letter"
+
+
+class ArchiveFailed(Exception):
+    pass
+
+
+class PoliteScheduler:
+    """
+    Limits concurrent downloads overall and per domain,
+    and spaces out the start of downloads from the same domain by at least domain_delay_in_secs
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_per_domain: int = 2, domain_delay_in_secs: float = 2):
+        self.global_slots = asyncio.Semaphore(max_concurrent)
+        self.domain_slots: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(max_per_domain))
+        self.domain_delay_in_secs = domain_delay_in_secs
+        self.next_start_at: Dict[str, float] = {}
+
+    async def wait_for_turn(self, domain: str):
+        # Reserve a start time before sleeping so that waiting downloads queue up behind each other
+        now = time.monotonic()
+        start_at = max(now, self.next_start_at.get(domain, now))
+        self.next_start_at[domain] = start_at + self.domain_delay_in_secs
+        await asyncio.sleep(start_at - now)
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        domain = (urlparse(url).hostname or "").lower()
+        # Wait for the domain first so that global slots aren't held by downloads queued behind a busy domain.
+        # The start time is only reserved once a global slot is free, otherwise queued downloads start together
+        async with self.domain_slots[domain]:
+            async with self.global_slots:
+                await self.wait_for_turn(domain)
+                yield
+
 
 class SelectPendingBookmarksToDownload(WorkflowBase):
     """
@@ -35,10 +98,16 @@ class SelectPendingBookmarksToDownload(WorkflowBase):
     def execute(self) -> dict:
         with table_from(self.database_file_path) as db_table:
             logging.info("Selecting next batch of files to download from %s table", db_table.name)
-            web_pages = db_table.find(source=WebPage.__name__, content=None)
+            now = datetime.now()
+            web_pages = [
+                web_page
+                for web_page in db_table.find(source=WebPage.__name__, content=None)
+                if not web_page.get("next_attempt_at") or web_page["next_attempt_at"] <= now
+            ]
             bookmarked_urls = {web_page["id"]: web_page["note"] for web_page in web_pages}
+            bookmark_formats = {web_page["id"]: web_page.get("archive_format") for web_page in web_pages}
 
-        return {"bookmarked_urls": bookmarked_urls}
+        return {"bookmarked_urls": bookmarked_urls, "bookmark_formats": bookmark_formats}
 
 
 class DownloadWebPages(WorkflowBase):
@@ -47,39 +116,155 @@ class DownloadWebPages(WorkflowBase):
     """
 
     bookmarked_urls: Dict[str, str]
+    bookmark_formats: Dict[str, Optional[str]]
+    archive_format_for: List[str]
+    max_concurrent_downloads: int
+    max_downloads_per_domain: int
+    domain_delay_in_secs: float
+    download_timeout_in_secs: int
+    hard_render_timeout_in_secs: Optional[int]
+    max_render_attempts: int
+    retry_backoff_in_secs: int
     database_file_path: Path
+    render_tabs: int
+    restart_browser_after: int
+    render_budget_in_secs: int
+    block_requests: bool
+    blocklist_file: Path
+    asset_cache_dir: Path
+    no_asset_cache: bool
+
+    def existing_download(self, web_page_url: str) -> Optional[Path]:
+        # Files are named {title}-{url hash}.{extension} so the title isn't needed to find an earlier download
+        return next(OUTPUT_DIR.glob(f"*-{url_hash(web_page_url)}.*"), None)
+
+    async def handle_web_page(
+        self, render_service: RenderService, web_page_url: str, bookmark_format: Optional[str] = None
+    ) -> Path:
+        existing_file = self.existing_download(web_page_url)
+        if existing_file:
+            logging.info("File %s already exists, skipping", existing_file)
+            return existing_file
+
+        archive_format = configured_format_for(web_page_url, bookmark_format, self.domain_formats)
+        # Only an explicit markdown format skips the browser. In auto mode the browser picks the format
+        if archive_format == "markdown":
+            _, readable = await asyncio.wait_for(
+                asyncio.to_thread(fetch_readable_page, web_page_url), timeout=self.download_timeout_in_secs
+            )
+            if readable:
+                return self.save_markdown(web_page_url, readable)
+            logging.info("Unable to extract readable text from %s. Archiving as PDF", web_page_url)
+            archive_format = "pdf"
+
+        return await self.render_web_page(render_service, web_page_url, archive_format)
+
+    async def render_web_page(self, render_service: RenderService, web_page_url: str, archive_format: str) -> Path:
+        # Pages that aren't article-like are captured as PDF in auto mode
+        extension = FILE_EXTENSIONS["pdf" if archive_format == AUTO else archive_format]
+        rendering_file = OUTPUT_DIR / f".{url_hash(web_page_url)}.rendering{extension}"
+        # The timeout starts once the page has a tab, time spent waiting for one doesn't use it up
+        result = await render_service.render(
+            web_page_url, rendering_file, self.render_budget_in_secs, archive_format, self.download_timeout_in_secs
+        )
+        if not result:
+            rendering_file.unlink(missing_ok=True)
+            raise ArchiveFailed(f"Failed to archive as {result.archive_format}: {result.failure}")
+        if result.readable:
+            return self.save_markdown(web_page_url, result.readable)
 
-    def handle_web_page(self, web_page_url: str) -> Union[Path, str]:
-        page_html = fetch_html_page(web_page_url)
-        bs = html_parser_from(page_html)
-        web_page_title = slug(bs.title.string if bs.title and bs.title.string else web_page_url)
-        target_file = OUTPUT_DIR / f"{web_page_title}.pdf"
-        if target_file.exists():
-            logging.info("File %s already exists, skipping", target_file)
-            return target_file
-
-        cmd = f'./webpage_to_pdf.py -i "{web_page_url}" -o "{target_file}" --headless'
-        run_command(cmd)
-        if target_file.exists():
-            return target_file
-        else:
-            logging.error("Failed to generate PDF for %s", web_page_url)
-            return "Not downloaded"
-
-    def content_from(self, downloaded_file_path_or_error: Union[Path, str]) -> str:
-        if isinstance(downloaded_file_path_or_error, Path):
-            return downloaded_file_path_or_error.as_posix()
-        else:
-            return downloaded_file_path_or_error
+        return self.store_download(web_page_url, result.title, result.canonical_url, rendering_file, extension)
+
+    def save_markdown(self, web_page_url: str, readable: ReadablePage) -> Path:
+        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        extension = FILE_EXTENSIONS["markdown"]
+        writing_file = OUTPUT_DIR / f".{url_hash(web_page_url)}.rendering{extension}"
+        writing_file.write_text(readable.markdown, encoding="utf-8")
+        return self.store_download(web_page_url, readable.title, readable.canonical_url, writing_file, extension)
+
+    def store_download(self, web_page_url: str, title: str, canonical_url: str, temp_file: Path, extension: str):
+        # Another bookmark may have pointed at the same article through a different url
+        existing_file = self.existing_download(canonical_url)
+        if existing_file:
+            logging.info("%s is a copy of %s, keeping the earlier download", web_page_url, existing_file)
+            temp_file.unlink(missing_ok=True)
+            return existing_file
+
+        web_page_title = slug(title or web_page_url)[:100]
+        target_file = OUTPUT_DIR / f"{web_page_title}-{url_hash(canonical_url)}{extension}"
+        temp_file.rename(target_file)
+        return target_file
+
+    async def download(self, scheduler: PoliteScheduler, render_service: RenderService, db_id: str, webpage_url: str):
+        try:
+            async with scheduler.slot(webpage_url):
+                logging.info(f"Downloading {webpage_url}")
+                downloaded_file_path = await self.handle_web_page(
+                    render_service, webpage_url, self.bookmark_formats.get(db_id)
+                )
+        except asyncio.TimeoutError:
+            self.record_failure(db_id, webpage_url, f"Timed out after {self.download_timeout_in_secs}s")
+            return
+        except ArchiveFailed as e:
+            self.record_failure(db_id, webpage_url, str(e))
+            return
+        except Exception as e:
+            logging.exception(f"Error while downloading {webpage_url}")
+            self.record_failure(db_id, webpage_url, f"{e.__class__.__name__}: {e}")
+            return
+        logging.info(f"Updating database with local id {db_id} -> download file: {downloaded_file_path}")
+        with table_from(self.database_file_path) as db_table:
+            db_table.update(
+                {
+                    "id": str(db_id),
+                    "content": downloaded_file_path.as_posix(),
+                    "download_state": "downloaded",
+                    "last_error": None,
+                },
+                ["id"],
+            )
+
+    def record_failure(self, db_id: str, webpage_url: str, error: str):
+        with table_from(self.database_file_path) as db_table:
+            bookmark = db_table.find_one(id=db_id)
+            attempts = (bookmark.get("render_attempts") or 0) + 1
+            failure = {"id": str(db_id), "render_attempts": attempts, "last_error": error}
+            if attempts >= self.max_render_attempts:
+                logging.error(f"Giving up on {webpage_url} after {attempts} attempts: {error}")
+                failure.update({"content": "Not downloaded", "download_state": DEAD_LETTER, "next_attempt_at": None})
+            else:
+                retry_in = timedelta(seconds=self.retry_backoff_in_secs * 2 ** (attempts - 1))
+                logging.warning(f"Attempt {attempts} for {webpage_url} failed: {error}. Retrying in {retry_in}")
+                failure.update({"download_state": "retrying", "next_attempt_at": datetime.now() + retry_in})
+            db_table.update(failure, ["id"])
+
+    async def download_all(self):
+        blocklist, asset_cache = request_interception_from(
+            self.block_requests, self.blocklist_file, self.asset_cache_dir, self.no_asset_cache
+        )
+        async with RenderService(
+            tabs=self.render_tabs,
+            restart_after=self.restart_browser_after,
+            blocklist=blocklist,
+            asset_cache=asset_cache,
+            hard_timeout_in_secs=self.hard_render_timeout_in_secs,
+        ) as render_service:
+            scheduler = PoliteScheduler(
+                self.max_concurrent_downloads, self.max_downloads_per_domain, self.domain_delay_in_secs
+            )
+            await asyncio.gather(
+                *(
+                    self.download(scheduler, render_service, db_id, webpage_url)
+                    for db_id, webpage_url in self.bookmarked_urls.items()
+                )
+            )
+        logging.info("Requests across all pages: %s", dict(render_service.request_counts))
 
     def execute(self):
+        self.domain_formats = parse_domain_formats(self.archive_format_for)
         logging.info("Downloading [%s] web pages", len(self.bookmarked_urls))
-        for db_id, webpage_url in self.bookmarked_urls.items():
-            logging.info(f"Downloading {webpage_url}")
-            downloaded_file_path_or_error = self.handle_web_page(webpage_url)
-            logging.info(f"Updating database with local id {db_id} -> download file: {downloaded_file_path_or_error}")
-            with table_from(self.database_file_path) as db_table:
-                db_table.update({"id": str(db_id), "content": self.content_from(downloaded_file_path_or_error)}, ["id"])
+        if self.bookmarked_urls:
+            asyncio.run(self.download_all())
 
 
 def workflow() -> List[Type[WorkflowBase]]:
@@ -89,9 +274,71 @@ def workflow() -> List[Type[WorkflowBase]]:
     ]
 
 
+def list_dead_letters(database_file_path: Path):
+    with table_from(database_file_path) as db_table:
+        dead_letters = list(db_table.find(download_state=DEAD_LETTER, order_by="id"))
+    for bookmark in dead_letters:
+        print(f"{bookmark['id']}\t{bookmark['note']}\t{bookmark.get('render_attempts')}\t{bookmark.get('last_error')}")
+    print(f"{len(dead_letters)} web pages in dead letter state")
+
+
 def parse_args():
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-d", "--database-file-path", type=Path, required=True, help="Path to database file")
+    parser.add_argument(
+        "--render-tabs", type=int, default=4, help="Number of pages to render concurrently in the shared browser"
+    )
+    parser.add_argument(
+        "--restart-browser-after", type=int, default=50, help="Relaunch the browser after this many pages"
+    )
+    parser.add_argument(
+        "--render-budget-in-secs",
+        type=int,
+        default=RENDER_BUDGET_IN_SECS,
+        help="Maximum time (in secs) to wait for a page to be ready before capturing it",
+    )
+    parser.add_argument("--max-concurrent-downloads", type=int, default=8, help="Pages downloaded at the same time")
+    parser.add_argument(
+        "--max-downloads-per-domain", type=int, default=2, help="Pages downloaded at the same time from one domain"
+    )
+    parser.add_argument(
+        "--domain-delay-in-secs",
+        type=float,
+        default=2,
+        help="Minimum time between starting downloads from the same domain",
+    )
+    parser.add_argument(
+        "--download-timeout-in-secs",
+        type=int,
+        default=180,
+        help="Give up on a page after this long once it has a browser tab. It is tried again on the next run",
+    )
+    parser.add_argument(
+        "--hard-render-timeout-in-secs",
+        type=int,
+        default=None,
+        help="Kill and restart the browser when a render takes longer. Defaults to twice the render budget + 30",
+    )
+    parser.add_argument(
+        "--max-render-attempts", type=int, default=5, help="Move a page to dead letter after this many failures"
+    )
+    parser.add_argument(
+        "--retry-backoff-in-secs",
+        type=int,
+        default=600,
+        help="Wait before the first retry of a failed page. Doubles after every failure",
+    )
+    parser.add_argument(
+        "--list-dead-letters", action="store_true", default=False, help="List pages that failed too many times"
+    )
+    add_request_interception_args(parser)
+    parser.add_argument(
+        "--archive-format-for",
+        action="append",
+        default=[],
+        metavar="DOMAIN=FORMAT",
+        help=f"Archive format for a domain and its subdomains. One of {', '.join(ARCHIVE_FORMATS)}. Can be repeated",
+    )
     parser.add_argument(
         "-b", "--batch", action="store_true", default=False, help="Run in batch mode (no scheduling, just run once)"
     )
@@ -103,12 +350,20 @@ def parse_args():
         dest="verbose",
         help="Increase verbosity of logging output. Display context variables between each step run",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    try:
+        parse_domain_formats(args.archive_format_for)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 
 if __name__ == "__main__":
     print("Running Muninn-WebPage-Downloader")
     args = parse_args()
     setup_logging(args.verbose)
+    if args.list_dead_letters:
+        list_dead_letters(args.database_file_path)
+        sys.exit(0)
     context = args.__dict__
     run_in_background(context, workflow())
@@ -0,0 +1,132 @@
+"""
+Cache of OCR results shared across photo bookmarks
+
+Photos are looked up by the SHA-256 of their content first and then by a perceptual (difference) hash,
+which catches copies of the same screenshot that Telegram re-encoded on the way.
+Entries are kept in the ocr_cache table of the bookmarks database and evicted least recently used first.
+Only entries made by the same engine version with the same preprocessing settings are used.
+"""
+import hashlib
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from common_utils import table_from
+
+OCR_CACHE_TABLE = "ocr_cache"
+
+
+def content_hash(image_file_path: Path) -> str:
+    return hashlib.sha256(image_file_path.read_bytes()).hexdigest()
+
+
+def perceptual_hash(image_file_path: Path, hash_size: int = 16) -> str:
+    """Difference hash: compares the brightness of neighbouring pixels on a small grayscale thumbnail"""
+    with Image.open(image_file_path) as image:
+        thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+def hamming_distance(first_hash: str, second_hash: str) -> int:
+    return (int(first_hash, 16) ^ int(second_hash, 16)).bit_count()
+
+
+def ocr_settings(preprocess: bool, deskew: bool) -> str:
+    return f"preprocess={preprocess},deskew={deskew}"
+
+
+class OcrCache:
+    """
+    engine_version and settings (see ocr_settings) are part of the key. Entries made before switching engine or
+    settings are never served again and get evicted as the least recently used
+    """
+
+    def __init__(
+        self,
+        database_file_path: Path,
+        engine_version: str,
+        settings: str,
+        max_entries: int = 5000,
+        max_distance: int = 6,
+    ):
+        self.database_file_path = database_file_path
+        self.engine_version = engine_version
+        self.settings = settings
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        with table_from(self.database_file_path, OCR_CACHE_TABLE) as cache_table:
+            # Perceptual hashes are compared by distance so keep them in memory rather than querying every row
+            self.perceptual_hashes: Dict[int, str] = {
+                row["id"]: row["perceptual_hash"]
+                for row in cache_table.find(**self.key())
+                if row.get("perceptual_hash")
+            }
+
+    def key(self) -> dict:
+        return {"engine_version": self.engine_version, "ocr_settings": self.settings}
+
+    def fingerprint(self, image_file_path: Path) -> Tuple[str, str]:
+        return content_hash(image_file_path), perceptual_hash(image_file_path)
+
+    def lookup(self, fingerprint: Tuple[str, str]) -> Optional[str]:
+        exact_hash, image_hash = fingerprint
+        with table_from(self.database_file_path, OCR_CACHE_TABLE) as cache_table:
+            cached = cache_table.find_one(content_hash=exact_hash, **self.key()) or self.find_similar(
+                cache_table, image_hash
+            )
+            if not cached:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            cache_table.update({"id": cached["id"], "last_used_at": datetime.now()}, ["id"])
+            return cached["text"]
+
+    def find_similar(self, cache_table, image_hash: str) -> Optional[dict]:
+        distances = {
+            row_id: hamming_distance(image_hash, cached_hash) for row_id, cached_hash in self.perceptual_hashes.items()
+        }
+        closest = min(distances, key=distances.get, default=None)
+        if closest is None or distances[closest] > self.max_distance:
+            return None
+        logging.debug("Found similar image in OCR cache (distance: %s)", distances[closest])
+        return cache_table.find_one(id=closest)
+
+    def store(self, fingerprint: Tuple[str, str], text: str, engine_version: str):
+        exact_hash, image_hash = fingerprint
+        with table_from(self.database_file_path, OCR_CACHE_TABLE) as cache_table:
+            row_id = cache_table.insert(
+                {
+                    "content_hash": exact_hash,
+                    "perceptual_hash": image_hash,
+                    "text": text,
+                    "engine_version": engine_version,
+                    "ocr_settings": self.settings,
+                    "created_at": datetime.now(),
+                    "last_used_at": datetime.now(),
+                }
+            )
+        if engine_version == self.engine_version:
+            self.perceptual_hashes[row_id] = image_hash
+
+    def evict(self):
+        with table_from(self.database_file_path, OCR_CACHE_TABLE) as cache_table:
+            excess = cache_table.count() - self.max_entries
+            if excess <= 0:
+                return
+            logging.info("Evicting %s least recently used entries from OCR cache", excess)
+            for row in list(cache_table.find(order_by="last_used_at", _limit=excess)):
+                cache_table.delete(id=row["id"])
+                self.perceptual_hashes.pop(row["id"], None)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,99 @@
+"""
+OCR engines shared by muninn-photo-ocr and tele_bookmark_bot
+
+TesserocrEngine  -> Keeps the tesseract model loaded in-process (tesserocr C API bindings),
+                    so each image only pays for recognition
+TesseractCliEngine -> Spawns the tesseract binary for every image. Used when tesserocr isn't installed
+"""
+import logging
+import subprocess
+from pathlib import Path
+
+
+class OcrEngine:
+    name = "base"
+
+    def image_to_text(self, image_file_path: Path) -> str:
+        raise NotImplementedError
+
+    @property
+    def version(self) -> str:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TesseractCliEngine(OcrEngine):
+    name = "tesseract-cli"
+
+    def __init__(self, language: str = "eng", timeout_in_secs: int = 120):
+        self.language = language
+        self.timeout_in_secs = timeout_in_secs
+        self._version = None
+
+    def image_to_text(self, image_file_path: Path) -> str:
+        tesseract_command = ["tesseract", image_file_path.as_posix(), "stdout", "--oem", "1", "-l", self.language]
+        completed = subprocess.run(
+            tesseract_command, check=True, capture_output=True, text=True, timeout=self.timeout_in_secs
+        )
+        return completed.stdout
+
+    @property
+    def version(self) -> str:
+        if not self._version:
+            completed = subprocess.run(["tesseract", "--version"], check=True, capture_output=True, text=True)
+            self._version = f"{self.name}-{completed.stdout.splitlines()[0].split()[-1]}"
+        return self._version
+
+
+class TesserocrEngine(OcrEngine):
+    name = "tesserocr"
+
+    def __init__(self, language: str = "eng", timeout_in_secs: int = 120):
+        import tesserocr
+
+        self.tesserocr = tesserocr
+        self.timeout_in_secs = timeout_in_secs
+        self.api = tesserocr.PyTessBaseAPI(lang=language, oem=tesserocr.OEM.LSTM_ONLY)
+
+    def image_to_text(self, image_file_path: Path) -> str:
+        self.api.SetImageFile(image_file_path.as_posix())
+        # Tesseract stops recognising once the timeout (in ms) runs out and returns False
+        if not self.api.Recognize(self.timeout_in_secs * 1000):
+            raise RuntimeError(f"OCR of {image_file_path} didn't finish within {self.timeout_in_secs}s")
+        return self.api.GetUTF8Text()
+
+    @property
+    def version(self) -> str:
+        return f"{self.name}-{self.tesserocr.tesseract_version().split()[1]}"
+
+    def close(self):
+        self.api.End()
+
+
+def create_ocr_engine(engine_name: str = "auto", language: str = "eng", timeout_in_secs: int = 120) -> OcrEngine:
+    """engine_name is one of auto, tesserocr or cli. auto picks the in-process engine when available"""
+    if engine_name in ("auto", TesserocrEngine.name):
+        try:
+            return TesserocrEngine(language, timeout_in_secs)
+        except ImportError:
+            if engine_name != "auto":
+                raise
+            logging.info("tesserocr is not installed. Falling back to tesseract cli")
+
+    return TesseractCliEngine(language, timeout_in_secs)
+
+
+def ocr_engine_version(engine_name: str = "auto") -> str:
+    """Version of the engine that create_ocr_engine picks, without loading a model"""
+    if engine_name in ("auto", TesserocrEngine.name):
+        try:
+            import tesserocr
+
+            return f"{TesserocrEngine.name}-{tesserocr.tesseract_version().split()[1]}"
+        except ImportError:
+            if engine_name != "auto":
+                raise
+
+    return TesseractCliEngine().version
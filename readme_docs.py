@@ -39,6 +39,14 @@ def main(args):
         "webpage_to_pdf.py",
         "bot_template.py",
         "google-token.py",
+        "remote_storage.py",
+        "ocr_engine.py",
+        "image_preprocess.py",
+        "ocr_cache.py",
+        "request_interceptor.py",
+        "web_archive.py",
+        "github_api.py",
+        "code_outline.py",
     ]
     py_scripts_with_help = []
     # Grab all the python scripts in the current directory and collect output from running the help command
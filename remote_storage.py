@@ -0,0 +1,149 @@
+"""
+Remote storage backends used by muninn-storage to archive local files
+
+GDriveStorage    -> Google Drive folder (production)
+S3Storage        -> Any S3 compatible object store (AWS, MinIO, ...)
+LocalDirectoryStorage -> Plain directory on disk. No credentials required so it can be used
+                         to benchmark upload throughput and retry behaviour offline
+"""
+import logging
+import mimetypes
+import random
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Optional, Tuple, Type
+
+from common_utils import retry
+
+
+class TransientStorageError(Exception):
+    """Raised by a backend for failures that are worth retrying"""
+
+
+# Rate limits, timeouts and server errors. Anything else (401, 403, 404, ...) fails the same way on every attempt
+TRANSIENT_S3_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout"}
+GDRIVE_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def is_transient_status(status: int) -> bool:
+    return status in (408, 429) or status >= 500
+
+
+class StorageBackend:
+    name = "base"
+    retryable_errors: Tuple[Type[Exception], ...] = (TransientStorageError,)
+
+    def __init__(self, max_attempts: int = 3, retry_delay_in_secs: float = 3):
+        self.max_attempts = max_attempts
+        self.retry_delay_in_secs = retry_delay_in_secs
+
+    def upload(self, local_file: Path, remote_name: str) -> str:
+        """Upload local file and return the identifier of the remote object"""
+        raise NotImplementedError
+
+    def upload_with_retries(self, local_file: Path, remote_name: str) -> str:
+        uploader = retry(self.retryable_errors, tries=self.max_attempts, delay=self.retry_delay_in_secs)(self.upload)
+        return uploader(local_file, remote_name)
+
+
+class GDriveStorage(StorageBackend):
+    name = "gdrive"
+
+    def __init__(self, google_service: Any, folder_id: Optional[str], **kwargs):
+        super().__init__(**kwargs)
+        self.google_service = google_service
+        self.folder_id = folder_id
+        self.retryable_errors = (TransientStorageError, TimeoutError, ConnectionError)
+
+    def upload(self, local_file: Path, remote_name: str) -> str:
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
+        file_metadata = {"name": remote_name, "parents": [self.folder_id]}
+        media = MediaFileUpload(local_file.as_posix(), mimetype=mimetypes.guess_type(local_file.as_posix())[0])
+        try:
+            file = self.google_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+        except HttpError as e:
+            if is_transient_status(e.resp.status) or self.is_rate_limited(e):
+                raise TransientStorageError(f"Unable to upload {local_file}: {e}") from e
+            raise
+        return file.get("id")
+
+    @staticmethod
+    def is_rate_limited(error) -> bool:
+        """Drive reports rate limits as 403 with a rateLimitExceeded/userRateLimitExceeded reason"""
+        details = error.error_details if isinstance(error.error_details, list) else []
+        return any(isinstance(detail, dict) and detail.get("reason") in GDRIVE_RATE_LIMIT_REASONS for detail in details)
+
+
+class S3Storage(StorageBackend):
+    name = "s3"
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, prefix: str = "tele-bookmarks", **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import boto3
+            from botocore.exceptions import ConnectionError as BotoConnectionError
+            from botocore.exceptions import HTTPClientError
+        except ImportError:
+            raise Exception("S3 storage requires boto3. Install it with `uv sync --group optional`")
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # endpoint_url allows pointing at a local MinIO (or any S3 compatible) server
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        # Connection errors and timeouts. Missing credentials, bad parameters, ... are BotoCoreErrors that aren't retried
+        self.retryable_errors = (TransientStorageError, BotoConnectionError, HTTPClientError)
+
+    def upload(self, local_file: Path, remote_name: str) -> str:
+        from boto3.exceptions import S3UploadFailedError
+        from botocore.exceptions import ClientError
+
+        key = f"{self.prefix}/{remote_name}{local_file.suffix}" if self.prefix else f"{remote_name}{local_file.suffix}"
+        content_type = mimetypes.guess_type(local_file.as_posix())[0] or "application/octet-stream"
+        try:
+            self.client.upload_file(local_file.as_posix(), self.bucket, key, ExtraArgs={"ContentType": content_type})
+        except (ClientError, S3UploadFailedError) as e:
+            # upload_file raises S3UploadFailedError while handling the ClientError of the failed request
+            client_error = e if isinstance(e, ClientError) else e.__cause__ or e.__context__
+            if isinstance(client_error, ClientError) and self.is_transient(client_error):
+                raise TransientStorageError(f"Unable to upload {local_file}: {e}") from e
+            raise
+        return f"s3://{self.bucket}/{key}"
+
+    @staticmethod
+    def is_transient(error) -> bool:
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return is_transient_status(status) or error.response.get("Error", {}).get("Code") in TRANSIENT_S3_ERROR_CODES
+
+
+class LocalDirectoryStorage(StorageBackend):
+    """
+    Copies files into a local directory.
+    latency_in_secs and failure_rate simulate a remote API so that throughput and retries can be benchmarked
+    """
+
+    name = "local"
+
+    def __init__(self, target_dir: Path, latency_in_secs: float = 0, failure_rate: float = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.target_dir = target_dir
+        self.target_dir.mkdir(parents=True, exist_ok=True)
+        self.latency_in_secs = latency_in_secs
+        self.failure_rate = failure_rate
+        self.attempts = 0
+        self.failures = 0
+
+    def upload(self, local_file: Path, remote_name: str) -> str:
+        self.attempts += 1
+        if self.latency_in_secs:
+            time.sleep(self.latency_in_secs)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures += 1
+            raise TransientStorageError(f"Simulated failure while uploading {local_file}")
+
+        target_file = self.target_dir / f"{remote_name}{local_file.suffix}"
+        shutil.copyfile(local_file, target_file)
+        logging.debug("Copied %s -> %s", local_file, target_file)
+        return target_file.as_posix()
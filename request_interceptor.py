@@ -0,0 +1,208 @@
+"""
+Request interception for pages rendered by webpage_to_pdf
+
+Blocklist          -> Resource types and domains (render_blocklist.txt) that are never fetched
+AssetCache         -> Scripts and stylesheets kept on disk so that repeat renders don't fetch them again.
+                      Chromium disables its own HTTP cache while requests are intercepted.
+                      Expired entries and the least recently used ones over the size cap are removed on start
+RequestInterceptor -> Attached to a page before it is opened. Applies both of the above and counts requests
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+DEFAULT_BLOCKLIST_FILE = Path(__file__).parent / "render_blocklist.txt"
+DEFAULT_ASSET_CACHE_DIR = Path.home().joinpath("OutputDir", "tele-bookmarks", "render-asset-cache")
+
+# Web fonts, audio/video and analytics beacons don't change the text of an archived page
+BLOCKED_RESOURCE_TYPES = {"font", "media", "ping", "eventsource", "websocket", "manifest"}
+CACHEABLE_RESOURCE_TYPES = {"script", "stylesheet"}
+# Module scripts and crossorigin assets are fetched in CORS mode and fail to load without these
+REPLAYED_HEADERS = (
+    "content-type",
+    "access-control-allow-origin",
+    "access-control-allow-credentials",
+    "timing-allow-origin",
+    "cross-origin-resource-policy",
+)
+
+
+class Blocklist:
+    def __init__(self, domains: Iterable[str], resource_types: Iterable[str] = BLOCKED_RESOURCE_TYPES):
+        self.domains: Set[str] = {domain.lower().lstrip(".") for domain in domains}
+        self.resource_types: Set[str] = set(resource_types)
+
+    @classmethod
+    def from_file(cls, blocklist_file: Path = DEFAULT_BLOCKLIST_FILE, **kwargs) -> "Blocklist":
+        lines = (line.split("#", 1)[0].strip() for line in blocklist_file.read_text().splitlines())
+        return cls([line for line in lines if line], **kwargs)
+
+    def is_blocked_domain(self, hostname: str) -> bool:
+        # Matches the domain itself and all of its subdomains
+        parts = hostname.lower().split(".")
+        return any(".".join(parts[i:]) in self.domains for i in range(len(parts)))
+
+    def blocks(self, resource_type: str, url: str) -> bool:
+        if resource_type in self.resource_types:
+            return True
+        return self.is_blocked_domain(urlparse(url).hostname or "")
+
+
+class AssetCache:
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_ASSET_CACHE_DIR,
+        max_asset_kb: int = 2048,
+        default_max_age_in_secs: int = 24 * 60 * 60,
+        max_cache_mb: int = 200,
+    ):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_asset_bytes = max_asset_kb * 1024
+        self.default_max_age_in_secs = default_max_age_in_secs
+        self.max_cache_bytes = max_cache_mb * 1024 * 1024
+        self.evict()
+
+    def paths_for(self, url: str) -> Tuple[Path, Path]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{key}.body", self.cache_dir / f"{key}.json"
+
+    def get(self, url: str) -> Optional[Tuple[Dict[str, str], bytes]]:
+        body_file, metadata_file = self.paths_for(url)
+        if not metadata_file.exists():
+            return None
+        try:
+            metadata = json.loads(metadata_file.read_text())
+            if metadata["expires_at"] < time.time():
+                self.remove(metadata_file)
+                return None
+            body = body_file.read_bytes()
+            # The modification time orders entries for eviction, least recently used first
+            metadata_file.touch()
+            return metadata["headers"], body
+        except (OSError, ValueError, KeyError):
+            logging.debug("Ignoring unreadable cache entry for %s", url, exc_info=True)
+            return None
+
+    def max_age_of(self, cache_control: str) -> Optional[int]:
+        """Seconds that a response can be reused for, or None if it shouldn't be cached"""
+        if "no-store" in cache_control or "private" in cache_control:
+            return None
+        max_age = re.search(r"max-age=(\d+)", cache_control)
+        return int(max_age.group(1)) if max_age else self.default_max_age_in_secs
+
+    def put(self, url: str, headers: Dict[str, str], body: bytes):
+        max_age = self.max_age_of(headers.get("cache-control", "").lower())
+        # A response that varies by Origin can't be replayed to pages from another origin
+        varies_by_origin = re.search(r"\borigin\b|\*", headers.get("vary", "").lower())
+        if not max_age or varies_by_origin or len(body) > self.max_asset_bytes:
+            return
+        body_file, metadata_file = self.paths_for(url)
+        body_file.write_bytes(body)
+        replayed_headers = {name: headers[name] for name in REPLAYED_HEADERS if name in headers}
+        replayed_headers.setdefault("content-type", "application/octet-stream")
+        metadata = {"url": url, "headers": replayed_headers, "expires_at": time.time() + max_age}
+        metadata_file.write_text(json.dumps(metadata))
+
+    def remove(self, metadata_file: Path):
+        metadata_file.with_suffix(".body").unlink(missing_ok=True)
+        metadata_file.unlink(missing_ok=True)
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones until the cache is under max_cache_bytes"""
+        now = time.time()
+        entries = []
+        for metadata_file in self.cache_dir.glob("*.json"):
+            try:
+                expires_at = json.loads(metadata_file.read_text())["expires_at"]
+                size = metadata_file.with_suffix(".body").stat().st_size
+                used_at = metadata_file.stat().st_mtime
+            except (OSError, ValueError, KeyError):
+                expires_at = 0
+            if expires_at < now:
+                self.remove(metadata_file)
+            else:
+                entries.append((used_at, size, metadata_file))
+        # Bodies left without metadata by a render that stopped while storing them
+        for body_file in self.cache_dir.glob("*.body"):
+            if not body_file.with_suffix(".json").exists():
+                body_file.unlink(missing_ok=True)
+
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, metadata_file in sorted(entries):
+            if cache_size <= self.max_cache_bytes:
+                break
+            self.remove(metadata_file)
+            cache_size -= size
+
+
+class RequestInterceptor:
+    def __init__(self, blocklist: Optional[Blocklist] = None, asset_cache: Optional[AssetCache] = None):
+        self.blocklist = blocklist
+        self.asset_cache = asset_cache
+        self.served_from_cache: Set[str] = set()
+        self.main_frame = None
+        self.stats = {"allowed": 0, "blocked": 0, "from_cache": 0, "bytes_fetched": 0}
+
+    async def attach(self, page):
+        self.main_frame = page.mainFrame
+        await page.setRequestInterception(True)
+        # pyppeteer calls event handlers synchronously, so the async work is scheduled on the loop
+        page.on("request", lambda request: asyncio.ensure_future(self.on_request(request)))
+        if self.asset_cache:
+            page.on("response", lambda response: asyncio.ensure_future(self.on_response(response)))
+        page._client.on("Network.loadingFinished", self.on_loading_finished)
+
+    async def on_request(self, request):
+        try:
+            if self.should_block(request):
+                self.stats["blocked"] += 1
+                await request.abort("blockedbyclient")
+                return
+
+            cached = self.cached_asset_for(request)
+            if cached:
+                headers, body = cached
+                self.stats["from_cache"] += 1
+                self.served_from_cache.add(request.url)
+                await request.respond({"status": 200, "headers": headers, "body": body})
+                return
+
+            self.stats["allowed"] += 1
+            await request.continue_()
+        except Exception:
+            # The page may have been closed while the request was in flight
+            logging.debug("Unable to handle request %s", request.url, exc_info=True)
+
+    def should_block(self, request) -> bool:
+        # The bookmarked page itself is always loaded, even when its domain is on the blocklist
+        if request.frame is self.main_frame and request.isNavigationRequest():
+            return False
+        return bool(self.blocklist) and self.blocklist.blocks(request.resourceType, request.url)
+
+    def cached_asset_for(self, request) -> Optional[Tuple[Dict[str, str], bytes]]:
+        if not self.asset_cache or request.resourceType not in CACHEABLE_RESOURCE_TYPES or request.method != "GET":
+            return None
+        return self.asset_cache.get(request.url)
+
+    async def on_response(self, response):
+        request = response.request
+        if (
+            request.resourceType not in CACHEABLE_RESOURCE_TYPES
+            or response.status != 200
+            or response.url in self.served_from_cache
+        ):
+            return
+        try:
+            self.asset_cache.put(response.url, response.headers, await response.buffer())
+        except Exception:
+            logging.debug("Unable to cache %s", response.url, exc_info=True)
+
+    def on_loading_finished(self, event: dict):
+        self.stats["bytes_fetched"] += int(event.get("encodedDataLength", 0))
@@ -17,7 +17,9 @@ from telegram import Update
 from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
 
 from common_utils import retry, setup_logging, verified_chat_id
+from ocr_engine import OcrEngine, TesserocrEngine, create_ocr_engine
 from twitter_api import get_tweet
+from web_archive import ARCHIVE_FORMATS
 from yt_api import video_title
 
 load_dotenv()
@@ -44,6 +46,9 @@ logging.info(f"Connecting to database {DB_CONNECTION_STRING}")
 logging.info(f"Creating table {BOOKMARKS_TABLE}")
 bookmarks_table = db.create_table(BOOKMARKS_TABLE)
 
+# Set when running with --inline-ocr and the in-process OCR engine is available
+inline_ocr_engine: Optional[OcrEngine] = None
+
 
 def welcome(update: Update, _):
     if update.message:
@@ -82,6 +87,7 @@ class BaseHandler:
             "created_at": datetime.now(),
             "content": archived_entry,
             "remote_file_id": None,
+            **self._extra_columns(),
         }
         bookmarks_table.insert(entry_row)
         logging.info(f"Updated database: {entry_row}")
@@ -90,6 +96,9 @@ class BaseHandler:
     def _bookmark(self) -> str:
         pass
 
+    def _extra_columns(self) -> dict:
+        return {}
+
 
 class Youtube(BaseHandler):
     def _bookmark(self) -> str:
@@ -105,10 +114,18 @@ class Twitter(BaseHandler):
 
 
 class WebPage(BaseHandler):
+    def __init__(self, note, archive_format: Optional[str] = None):
+        super().__init__(note)
+        self.archive_format = archive_format
+
     def _bookmark(self) -> None:
         logging.info(f"Bookmarking WebPage: {self.note}")
         return None
 
+    def _extra_columns(self) -> dict:
+        # Picked up by muninn-web-page-downloader. Without it the format is chosen automatically
+        return {"archive_format": self.archive_format} if self.archive_format else {}
+
 
 class GitHub(WebPage):
     pass
@@ -132,7 +149,14 @@ class Photo(BaseHandler):
 
 
 class PhotoOcr(Photo):
-    pass
+    def ocr_inline(self, image_file_path: Path, ocr_engine: OcrEngine) -> str:
+        """Convert the saved photo straight away and mark it as converted so that muninn-photo-ocr skips it"""
+        text_path = image_file_path.with_suffix(".txt")
+        converted_text = ocr_engine.image_to_text(image_file_path)
+        text_path.write_text(converted_text)
+        bookmarks_table.update({"note": self.note, "remote_file_id": text_path.as_posix()}, ["note"])
+        logging.info(f"Photo converted inline: {text_path}")
+        return converted_text
 
 
 class Document(BaseHandler):
@@ -151,7 +175,10 @@ def message_handler_for(incoming_text) -> BaseHandler:
     if not incoming_text.startswith("http"):
         return PlainTextNote(incoming_text)
 
-    incoming_url = incoming_text
+    # "<url> as markdown" archives the page in the given format
+    incoming_url, _, archive_format = incoming_text.partition(" as ")
+    if archive_format.strip() not in ARCHIVE_FORMATS:
+        incoming_url, archive_format = incoming_text, ""
 
     urls_to_handler = [
         {"urls": ["https://twitter.com"], "handler": Twitter},
@@ -165,7 +192,7 @@ def message_handler_for(incoming_text) -> BaseHandler:
             if incoming_url.startswith(url):
                 return entry.get("handler")(incoming_url)
 
-    return WebPage(incoming_url)
+    return WebPage(incoming_url.strip(), archive_format.strip() or None)
 
 
 def process_photo(update: Update) -> str:
@@ -181,7 +208,12 @@ def process_photo(update: Update) -> str:
     else:
         photo_handler = Photo(photo_identifier, photo_file)
 
-    photo_handler.bookmark()
+    archived_photo = photo_handler.bookmark()
+
+    if isinstance(photo_handler, PhotoOcr) and inline_ocr_engine:
+        converted_text = photo_handler.ocr_inline(Path(archived_photo), inline_ocr_engine)
+        if converted_text.strip():
+            update.message.reply_text(converted_text[:4096])
 
     return f"Photo {photo_identifier}"
 
@@ -268,6 +300,16 @@ def setup_directories():
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
+def setup_inline_ocr():
+    global inline_ocr_engine
+    ocr_engine = create_ocr_engine()
+    if isinstance(ocr_engine, TesserocrEngine):
+        inline_ocr_engine = ocr_engine
+        logging.info(f"OCR photos inline using {ocr_engine.version}")
+    else:
+        logging.warning("Inline OCR needs tesserocr. Photos will be converted by muninn-photo-ocr")
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
@@ -278,6 +320,12 @@ def parse_args():
         dest="verbose",
         help="Increase verbosity of logging output",
     )
+    parser.add_argument(
+        "--inline-ocr",
+        action="store_true",
+        default=False,
+        help="Reply with the text of photos captioned ocr straight away (requires tesserocr)",
+    )
     return parser.parse_args()
 
 
@@ -285,4 +333,6 @@ if __name__ == "__main__":
     args = parse_args()
     setup_directories()
     setup_logging(args.verbose)
+    if args.inline_ocr:
+        setup_inline_ocr()
     start_bot()
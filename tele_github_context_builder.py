@@ -1,40 +1,66 @@
 #!/usr/bin/env python3
 """
 Telegram bot to generate LLM context from GitHub repositories
-This script downloads a GitHub repository, extracts it, and builds a context
-from specified folder and file types.
+This script downloads a GitHub repository and builds a context from specified folder and file types.
+Files are read straight from the downloaded zip, nothing is extracted to disk.
+Files ignored by .gitignore, vendored/generated code, lockfiles, binary, minified, oversized and duplicate files
+are left out.
 
 Usage:
-Run as a telegram bot
-./tele_github_context_builder.py -v -v
+Run as a telegram bot. Repos are processed by a pool of --workers threads with a status message that shows progress.
+Each user can have --max-jobs-per-user repos in progress and /cancel stops them
+./tele_github_context_builder.py -b -v -v
 
 Single use
 ./tele_github_context_builder.py -u https://github.com/motion-canvas/motion-canvas/tree/main/packages/docs/docs -t md mdx -v
 
+Only fetch the docs folder from the zip with HTTP range requests (falls back to downloading the whole zip)
+./tele_github_context_builder.py -u https://github.com/motion-canvas/motion-canvas/tree/main/packages/docs/docs -t md --ranged
+
+Split into parts of at most 100k (estimated) tokens. README and top level files are added first
+./tele_github_context_builder.py -u https://github.com/motion-canvas/motion-canvas -t .ts .md --max-tokens 100000 -v
+
+Outline of the code only: module docstrings, class/function signatures and type declarations
+./tele_github_context_builder.py -u https://github.com/motion-canvas/motion-canvas -t .ts .md --outline
+
 """
+import asyncio
+import functools
+import io
 import logging
 import os
-import shutil
+import re
 import tempfile
+import threading
 import zipfile
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from urllib.error import URLError
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from urllib.parse import urlparse
-from urllib.request import urlopen
 
+import requests
 import telegram
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
-    CallbackContext,
+    Application,
     CommandHandler,
+    ContextTypes,
     ConversationHandler,
-    Filters,
     MessageHandler,
-    Updater,
+    filters,
 )
 
-from common_utils import retry, setup_logging
+from code_outline import outline_of
+from common_utils import DownloadError, RangeHttpFile, download_to_file, setup_logging
+from github_api import (
+    DefaultBranchResolver,
+    GitHubError,
+    RepoSnapshots,
+    commit_archive_url,
+    parse_repo,
+)
 
 load_dotenv()
 
@@ -43,10 +69,14 @@ BOT_TOKEN = os.getenv("DGV82116QE_BOT_TOKEN")
 # States
 WAITING_FOR_URL, WAITING_FOR_FILTERS = range(2)
 
+PROGRESS_INTERVAL_IN_SECS = 3
+
 # Setup Output Directory
 OUTPUT_DIR = os.path.join(os.getcwd(), "output_dir")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+BRANCH_RESOLVER = DefaultBranchResolver()
+
 
 def parse_github_url(url):
     """Parse GitHub URL to extract repository URL and folder path."""
@@ -65,123 +95,415 @@ def parse_github_url(url):
     return repo_url, folder_path
 
 
-def download_github_repo(repo_url, output_dir):
-    """Download GitHub repository as a zip file if it doesn't exist."""
-    repo_name = os.path.basename(urlparse(repo_url).path)
-    zip_url = f"{repo_url}/archive/main.zip"
-
-    os.makedirs(output_dir, exist_ok=True)
-    zip_path = os.path.join(output_dir, f"{repo_name}.zip")
-
-    if os.path.exists(zip_path):
-        logging.info(f"Zip file already exists at {zip_path}. Skipping download.")
-        return zip_path
+def download_github_repo(repo_url, output_dir, on_progress=None, latest=None):
+    """
+    Download the latest commit of a GitHub repository as a zip file unless it was already downloaded.
+    on_progress is called with the bytes downloaded so far.
+    latest (from open_remote_repo_zip) saves looking up the head commit again
+    """
+    owner, repo_name = parse_repo(repo_url)
+    snapshots = RepoSnapshots(Path(output_dir), branch_resolver=BRANCH_RESOLVER)
 
     try:
-        with urlopen(zip_url) as response, open(zip_path, "wb") as out_file:
-            shutil.copyfileobj(response, out_file)
-        logging.info(f"Repository downloaded to {zip_path}")
-    except URLError as e:
+        zip_path, downloaded = snapshots.snapshot(
+            owner,
+            repo_name,
+            download=functools.partial(download_to_file, on_progress=on_progress),
+            latest=latest,
+        )
+    except (GitHubError, DownloadError, requests.RequestException) as e:
         raise Exception(f"Failed to download repository: {str(e)}")
 
-    return zip_path
-
-
-def extract_zip(zip_path, extract_path):
-    """Extract the zip file and return the path to the extracted repository folder."""
-    logging.info(f"Extracting zip file: {zip_path}")
-    logging.info(f"Extraction path: {extract_path}")
-
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(extract_path)
-
-    logging.info("Zip file extracted successfully")
-
-    # Find the extracted repository folder
-    repo_name = os.path.splitext(os.path.basename(zip_path))[0]
-    logging.info(f"Looking for extracted folder starting with: {repo_name}")
-
-    extracted_folder = None
-    for item in os.listdir(extract_path):
-        logging.debug(f"Checking item: {item}")
-        if item.startswith(repo_name) and item.endswith("-main"):
-            extracted_folder = os.path.join(extract_path, item)
-            logging.info(f"Found extracted folder: {extracted_folder}")
-            break
-
-    if not extracted_folder:
-        logging.error(f"Could not find extracted repository folder in {extract_path}")
-        logging.debug(f"Contents of {extract_path}:")
-        for item in os.listdir(extract_path):
-            logging.debug(f"  {item}")
-        raise Exception(f"Could not find extracted repository folder in {extract_path}")
-
-    # Rename the folder to remove the '-main' suffix
-    renamed_folder = os.path.join(extract_path, repo_name)
-    logging.info(f"Renaming {extracted_folder} to {renamed_folder}")
-
-    if os.path.exists(renamed_folder):
-        logging.warning(f"Destination folder {renamed_folder} already exists. Removing it.")
-        shutil.rmtree(renamed_folder)
-
-    os.rename(extracted_folder, renamed_folder)
-    logging.info("Folder renamed successfully")
-
-    return renamed_folder
-
-
-def collect_files(base_path, folder_path, file_types):
-    """Collect files matching the specified types in the given folder and its subdirectories."""
-    logging.info(f"Collecting files from base path: {base_path}")
+    if downloaded:
+        logging.info(f"Repository downloaded to {zip_path}")
+    else:
+        logging.info(f"Zip file of the latest commit already exists at {zip_path}. Skipping download.")
+    return zip_path.as_posix()
+
+
+def open_remote_repo_zip(repo_url, output_dir):
+    """
+    The zip of the latest commit of a GitHub repository read with HTTP range requests, so that only the central
+    directory and the members that are used get fetched, and the (branch, snapshot metadata) of that commit.
+    The zip is None when the latest commit is already downloaded or the server doesn't support range requests
+    """
+    owner, repo_name = parse_repo(repo_url)
+    snapshots = RepoSnapshots(Path(output_dir), branch_resolver=BRANCH_RESOLVER)
+    latest = snapshots.latest(owner, repo_name)
+    metadata = latest[1]
+    if "zip_file" in metadata:
+        return None, latest
+    return RangeHttpFile.open(commit_archive_url(owner, repo_name, metadata["sha"])), latest
+
+
+# Roughly one token per 4 characters of a word and one per punctuation character. Close to BPE tokenizers on code
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+# Lower weight is added first when the context has a token budget. Ties go to the smallest file
+PATH_WEIGHTS = [
+    (re.compile(r"(^|/)readme[^/]*$", re.I), 0),
+    (re.compile(r"(^|/)(docs?|documentation)/", re.I), 2),
+    (re.compile(r"(^|/)(tests?|spec|examples?|fixtures|benchmarks?)/", re.I), 4),
+]
+TOP_LEVEL_FILE_WEIGHT = 1
+DEFAULT_PATH_WEIGHT = 3
+
+
+def estimate_tokens(text):
+    # subn counts the matches without building a list of them
+    return TOKEN_PATTERN.subn("", text)[1]
+
+
+def file_priority(path_in_folder, file_size):
+    """Sort key for the files of the requested folder: README, then top level files, then by path weight and size"""
+    weight = next((weight for pattern, weight in PATH_WEIGHTS if pattern.search(path_in_folder)), None)
+    if weight is None:
+        weight = TOP_LEVEL_FILE_WEIGHT if "/" not in path_in_folder else DEFAULT_PATH_WEIGHT
+    return weight, file_size
+
+
+def part_file_name(file_name, part, max_tokens):
+    """context.txt stays as it is without a budget, otherwise parts are numbered: context.part-01.txt"""
+    if not max_tokens:
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}.part-{part:02}{ext}"
+
+
+class ContextWriter:
+    """
+    Appends each file to the output as soon as it is read and keeps count of the files, characters and tokens written.
+    With max_tokens, the context is split into numbered parts that each fit the budget.
+    open_file(name) returns a text stream for a part. Parts are opened one at a time, when they are first written to
+    """
+
+    def __init__(self, open_file, file_name, max_tokens=None, max_parts=None):
+        self.open_file = open_file
+        self.file_name = file_name
+        self.max_tokens = max_tokens
+        self.max_parts = max_parts
+        self.output = None
+        self.part_names = []
+        self.part_tokens = 0
+        self.part_files = 0
+        self.files = 0
+        self.size = 0
+        self.tokens = 0
+        self.skipped = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+    def next_part(self):
+        self.close()
+        self.part_names.append(part_file_name(self.file_name, len(self.part_names) + 1, self.max_tokens))
+        self.output = self.open_file(self.part_names[-1])
+        self.part_tokens = 0
+        self.part_files = 0
+
+    def add(self, relative_path, content):
+        """False if the file didn't fit in the token budget"""
+        entry = f"File: {relative_path}\n\n{content}\n\n"
+        tokens = estimate_tokens(entry) if self.max_tokens else 0
+        if self.max_tokens and tokens > self.max_tokens:
+            logging.info(f"Skipping {relative_path}. {tokens} tokens is more than the budget of a part")
+            self.skipped.append(relative_path)
+            return False
+        if self.output is None or (self.max_tokens and self.part_tokens + tokens > self.max_tokens):
+            if self.max_parts and len(self.part_names) >= self.max_parts:
+                logging.info(f"Skipping {relative_path}. All {self.max_parts} parts are full")
+                self.skipped.append(relative_path)
+                return False
+            self.next_part()
+
+        if self.part_files:
+            entry = "\n" + entry
+        self.output.write(entry)
+        self.part_tokens += tokens
+        self.part_files += 1
+        self.files += 1
+        self.size += len(entry)
+        self.tokens += tokens
+        return True
+
+
+DEFAULT_EXCLUDED_DIRS = {
+    ".git",
+    "node_modules",
+    "vendor",
+    "third_party",
+    "dist",
+    "build",
+    "__pycache__",
+    ".venv",
+    "venv",
+    ".tox",
+    "bower_components",
+}
+DEFAULT_EXCLUDED_FILES = {
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "poetry.lock",
+    "uv.lock",
+    "Pipfile.lock",
+    "Cargo.lock",
+    "Gemfile.lock",
+    "composer.lock",
+    "go.sum",
+}
+DEFAULT_EXCLUDED_SUFFIXES = (".min.js", ".min.css", ".map")
+# Only these are checked for minified content. Prose (.md, .txt, .rst) often keeps a paragraph on one line
+MINIFIABLE_SUFFIXES = (".js", ".mjs", ".cjs", ".jsx", ".ts", ".tsx", ".css", ".scss", ".json", ".svg", ".html", ".xml")
+SNIFF_BYTES = 8192
+
+
+def gitignore_regex(pattern):
+    """Regex for a .gitignore pattern relative to the folder of the .gitignore file"""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1 : end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    # Patterns without a slash match at any depth
+    return regex if anchored else "(?:.*/)?" + regex
+
+
+class GitIgnore:
+    """The subset of .gitignore rules that matters for reading files: globs, **, negation, anchoring and dir/ rules"""
+
+    def __init__(self):
+        self.rules = []
+        self.ignored_dirs = {}
+
+    def add(self, base_dir, text):
+        prefix = re.escape(base_dir + "/") if base_dir else ""
+        for line in text.splitlines():
+            line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            line = line[1:] if negate else line
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line:
+                self.rules.append((re.compile(f"^{prefix}{gitignore_regex(line)}$"), negate, dir_only))
+
+    def matches(self, path, is_dir):
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if (is_dir or not dir_only) and regex.match(path):
+                ignored = not negate
+        return ignored
+
+    def is_ignored(self, path):
+        # Files can't be re-included once one of their parent folders is ignored
+        parts = path.split("/")
+        for depth in range(1, len(parts)):
+            folder = "/".join(parts[:depth])
+            if folder not in self.ignored_dirs:
+                self.ignored_dirs[folder] = self.matches(folder, is_dir=True)
+            if self.ignored_dirs[folder]:
+                return True
+        return self.matches(path, is_dir=False)
+
+
+class RepoFileFilter:
+    """
+    Drops files that don't belong in an LLM context. Everything except the sniff works on zip metadata,
+    so rejected files are never decompressed. Counts of rejected files by reason are kept in `rejected`
+    """
+
+    def __init__(self, max_file_kb=512, default_excludes=True, use_gitignore=True):
+        self.max_file_bytes = max_file_kb * 1024
+        self.default_excludes = default_excludes
+        self.use_gitignore = use_gitignore
+        self.gitignore = GitIgnore()
+        self.seen_contents = set()
+        self.rejected = Counter()
+
+    def load_gitignores(self, zip_file, members, repo_folder, prefix=None):
+        """
+        Rules of the .gitignore files that apply under prefix (the requested folder): the ones in its parent
+        folders and inside it. The others only cover files that aren't read
+        """
+        if not self.use_gitignore:
+            return
+        prefix = prefix or repo_folder
+        gitignores = [
+            member
+            for member in members
+            if member.filename.endswith("/.gitignore")
+            and (prefix.startswith(os.path.dirname(member.filename) + "/") or member.filename.startswith(prefix))
+        ]
+        # Rules of nested .gitignore files take precedence, so they are added last
+        for member in sorted(gitignores, key=lambda member: member.filename.count("/")):
+            base_dir = os.path.dirname(member.filename[len(repo_folder) :])
+            self.gitignore.add(base_dir, zip_file.read(member).decode("utf-8", errors="replace"))
+
+    def rejection_of(self, member, path):
+        """Reason for skipping a file judging by its zip entry, or None to read it"""
+        name = os.path.basename(path)
+        if self.default_excludes and (
+            DEFAULT_EXCLUDED_DIRS.intersection(path.split("/")[:-1])
+            or name in DEFAULT_EXCLUDED_FILES
+            or name.endswith(DEFAULT_EXCLUDED_SUFFIXES)
+        ):
+            return "excluded"
+        if self.use_gitignore and self.gitignore.is_ignored(path):
+            return "gitignored"
+        if member.file_size > self.max_file_bytes:
+            return "too large"
+        return None
+
+    def accepts(self, member, path):
+        reason = self.rejection_of(member, path)
+        if reason:
+            logging.debug(f"Skipping {path}: {reason}")
+            self.rejected[reason] += 1
+        return reason is None
+
+    def is_duplicate(self, member, path):
+        # Same CRC32 and size is as good as identical content for files of a single repo
+        key = (member.CRC, member.file_size)
+        if key in self.seen_contents:
+            logging.debug(f"Skipping {path}: duplicate")
+            self.rejected["duplicate"] += 1
+            return True
+        self.seen_contents.add(key)
+        return False
+
+    def accepts_head(self, head, path):
+        """Sniff the first bytes of a file for binary content, or minified content for code and assets"""
+        reason = None
+        if b"\0" in head:
+            reason = "binary"
+        else:
+            try:
+                text = head.decode("utf-8")
+            except UnicodeDecodeError as e:
+                # A multi-byte character can be cut off at the end of the sniffed bytes
+                text = "" if e.start < len(head) - 3 else head[: e.start].decode("utf-8")
+                reason = None if text else "binary"
+            lines = text.splitlines()
+            if (
+                not reason
+                and path.lower().endswith(MINIFIABLE_SUFFIXES)
+                and len(text) >= 2000
+                and (max(map(len, lines)) > 1000 or len(text) / len(lines) > 300)
+            ):
+                reason = "minified"
+        if reason:
+            logging.debug(f"Skipping {path}: {reason}")
+            self.rejected[reason] += 1
+        return reason is None
+
+
+def collect_files(zip_path, folder_path, file_types, writer, file_filter=None, on_file=None, outline=False):
+    """
+    Add files matching the specified types in the given folder and its subdirectories to the writer.
+    Files are read straight from the zip. Only the members that match and pass file_filter are decompressed.
+    When the writer has a token budget, files are added in order of file_priority.
+    on_file is called with the number of files read so far and the number of files matched before each file.
+    With outline, source files are replaced by their outline (see code_outline)
+    """
+    file_filter = file_filter or RepoFileFilter()
+    logging.info(f"Collecting files from: {zip_path}")
     logging.info(f"Folder path: {folder_path}")
     logging.info(f"File types to collect: {file_types}")
 
-    context = []
-    full_path = os.path.join(base_path, folder_path)
-    logging.info(f"Full path to search: {full_path}")
-
-    if not os.path.exists(full_path):
-        logging.warning(f"Folder not found: {full_path}")
-        return context
-
-    logging.info(f"Starting file collection in: {full_path} (including all subdirectories)")
-
-    for root, dirs, files in os.walk(full_path):
-        logging.info(f"Searching in directory: {root}")
-        logging.debug(f"Subdirectories: {dirs}")
-        logging.debug(f"Files in this directory: {files}")
-
-        for file in files:
-            logging.debug(f"Checking file: {file}")
-            if any(file.endswith(ft) for ft in file_types):
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, base_path)
-                logging.info(f"Matched file: {relative_path}")
-                try:
-                    with open(file_path, encoding="utf-8") as f:
-                        content = f.read()
-                    context.append(f"File: {relative_path}\n\n{content}\n\n")
-                    logging.info(f"Added content from {relative_path} to context")
-                except Exception as e:
-                    logging.error(f"Error reading file {file_path}: {str(e)}")
-            else:
-                logging.debug(f"File {file} does not match specified types")
-
-    logging.info(f"File collection complete. Total files collected: {len(context)}")
-    if len(context) == 0:
+    with zipfile.ZipFile(zip_path, "r") as zip_file:
+        members = zip_file.infolist()
+        # GitHub archives have a single top level folder named <repo>-<commit>
+        top_level_folders = {member.filename.split("/", 1)[0] for member in members}
+        if len(top_level_folders) != 1:
+            raise Exception(f"Expected a single repository folder in {zip_path}, found {len(top_level_folders)}")
+        repo_folder = top_level_folders.pop() + "/"
+        prefix = repo_folder + (folder_path.strip("/") + "/" if folder_path.strip("/") else "")
+        logging.info(f"Searching {len(members)} zip members under: {prefix}")
+        file_filter.load_gitignores(zip_file, members, repo_folder, prefix)
+
+        matched = []
+        for member in members:
+            if member.is_dir() or not member.filename.startswith(prefix):
+                continue
+            if not member.filename.endswith(tuple(file_types)):
+                logging.debug(f"File {member.filename} does not match specified types")
+                continue
+            if file_filter.accepts(member, member.filename[len(repo_folder) :]):
+                matched.append(member)
+        if writer.max_tokens:
+            matched.sort(key=lambda member: file_priority(member.filename[len(prefix) :], member.file_size))
+
+        for files_read, member in enumerate(matched):
+            if on_file:
+                on_file(files_read, len(matched))
+            relative_path = member.filename[len(repo_folder) :]
+            if file_filter.is_duplicate(member, relative_path):
+                continue
+            logging.info(f"Matched file: {relative_path}")
+            try:
+                # Only one file is held in memory at a time
+                with zip_file.open(member) as f:
+                    head = f.read(SNIFF_BYTES)
+                    if not file_filter.accepts_head(head, relative_path):
+                        continue
+                    content = (head + f.read()).decode("utf-8")
+            except Exception as e:
+                logging.error(f"Error reading file {relative_path}: {str(e)}")
+                continue
+            if outline:
+                # Files in a language without an outline (docs, configs) are added as they are
+                source_outline = outline_of(relative_path, content)
+                if source_outline == "":
+                    logging.debug(f"No declarations in {relative_path}")
+                    continue
+                content = content if source_outline is None else source_outline
+            if writer.add(relative_path, content):
+                logging.info(f"Added content from {relative_path} to context")
+
+    logging.info(f"File collection complete. Total files collected: {writer.files}")
+    if file_filter.rejected:
+        logging.info(f"Files skipped by the filter: {dict(file_filter.rejected)}")
+    if writer.files == 0:
         logging.warning("No files were added to the context. This may indicate an issue.")
-    return context
-
+    return writer
 
-def generate_output(context, output_dir):
-    """Generate an output file with the collected context."""
-    output_file = os.path.join(output_dir, "context_output.txt")
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(context)
-    return output_file
 
-
-def process_repo(url, file_filters):
+def process_repo(url, file_filters, writer, file_filter=None, ranged=False, job=None, outline=False):
+    """
+    Write the context of the repo with writer (a ContextWriter) and return it with its counts.
+    With ranged, a folder of a repo that isn't downloaded yet is read from the remote zip with range requests.
+    job (a ContextJob) is kept up to date with the progress and can cancel the work
+    """
     logging.info("Starting GitHub Context Builder")
 
     try:
@@ -190,31 +512,132 @@ def process_repo(url, file_filters):
         logging.info(f"Repository URL: {repo_url}")
         logging.info(f"Folder path: {folder_path}")
 
-        # Download the repository if needed
-        zip_path = download_github_repo(repo_url, OUTPUT_DIR)
+        remote_zip, latest = open_remote_repo_zip(repo_url, OUTPUT_DIR) if ranged and folder_path else (None, None)
+        if remote_zip:
+
+            def on_file(files_read, files_matched):
+                if job:
+                    job.downloaded(remote_zip.raw.bytes_fetched)
+                    job.reading(files_read, files_matched)
+
+            with remote_zip:
+                collect_files(remote_zip, folder_path, file_filters, writer, file_filter, on_file, outline)
+            logging.info(
+                f"Fetched {remote_zip.raw.bytes_fetched} of {remote_zip.raw.size} bytes "
+                f"with {remote_zip.raw.requests} range requests"
+            )
+        else:
+            # Download the repository if needed
+            zip_path = download_github_repo(repo_url, OUTPUT_DIR, job.downloaded if job else None, latest)
+            on_file = job.reading if job else None
+            collect_files(zip_path, folder_path, file_filters, writer, file_filter, on_file, outline)
+        logging.info(f"Collected {writer.files} files into {len(writer.part_names)} part(s)")
+
+        return writer
+
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+        raise
 
-        # Extract the repository
-        extracted_path = extract_zip(zip_path, OUTPUT_DIR)
-        logging.info(f"Repository extracted to {extracted_path}")
 
-        # Collect files and build context
-        context = collect_files(extracted_path, folder_path, file_filters)
-        logging.info(f"Collected {len(context)} files")
+class JobCancelled(Exception):
+    pass
 
-        shutil.rmtree(extracted_path)
-        logging.info(f"Deleted {extracted_path}")
 
-        return "\n".join(context), len(context)
+class ContextJob:
+    """A context requested from the bot. Updated by the worker thread building it and read for the progress updates"""
 
-    except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
+    def __init__(self, user_id, repo_url, file_types, max_tokens, outline=False):
+        self.user_id = user_id
+        self.repo_url = repo_url
+        self.file_types = file_types
+        self.max_tokens = max_tokens
+        self.outline = outline
+        self.cancel_requested = threading.Event()
+        self.stage = "⏳ Queued"
+        self.downloaded_bytes = 0
+        self.files_read = 0
+        self.files_matched = 0
+
+    def check_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled(f"Cancelled {self.repo_url}")
+
+    def downloaded(self, downloaded_bytes):
+        self.stage = "⬇️ Downloading"
+        self.downloaded_bytes = downloaded_bytes
+        self.check_cancelled()
+
+    def reading(self, files_read, files_matched):
+        self.stage = "📄 Building context"
+        self.files_read = files_read
+        self.files_matched = files_matched
+        self.check_cancelled()
+
+    def status(self):
+        return (
+            f"{self.stage} {self.repo_url}\n"
+            f"Downloaded: {self.downloaded_bytes / 1024 / 1024:.1f} MB. Files: {self.files_read}/{self.files_matched}"
+        )
+
+
+def build_context_zip(job, zip_file_path):
+    """Runs on a worker thread. The context is compressed as it is written, it is never held in memory"""
+    job.check_cancelled()
+    job.stage = "🔎 Checking for new commits"
+    with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+
+        def open_part(name):
+            return io.TextIOWrapper(zipf.open(name, "w", force_zip64=True), encoding="utf-8")
+
+        file_filter = RepoFileFilter()
+        with ContextWriter(open_part, "context.txt", job.max_tokens) as writer:
+            process_repo(job.repo_url, job.file_types, writer, file_filter, ranged=True, job=job, outline=job.outline)
+    return writer, file_filter
 
 
 def parse_args():
     parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-b", "--run-as-bot", action="store_true", default=False, help="Run as telegram bot")
+    parser.add_argument(
+        "--workers", type=int, default=2, help="Number of repos processed at the same time when running as a bot"
+    )
+    parser.add_argument(
+        "--max-jobs-per-user", type=int, default=1, help="Number of repos a user can have in progress at the same time"
+    )
     parser.add_argument("-u", "--url", required=False, help="GitHub URL (repository or specific folder)")
     parser.add_argument("-t", "--types", required=False, nargs="+", help="File types to include (e.g., .py .js)")
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        required=False,
+        help="Split the context into numbered parts of at most this many (estimated) tokens",
+    )
+    parser.add_argument(
+        "--max-parts", type=int, required=False, help="Skip the files that don't fit in this many parts"
+    )
+    parser.add_argument(
+        "--ranged",
+        action="store_true",
+        default=False,
+        help="Read the folder from the remote zip with HTTP range requests when the repo isn't downloaded",
+    )
+    parser.add_argument(
+        "--outline",
+        action="store_true",
+        default=False,
+        help="Only keep module docstrings, class/function signatures and type declarations of source files",
+    )
+    parser.add_argument("--max-file-kb", type=int, default=512, help="Skip files larger than this")
+    parser.add_argument(
+        "--no-default-excludes",
+        action="store_true",
+        default=False,
+        help="Keep vendored/generated folders, lockfiles and other files excluded by default",
+    )
+    parser.add_argument("--no-gitignore", action="store_true", default=False, help="Keep files ignored by .gitignore")
     parser.add_argument(
         "-v",
         "--verbose",
@@ -226,95 +649,167 @@ def parse_args():
     return parser.parse_args()
 
 
-def start(update: Update, _) -> int:
-    update.message.reply_text("👋 Welcome! Please send me a GitHub repository URL.")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("👋 Welcome! Please send me a GitHub repository URL.")
     return WAITING_FOR_URL
 
 
-def help_command(update: Update, _) -> None:
-    update.message.reply_text("Help: Send a GitHub URL, then provide file filters when prompted.")
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(
+        "Help: Send a GitHub URL, then provide file filters when prompted. Send /cancel to stop your running jobs."
+    )
 
 
-@retry(telegram.error.TimedOut, tries=3)
-def process_url(update: Update, context: CallbackContext) -> int:
+async def process_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     url = update.message.text
     if not url.startswith("https://github.com/"):
-        update.message.reply_text("That doesn't look like a valid GitHub URL. Please try again.")
+        await update.message.reply_text("That doesn't look like a valid GitHub URL. Please try again.")
         return WAITING_FOR_URL
 
     context.user_data["repo_url"] = url
-    update.message.reply_text(
-        "Great! Now, please provide file filters (comma-separated file extensions, e.g., .py,.js,.md)"
+    await update.message.reply_text(
+        "Great! Now, please provide file filters (comma-separated file extensions, e.g., .py,.js,.md). "
+        "Add tokens=100000 to split the context into parts of at most that many tokens "
+        "and outline to only keep the signatures and docstrings of the code"
     )
     return WAITING_FOR_FILTERS
 
 
-@retry(telegram.error.TimedOut, tries=3)
-def process_filters(update: Update, context: CallbackContext) -> int:
-    filters = [f.strip() for f in update.message.text.split(",")]
-    context.user_data["filters"] = filters
-
-    update.message.reply_text("⚡ Processing the repository. Please wait...")
-
+def parse_filters(text):
+    """(file types, max tokens, outline) from the filters message. Raises ValueError with a reply for the user"""
+    file_types = []
+    max_tokens = None
+    outline = False
+    for token in (f.strip() for f in text.split(",")):
+        if token.lower().startswith("tokens="):
+            value = token.split("=", 1)[1].strip()
+            if not value.isdecimal() or int(value) <= 0:
+                raise ValueError(f"tokens must be a positive whole number (e.g. tokens=100000), not '{value}'")
+            max_tokens = int(value)
+        elif token.lower() == "outline":
+            outline = True
+        elif token:
+            file_types.append(token)
+    return file_types, max_tokens, outline
+
+
+async def process_filters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        context_content, files_processed = process_repo(context.user_data["repo_url"], filters)
+        file_types, max_tokens, outline = parse_filters(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}. Please send the filters again.")
+        return WAITING_FOR_FILTERS
+    context.user_data["filters"] = file_types
+
+    user_jobs = context.bot_data["jobs"][update.effective_user.id]
+    if len(user_jobs) >= context.bot_data["max_jobs_per_user"]:
+        await update.message.reply_text(
+            f"You already have {len(user_jobs)} repo(s) being processed. "
+            "Wait for them to finish or send /cancel to stop them."
+        )
+        return WAITING_FOR_URL
+
+    job = ContextJob(update.effective_user.id, context.user_data["repo_url"], file_types, max_tokens, outline)
+    user_jobs.append(job)
+    status_message = await update.message.reply_text(job.status())
+    # The job runs in the background so that the bot keeps answering this and other users
+    context.application.create_task(run_job(job, status_message, context), update=update)
 
-        # Create a temporary file to store the context
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".txt", mode="w", encoding="utf-8") as temp_file:
-            temp_file.write(context_content)
-            temp_file_path = temp_file.name
+    await update.message.reply_text("You can send another GitHub URL while this one is processed.")
+    return WAITING_FOR_URL
 
-        # Create a zip file containing the context file
-        zip_file_path = temp_file_path + ".zip"
-        with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(temp_file_path, arcname="context.txt")
 
-        # Send the zip file as an attachment
-        update.message.reply_document(document=open(zip_file_path, "rb"), filename="context.zip")
+async def edit_status(status_message, text):
+    try:
+        await status_message.edit_text(text, disable_web_page_preview=True)
+    except telegram.error.TelegramError as e:
+        logging.debug(f"Unable to update status message: {e}")
 
-        # Delete the temporary files
-        os.unlink(temp_file_path)
-        os.unlink(zip_file_path)
 
-        update.message.reply_text(f"Context size: {len(context_content)}. Files processed: {files_processed}.")
+async def run_job(job, status_message, context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop()
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_file_path = os.path.join(temp_dir, "context.zip")
+            work = loop.run_in_executor(context.bot_data["worker_pool"], build_context_zip, job, zip_file_path)
+            last_status = job.status()
+            while not work.done():
+                await asyncio.wait({work}, timeout=PROGRESS_INTERVAL_IN_SECS)
+                # Edits are rate limited by Telegram, so they are only sent every few seconds and when changed
+                if not work.done() and job.status() != last_status:
+                    last_status = job.status()
+                    await edit_status(status_message, last_status)
+            writer, file_filter = work.result()
+
+            with open(zip_file_path, "rb") as document:
+                await status_message.reply_document(document=document, filename="context.zip")
+
+        summary = (
+            f"Context size: {writer.size} (~{writer.tokens} tokens in {len(writer.part_names)} part(s)). "
+            f"Files processed: {writer.files}. Skipped: {len(writer.skipped)}."
+            if job.max_tokens
+            else f"Context size: {writer.size}. Files processed: {writer.files}."
+        )
+        if file_filter.rejected:
+            summary += f"\nFiltered out: {dict(file_filter.rejected)}"
+        await edit_status(status_message, f"✅ {job.repo_url}\n{summary}")
+    except JobCancelled:
+        await edit_status(status_message, f"🛑 Cancelled {job.repo_url}")
     except Exception as e:
-        update.message.reply_text(f"An error occurred: {str(e)}")
+        logging.exception(f"Unable to build context for {job.repo_url}")
+        await edit_status(status_message, f"❌ {job.repo_url}\nAn error occurred: {str(e)}")
+    finally:
+        context.bot_data["jobs"][job.user_id].remove(job)
 
-    update.message.reply_text("Done. You can send another GitHub URL if you'd like.")
-    return WAITING_FOR_URL
 
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_jobs = context.bot_data["jobs"][update.effective_user.id]
+    for job in user_jobs:
+        job.cancel_requested.set()
+    await update.message.reply_text(f"Cancelling {len(user_jobs)} job(s)." if user_jobs else "Nothing to cancel.")
 
-def main():
+
+def main(args):
     """Start the bot."""
     logging.info("Starting bot")
-    updater = Updater(BOT_TOKEN, use_context=True)
-
-    dispatcher = updater.dispatcher
+    application = Application.builder().token(BOT_TOKEN).build()
+    application.bot_data["worker_pool"] = ThreadPoolExecutor(args.workers, thread_name_prefix="context-job")
+    application.bot_data["max_jobs_per_user"] = args.max_jobs_per_user
+    application.bot_data["jobs"] = defaultdict(list)
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            WAITING_FOR_URL: [MessageHandler(Filters.text & ~Filters.command, process_url)],
-            WAITING_FOR_FILTERS: [MessageHandler(Filters.text & ~Filters.command, process_filters)],
+            WAITING_FOR_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_url)],
+            WAITING_FOR_FILTERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_filters)],
         },
         fallbacks=[CommandHandler("help", help_command)],
     )
 
-    dispatcher.add_handler(conv_handler)
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("cancel", cancel))
 
-    updater.start_polling()
-
-    updater.idle()
+    logging.info("Bot running...")
+    application.run_polling()
 
 
 if __name__ == "__main__":
     args = parse_args()
     setup_logging(args.verbose)
     if args.run_as_bot:
-        main()
+        main(args)
     else:
-        context_content, files_processed = process_repo(args.url, args.types)
-        # Generate output file
-        output_file = generate_output(context_content, OUTPUT_DIR)
-        logging.info(f"Context size: {len(context_content)}. Files process {files_processed}.")
-        print(f"Output file generated: {output_file}")
+
+        def open_part(name):
+            return open(os.path.join(OUTPUT_DIR, name), "w", encoding="utf-8")
+
+        file_filter = RepoFileFilter(args.max_file_kb, not args.no_default_excludes, not args.no_gitignore)
+        with ContextWriter(open_part, "context_output.txt", args.max_tokens, args.max_parts) as writer:
+            process_repo(args.url, args.types, writer, file_filter, args.ranged, outline=args.outline)
+        logging.info(f"Context size: {writer.size} (~{writer.tokens} tokens). Files process {writer.files}.")
+        if file_filter.rejected:
+            print(f"Filtered out: {dict(file_filter.rejected)}")
+        if writer.skipped:
+            print(f"Skipped {len(writer.skipped)} files that didn't fit in the token budget")
+        for part_name in writer.part_names:
+            print(f"Output file generated: {os.path.join(OUTPUT_DIR, part_name)}")
@@ -0,0 +1,239 @@
+"""
+Archive formats for bookmarked web pages
+
+pdf      -> Rendered by Chromium (webpage_to_pdf). Keeps the layout but is the most expensive
+mhtml    -> Single file snapshot of the rendered page with its resources, gzipped
+html     -> Rendered DOM only, gzipped
+markdown -> Readable article text extracted from the HTML. No browser needed
+
+The format is chosen from (first match wins):
+the archive_format column of the bookmark -> a per-domain map -> the content of the page (auto).
+In auto mode the browser loads the page once: article-like pages and plain text are stored as markdown
+extracted from the rendered page, anything else is captured as PDF from the same tab (see webpage_to_pdf.py).
+Only an explicit markdown format fetches the page without a browser
+"""
+import logging
+import re
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import requests
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+
+from common_utils import html_parser_from
+
+ARCHIVE_FORMATS = ("pdf", "mhtml", "html", "markdown")
+AUTO = "auto"
+BROWSER_FORMATS = ("pdf", "mhtml", "html")
+FILE_EXTENSIONS = {"pdf": ".pdf", "mhtml": ".mhtml.gz", "html": ".html.gz", "markdown": ".md"}
+
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/120.0 Safari/537.36"
+)
+
+# Never part of the readable content
+NOISE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe", "button", "svg"]
+NOISE_PATTERN = re.compile(r"comment|sidebar|share|social|promo|related|newsletter|cookie|banner|advert", re.I)
+BLOCK_TAGS = ["p", "div", "section", "ul", "ol", "pre", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "table"]
+LAYOUT_TAGS = ["table", "canvas", "svg", "iframe", "video", "figure", "img"]
+MIN_ARTICLE_CHARS = 1000
+
+
+class ReadablePage:
+    def __init__(self, title: str, canonical_url: str, markdown: str, text_length: int, layout_elements: int):
+        self.title = title
+        self.canonical_url = canonical_url
+        self.markdown = markdown
+        self.text_length = text_length
+        self.layout_elements = layout_elements
+
+    @property
+    def is_article_like(self) -> bool:
+        """Mostly text. Pages with many images/tables/canvases are better kept as PDF"""
+        return self.text_length >= MIN_ARTICLE_CHARS and self.layout_elements <= max(3, self.text_length // 2000)
+
+
+def parse_domain_formats(entries: Iterable[str]) -> Dict[str, str]:
+    """Turn ["example.com=markdown", ...] into {"example.com": "markdown"}"""
+    domain_formats = {}
+    for entry in entries:
+        domain, _, archive_format = entry.partition("=")
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format in {entry}. Expected one of {', '.join(ARCHIVE_FORMATS)}")
+        domain_formats[domain.lower().lstrip(".")] = archive_format
+    return domain_formats
+
+
+def domain_format_for(url: str, domain_formats: Dict[str, str]) -> Optional[str]:
+    # Subdomains use the format of their parent domain unless they have their own entry
+    parts = (urlparse(url).hostname or "").split(".")
+    for i in range(len(parts)):
+        archive_format = domain_formats.get(".".join(parts[i:]))
+        if archive_format:
+            return archive_format
+    return None
+
+
+def configured_format_for(url: str, bookmark_format: Optional[str], domain_formats: Dict[str, str]) -> str:
+    if bookmark_format in ARCHIVE_FORMATS:
+        return bookmark_format
+    return domain_format_for(url, domain_formats) or AUTO
+
+
+def fetch_page(url: str, timeout: int = 15) -> Tuple[str, Optional[str]]:
+    """Content type of the page and its text. Text is only downloaded for HTML and plain text"""
+    with requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type not in ("text/html", "application/xhtml+xml", "text/plain", "text/markdown"):
+            return content_type, None
+        response.encoding = response.encoding or response.apparent_encoding
+        return content_type, response.text
+
+
+def readable_page(page_html: str, url: str) -> ReadablePage:
+    bs = html_parser_from(page_html)
+    title = page_title(bs) or url
+    canonical_url = canonical_url_of(bs, url)
+
+    for element in bs(NOISE_TAGS):
+        element.decompose()
+    for element in bs.find_all(attrs={"class": NOISE_PATTERN}) + bs.find_all(attrs={"id": NOISE_PATTERN}):
+        if not element.decomposed and element.name not in ("body", "html", "article", "main"):
+            element.decompose()
+
+    content = main_content_of(bs)
+    layout_elements = len(content.find_all(LAYOUT_TAGS))
+    body = markdown_from(content, url)
+    text_length = len(content.get_text(" ", strip=True))
+    heading = "" if body.startswith("# ") else f"# {title}\n\n"
+    markdown = f"{heading}<{canonical_url}>\n\n{body}\n"
+    return ReadablePage(title, canonical_url, markdown, text_length, layout_elements)
+
+
+def page_title(bs: BeautifulSoup) -> str:
+    og_title = bs.find("meta", attrs={"property": "og:title"})
+    if bs.title and bs.title.string:
+        return bs.title.string.strip()
+    return og_title.get("content", "").strip() if og_title else ""
+
+
+def canonical_url_of(bs: BeautifulSoup, url: str) -> str:
+    canonical = bs.find("link", rel="canonical")
+    if canonical and canonical.get("href"):
+        return urljoin(url, canonical["href"])
+    return url
+
+
+def main_content_of(bs: BeautifulSoup) -> Tag:
+    """<article>/<main> if there is one, otherwise the element holding most of the paragraph text"""
+    for tag_name in ("article", "main"):
+        candidate = bs.find(tag_name)
+        if candidate and len(candidate.get_text(strip=True)) > 200:
+            return candidate
+
+    scores: Dict[int, Tuple[int, Tag]] = {}
+    for paragraph in bs.find_all("p"):
+        parent = paragraph.parent
+        if parent is None:
+            continue
+        score, _ = scores.get(id(parent), (0, parent))
+        scores[id(parent)] = (score + len(paragraph.get_text(strip=True)), parent)
+    if not scores:
+        return bs.body or bs
+    return max(scores.values(), key=lambda scored: scored[0])[1]
+
+
+def markdown_from(element: Tag, base_url: str) -> str:
+    blocks = []
+    for child in element.children:
+        block = block_to_markdown(child, base_url)
+        if block:
+            blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+def block_to_markdown(node, base_url: str) -> str:
+    if isinstance(node, Comment):
+        return ""
+    if isinstance(node, NavigableString):
+        return node.strip() if node.parent and node.parent.name not in ("ul", "ol", "table") else ""
+    if not isinstance(node, Tag):
+        return ""
+    if node.name in ("h1", "h2", "h3", "h4", "h5", "h6"):
+        return f"{'#' * int(node.name[1])} {inline_markdown(node, base_url)}"
+    if node.name == "p":
+        return inline_markdown(node, base_url)
+    if node.name in ("ul", "ol"):
+        items = node.find_all("li", recursive=False)
+        bullets = [f"{i + 1}." if node.name == "ol" else "-" for i in range(len(items))]
+        return "\n".join(f"{bullet} {inline_markdown(item, base_url)}" for bullet, item in zip(bullets, items))
+    if node.name == "pre":
+        return f"```\n{node.get_text().rstrip()}\n```"
+    if node.name == "blockquote":
+        return "\n".join(f"> {line}" for line in markdown_from(node, base_url).splitlines())
+    if node.name == "img":
+        return image_markdown(node, base_url)
+    if node.name == "hr":
+        return "---"
+    if not node.find(BLOCK_TAGS):
+        return inline_markdown(node, base_url)
+    return markdown_from(node, base_url)
+
+
+def inline_markdown(node: Tag, base_url: str) -> str:
+    parts = []
+    for child in node.descendants:
+        if isinstance(child, Comment):
+            continue
+        if isinstance(child, NavigableString):
+            if child.find_parent("a") is None or child.find_parent("a") is node:
+                parts.append(str(child))
+        elif child.name == "a" and child.get("href"):
+            parts.append(f"[{child.get_text(strip=True)}]({urljoin(base_url, child['href'])})")
+        elif child.name == "img":
+            parts.append(image_markdown(child, base_url))
+        elif child.name == "br":
+            parts.append("\n")
+    return re.sub(r"[ \t\r\f\v]+", " ", "".join(parts)).strip()
+
+
+def image_markdown(image: Tag, base_url: str) -> str:
+    source = image.get("src") or image.get("data-src")
+    return f"![{image.get('alt', '')}]({urljoin(base_url, source)})" if source else ""
+
+
+def markdown_for_text(text: str, url: str) -> ReadablePage:
+    return ReadablePage(url, url, text, len(text), 0)
+
+
+def readable_from(content_type: str, page_text: Optional[str], url: str) -> Optional[ReadablePage]:
+    """Readable version of HTML or plain text. None for any other content"""
+    if page_text is None:
+        return None
+    if content_type in ("text/plain", "text/markdown"):
+        return markdown_for_text(page_text, url)
+    return readable_page(page_text, url)
+
+
+def fetch_readable_page(url: str) -> Tuple[str, Optional[ReadablePage]]:
+    """Content type of the page and its readable version (None unless it is HTML or plain text)"""
+    content_type, page_text = fetch_page(url)
+    return content_type, readable_from(content_type, page_text, url)
+
+
+def auto_format(url: str, content_type: str, page: Optional[ReadablePage]) -> str:
+    """markdown for plain text and article-like pages, otherwise pdf"""
+    if page is None:
+        logging.info("%s is %s. Archiving as PDF", url, content_type or "unknown content")
+        return "pdf"
+    if content_type in ("text/plain", "text/markdown") or page.is_article_like:
+        return "markdown"
+    logging.info(
+        "%s doesn't look like an article (%s characters, %s images/tables). Archiving as PDF",
+        url,
+        page.text_length,
+        page.layout_elements,
+    )
+    return "pdf"
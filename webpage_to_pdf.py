@@ -1,24 +1,131 @@
 #!/usr/bin/env python3
 """
-Generate PDF from a webpage
+Generate PDF (or a gzipped MHTML/HTML snapshot) from a webpage
+
+RenderService keeps a single browser running so that a batch of pages can be rendered
+in concurrent tabs without paying for a browser launch per page.
+
+Instead of fixed sleeps, a page is considered ready once the network is idle and the DOM
+has stopped changing. Lazy images are loaded in one pass and everything before capture
+happens within a render time budget.
+
+The title and canonical url are read from the rendered page, so nothing else needs to fetch it again.
+With the auto format, article-like pages come back as readable markdown from the rendered page
+and anything else is captured as PDF, so the page is only loaded once either way.
+
+Fonts, media, beacons and requests to domains in render_blocklist.txt are blocked, and scripts/stylesheets
+are served from a local cache (see request_interceptor.py).
 """
 import argparse
 import asyncio
+import gzip
 import logging
 import os
 import platform
-import random
 import time
+from collections import Counter
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from pyppeteer import launch
+from pyppeteer.errors import BrowserError, NetworkError, PageError
 
 from common_utils import setup_logging
+from request_interceptor import (
+    DEFAULT_ASSET_CACHE_DIR,
+    DEFAULT_BLOCKLIST_FILE,
+    AssetCache,
+    Blocklist,
+    RequestInterceptor,
+)
+from web_archive import AUTO, BROWSER_FORMATS, ReadablePage, auto_format, readable_from
 
 ENCODE_IN = "utf-8"
 ENCODE_OUT = "utf-8"
 TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+RENDER_BUDGET_IN_SECS = 60
+
+# Resolves once nothing in the DOM has changed for quietMs (or after maxMs regardless)
+WAIT_FOR_DOM_TO_SETTLE_JS = """
+(quietMs, maxMs) => new Promise(resolve => {
+    let quietTimer = null;
+    const observer = new MutationObserver(() => {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(done, quietMs);
+    });
+    const deadline = setTimeout(done, maxMs);
+    function done() {
+        observer.disconnect();
+        clearTimeout(quietTimer);
+        clearTimeout(deadline);
+        resolve();
+    }
+    observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    quietTimer = setTimeout(done, quietMs);
+})
+"""
+
+PAGE_METADATA_JS = """
+() => {
+    const meta = name => document.querySelector(`meta[property="${name}"], meta[name="${name}"]`);
+    const canonical = document.querySelector('link[rel="canonical"]');
+    const ogTitle = meta("og:title");
+    const ogUrl = meta("og:url");
+    return {
+        title: document.title || (ogTitle && ogTitle.content) || "",
+        canonicalUrl: (canonical && canonical.href) || (ogUrl && ogUrl.content) || location.href,
+    };
+}
+"""
+
+# Switch lazy elements to eager loading (including the common data-src pattern) and wait for all images
+LOAD_LAZY_IMAGES_JS = """
+(maxMs) => {
+    document.querySelectorAll('[loading="lazy"]').forEach(el => el.loading = 'eager');
+    document.querySelectorAll('img[data-src]').forEach(img => {
+        if (!img.getAttribute('src') || img.src.startsWith('data:')) img.src = img.dataset.src;
+    });
+    document.querySelectorAll('[data-srcset]').forEach(el => {
+        if (!el.getAttribute('srcset')) el.srcset = el.dataset.srcset;
+    });
+    const pending = Array.from(document.images)
+        .filter(img => !img.complete)
+        .map(img => new Promise(resolve => { img.onload = img.onerror = resolve; }));
+    return Promise.race([Promise.all(pending), new Promise(resolve => setTimeout(resolve, maxMs))])
+        .then(() => pending.length);
+}
+"""
+
+# Scroll a viewport at a time, only waiting as long as the page keeps changing after each step
+SCROLL_TO_END_JS = """
+async (maxSteps, quietMs, maxStepMs) => {
+    const settle = () => new Promise(resolve => {
+        let quietTimer = setTimeout(done, quietMs);
+        const deadline = setTimeout(done, maxStepMs);
+        const observer = new MutationObserver(() => {
+            clearTimeout(quietTimer);
+            quietTimer = setTimeout(done, quietMs);
+        });
+        function done() { observer.disconnect(); clearTimeout(quietTimer); clearTimeout(deadline); resolve(); }
+        observer.observe(document, {subtree: true, childList: true});
+    });
+    let steps = 0;
+    let lastHeight = -1;
+    while (steps < maxSteps) {
+        window.scrollBy(0, window.innerHeight);
+        await settle();
+        steps++;
+        const height = document.scrollingElement.scrollHeight;
+        const atBottom = window.scrollY + window.innerHeight >= height - 2;
+        if (atBottom && height === lastHeight) break;
+        lastHeight = height;
+    }
+    window.scrollTo(0, 0);
+    return steps;
+}
+"""
+
 
 def parse_args():
     """Parse command line arguments."""
@@ -26,11 +133,14 @@ def parse_args():
     parser.add_argument("-i", "--input-url", type=str, required=True, help="Web Url")
     parser.add_argument("-o", "--output-file-path", type=Path, required=True, help="Full output file path for PDF")
     parser.add_argument(
-        "-w",
-        "--wait-in-secs-before-capture",
+        "-f", "--archive-format", choices=BROWSER_FORMATS, default="pdf", help="Capture page as PDF, MHTML or HTML"
+    )
+    parser.add_argument(
+        "-t",
+        "--render-budget-in-secs",
         type=int,
-        default=5,
-        help="Wait (in secs) before capturing screenshot",
+        default=RENDER_BUDGET_IN_SECS,
+        help="Maximum time (in secs) to wait for the page to be ready before capturing it",
     )
     parser.add_argument(
         "-s",
@@ -39,6 +149,7 @@ def parse_args():
         default=False,
         help="Run headless (no browser window)",
     )
+    add_request_interception_args(parser)
     parser.add_argument(
         "-v",
         "--verbose",
@@ -50,29 +161,127 @@ def parse_args():
     return parser.parse_args()
 
 
-async def open_site(browser, website_url, output_dir):
+def add_request_interception_args(parser):
+    parser.add_argument(
+        "--block-requests",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Block fonts, media, beacons and requests to domains in the blocklist",
+    )
+    parser.add_argument(
+        "--blocklist-file", type=Path, default=DEFAULT_BLOCKLIST_FILE, help="File with one blocked domain per line"
+    )
+    parser.add_argument(
+        "--asset-cache-dir",
+        type=Path,
+        default=DEFAULT_ASSET_CACHE_DIR,
+        help="Directory to cache scripts and stylesheets across renders",
+    )
+    parser.add_argument(
+        "--no-asset-cache", action="store_true", default=False, help="Always fetch scripts and stylesheets"
+    )
+
+
+def request_interception_from(
+    block_requests: bool, blocklist_file: Path, asset_cache_dir: Path, no_asset_cache: bool
+) -> Tuple[Optional[Blocklist], Optional[AssetCache]]:
+    blocklist = Blocklist.from_file(blocklist_file) if block_requests else None
+    asset_cache = None if no_asset_cache else AssetCache(asset_cache_dir)
+    return blocklist, asset_cache
+
+
+class NetworkIdleTracker:
+    """Counts in-flight requests of a page so that we can wait for the network to go quiet"""
+
+    def __init__(self, page):
+        self.in_flight = 0
+        self.last_activity = time.monotonic()
+        page.on("request", self.on_request_started)
+        page.on("requestfinished", self.on_request_done)
+        page.on("requestfailed", self.on_request_done)
+
+    def on_request_started(self, _):
+        self.in_flight += 1
+        self.last_activity = time.monotonic()
+
+    def on_request_done(self, _):
+        self.in_flight = max(self.in_flight - 1, 0)
+        self.last_activity = time.monotonic()
+
+    async def wait_until_idle(self, idle_in_secs: float = 0.5, max_in_flight: int = 0):
+        while self.in_flight > max_in_flight or time.monotonic() - self.last_activity < idle_in_secs:
+            await asyncio.sleep(0.05)
+
+
+async def open_site(browser, website_url, output_dir, request_interceptor: Optional[RequestInterceptor] = None):
     page = await browser.newPage()
     await page._client.send(
         "Page.setDownloadBehavior",
         {"behavior": "allow", "downloadPath": output_dir},
     )
-    await page.goto(website_url, {"waitUntil": "networkidle2"})
-    return browser, page
+    if request_interceptor:
+        await request_interceptor.attach(page)
+    network_tracker = NetworkIdleTracker(page)
+    await page.goto(website_url, {"waitUntil": "domcontentloaded"})
+    return browser, page, network_tracker
+
+
+async def wait_for_page_to_settle(page, network_tracker: NetworkIdleTracker):
+    # Allow long polling/analytics connections to stay open, as networkidle2 does
+    await network_tracker.wait_until_idle(max_in_flight=2)
+    await page.evaluate(WAIT_FOR_DOM_TO_SETTLE_JS, 300, 5000)
+
 
+async def scroll_to_end(page, max_steps: int = 200):
+    steps = await page.evaluate(SCROLL_TO_END_JS, max_steps, 150, 2000)
+    logging.info(f"Scrolled to the end of page in {steps} steps")
 
-def scroll_speed():
-    return random.randint(300, 500)
 
+async def load_lazy_images(page):
+    pending_images = await page.evaluate(LOAD_LAZY_IMAGES_JS, 10000)
+    logging.info(f"Loaded {pending_images} lazy images")
 
-async def scroll_to_end(page):
-    current_scroll_position, new_height = 0, 1
-    while current_scroll_position <= new_height:
-        await page.evaluate(f"""() => {{ window.scrollTo(0, {current_scroll_position}); }} """)
-        new_height = await page.evaluate("""() => { return document.body.scrollHeight; } """)
-        current_scroll_position += scroll_speed()
-        logging.info(f"current_scroll_position: {current_scroll_position}, new_height: {new_height}")
-        # Wait to any dynamic elements to load
-        time.sleep(2)
+
+async def prepare_page(page, network_tracker: NetworkIdleTracker):
+    await wait_for_page_to_settle(page, network_tracker)
+    await load_lazy_images(page)
+    await scroll_to_end(page)
+    await wait_for_page_to_settle(page, network_tracker)
+
+
+async def page_metadata(page) -> Dict[str, str]:
+    try:
+        return await page.evaluate(PAGE_METADATA_JS)
+    except Exception:
+        logging.warning("Unable to read title and canonical url from page", exc_info=True)
+        return {"title": "", "canonicalUrl": page.url}
+
+
+def write_gzipped(output_file_path: Path, content: str):
+    with gzip.open(output_file_path, "wt", encoding="utf-8") as output_file:
+        output_file.write(content)
+
+
+async def capture_page(page, output_file_path: Path, archive_format: str = "pdf"):
+    """pdf, mhtml (single file snapshot with resources) or html (rendered DOM). mhtml and html are gzipped"""
+    if archive_format == "mhtml":
+        snapshot = await page._client.send("Page.captureSnapshot", {"format": "mhtml"})
+        await asyncio.to_thread(write_gzipped, output_file_path, snapshot["data"])
+    elif archive_format == "html":
+        await asyncio.to_thread(write_gzipped, output_file_path, await page.content())
+    else:
+        await generate_pdf(page, output_file_path.as_posix())
+
+
+async def readable_page_in_tab(page) -> Tuple[str, Optional[ReadablePage]]:
+    """Content type of the rendered page and its readable version (None unless it is HTML or plain text)"""
+    content_type = await page.evaluate("() => document.contentType")
+    page_text = None
+    if content_type in ("text/plain", "text/markdown"):
+        page_text = await page.evaluate("() => document.body ? document.body.innerText : ''")
+    elif content_type in ("text/html", "application/xhtml+xml"):
+        page_text = await page.content()
+    return content_type, await asyncio.to_thread(readable_from, content_type, page_text, page.url)
 
 
 async def generate_pdf(page, output_file_path):
@@ -105,16 +314,7 @@ async def close_any_open_dialogs(page):
         await link.click()
 
 
-async def main():
-    args = parse_args()
-    setup_logging(args.verbose)
-    website_url = args.input_url
-    output_file_path = args.output_file_path
-    wait_in_secs_before_capture = args.wait_in_secs_before_capture
-    run_headless = args.headless
-
-    output_dir = output_file_path.parent
-    output_dir.mkdir(exist_ok=True)
+def browser_launch_config(run_headless: bool) -> dict:
     launch_config = {
         "headless": run_headless,
         "defaultViewport": None,
@@ -126,26 +326,240 @@ async def main():
         else:
             logging.error("Chromium not found. Please install it and make it available in /usr/bin/chromium-browser")
 
-    browser = await launch(**launch_config)
-    logging.info(f"Processing {website_url}")
-    try:
-        browser, page = await open_site(browser, website_url, output_dir.as_posix())
-        time.sleep(wait_in_secs_before_capture)
-        await scroll_to_end(page)
-        await close_any_open_dialogs(page)
-        logging.info("🚒 Reached end of page. Trying to capture PDF")
-        if run_headless:
+    return launch_config
+
+
+class RenderResult:
+    """
+    What a render produced. Truthy when the page was saved, otherwise `failure` says why.
+    With the auto format, archive_format is the format picked and readable is set (and nothing is saved) for markdown
+    """
+
+    def __init__(self, website_url: str, output_file_path: Path, archive_format: str = "pdf"):
+        self.website_url = website_url
+        self.output_file_path = output_file_path
+        self.archive_format = archive_format
+        self.readable: Optional[ReadablePage] = None
+        self.rendered = False
+        self.title = ""
+        self.canonical_url = website_url
+        self.request_stats: Dict[str, int] = {}
+        self.failure: Optional[str] = None
+
+    def __bool__(self):
+        return self.rendered
+
+
+class RenderService:
+    """
+    Long-lived browser shared by all renders.
+    Up to `tabs` pages are rendered concurrently. The browser is relaunched after `restart_after` pages
+    to bound memory, or straight away if it crashes.
+    A render that doesn't finish within the hard timeout is treated as a hung browser: the browser is killed
+    and relaunched for the next page.
+    Requests are only intercepted when a blocklist or an asset cache is given
+    """
+
+    def __init__(
+        self,
+        tabs: int = 4,
+        restart_after: int = 50,
+        run_headless: bool = True,
+        blocklist: Optional[Blocklist] = None,
+        asset_cache: Optional[AssetCache] = None,
+        hard_timeout_in_secs: Optional[float] = None,
+    ):
+        self.tabs = asyncio.Semaphore(tabs)
+        self.hard_timeout_in_secs = hard_timeout_in_secs
+        self.restart_after = restart_after
+        self.run_headless = run_headless
+        self.blocklist = blocklist
+        self.asset_cache = asset_cache
+        # Totals across all renders: allowed, blocked, from_cache and bytes_fetched
+        self.request_counts: Counter = Counter()
+        self.browser = None
+        self.browser_crashed = False
+        self.pages_since_launch = 0
+        self.open_tabs = 0
+        self.browser_state = asyncio.Condition()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.stop()
+
+    async def stop(self):
+        if self.browser:
             try:
-                await asyncio.wait_for(generate_pdf(page, output_file_path.as_posix()), timeout=20)
-                logging.info(f"📸 PDF saved {output_file_path}")
-                await page.close()
+                await asyncio.wait_for(self.browser.close(), timeout=10)
+            except Exception:
+                logging.exception("Error while closing browser")
+                self.kill_browser()
+            self.browser = None
+
+    def kill_browser(self):
+        process = self.browser.process if self.browser else None
+        if process and process.poll() is None:
+            logging.warning(f"💀 Killing browser process {process.pid}")
+            process.kill()
+        self.browser_crashed = True
+
+    def needs_relaunch(self) -> bool:
+        return self.browser is None or self.browser_crashed or self.pages_since_launch >= self.restart_after
+
+    async def relaunch(self):
+        await self.stop()
+        logging.info("🚀 Launching browser")
+        self.browser = await launch(**browser_launch_config(self.run_headless))
+        self.browser.on("disconnected", self.on_browser_disconnected)
+        self.browser_crashed = False
+        self.pages_since_launch = 0
+
+    def on_browser_disconnected(self):
+        logging.warning("Browser disconnected")
+        self.browser_crashed = True
+
+    async def open_tab(self):
+        async with self.browser_state:
+            if self.needs_relaunch():
+                # Let the tabs using the old browser finish before replacing it
+                await self.browser_state.wait_for(lambda: self.open_tabs == 0)
+                if self.needs_relaunch():
+                    await self.relaunch()
+            self.open_tabs += 1
+            self.pages_since_launch += 1
+            return self.browser
+
+    async def close_tab(self, page):
+        try:
+            if page:
+                await asyncio.wait_for(page.close(), timeout=5)
+        except Exception:
+            logging.debug("Unable to close tab", exc_info=True)
+        async with self.browser_state:
+            self.open_tabs -= 1
+            self.browser_state.notify_all()
+
+    async def render(
+        self,
+        website_url: str,
+        output_file_path: Path,
+        render_budget_in_secs: int = RENDER_BUDGET_IN_SECS,
+        archive_format: str = "pdf",
+        timeout_in_secs: Optional[float] = None,
+    ) -> RenderResult:
+        """
+        timeout_in_secs limits the render once it has a tab, so the time queued for a tab doesn't count.
+        Running out of it fails the render. Only the hard timeout restarts the browser
+        """
+        result = RenderResult(website_url, output_file_path, archive_format)
+        # Opening the page and preparing it each have the render budget, capturing has 20 secs
+        hard_timeout_in_secs = self.hard_timeout_in_secs or render_budget_in_secs * 2 + 30
+        async with self.tabs:
+            try:
+                await asyncio.wait_for(
+                    self.render_in_tab(result, render_budget_in_secs),
+                    timeout=min(hard_timeout_in_secs, timeout_in_secs or hard_timeout_in_secs),
+                )
             except asyncio.TimeoutError:
-                logging.error(f"PDF generation timed out for {website_url}")
-        else:
-            logging.warning("⚠️ PDF generation is only supported in headless mode. Run with --headless")
+                if timeout_in_secs and timeout_in_secs < hard_timeout_in_secs:
+                    logging.error(f"Render of {website_url} timed out after {timeout_in_secs}s")
+                    if not result.rendered:
+                        result.failure = f"timed out after {timeout_in_secs}s"
+                    return result
+                logging.error(f"Render of {website_url} hung for {hard_timeout_in_secs}s. Restarting browser")
+                # The page may have been saved before the browser stopped responding (ie. while closing the tab)
+                if not result.rendered:
+                    result.failure = "hung"
+                self.kill_browser()
+        return result
 
-    except Exception:
-        logging.exception(f"Error while processing {website_url}")
+    async def render_in_tab(self, result: RenderResult, render_budget_in_secs: int):
+        website_url, output_file_path = result.website_url, result.output_file_path
+        try:
+            browser = await self.open_tab()
+        except (BrowserError, OSError) as e:
+            logging.error(f"Unable to launch browser for {website_url}: {e}")
+            result.failure = "browser launch failed"
+            return
+        page = None
+        request_interceptor = self.request_interceptor()
+        logging.info(f"Processing {website_url}")
+        try:
+            output_file_path.parent.mkdir(exist_ok=True)
+            browser, page, network_tracker = await asyncio.wait_for(
+                open_site(browser, website_url, output_file_path.parent.as_posix(), request_interceptor),
+                timeout=render_budget_in_secs,
+            )
+            try:
+                await asyncio.wait_for(prepare_page(page, network_tracker), timeout=render_budget_in_secs)
+                logging.info("🚒 Reached end of page. Trying to capture PDF")
+            except asyncio.TimeoutError:
+                logging.warning(f"⏱️ Render budget used up for {website_url}. Capturing what has loaded so far")
+            await close_any_open_dialogs(page)
+            metadata = await page_metadata(page)
+            result.title, result.canonical_url = metadata["title"], metadata["canonicalUrl"]
+            if result.archive_format == AUTO:
+                content_type, readable = await readable_page_in_tab(page)
+                result.archive_format = auto_format(website_url, content_type, readable)
+                if result.archive_format == "markdown":
+                    result.readable = readable
+                    result.rendered = True
+                    return
+            if result.archive_format == "pdf" and not self.run_headless:
+                logging.warning("⚠️ PDF generation is only supported in headless mode. Run with --headless")
+                result.failure = "pdf needs headless mode"
+                return
+            await asyncio.wait_for(capture_page(page, output_file_path, result.archive_format), timeout=20)
+            logging.info(f"📸 {result.archive_format.upper()} saved {output_file_path}")
+            result.rendered = True
+        except asyncio.TimeoutError:
+            logging.error(f"Rendering timed out for {website_url}")
+            result.failure = "timed out"
+        except (BrowserError, NetworkError, PageError, ConnectionError) as e:
+            logging.exception(f"Browser error while processing {website_url}")
+            result.failure = f"browser error: {e}"
+            if browser.process and browser.process.poll() is not None:
+                self.browser_crashed = True
+        except Exception as e:
+            logging.exception(f"Error while processing {website_url}")
+            result.failure = f"error: {e}"
+        finally:
+            await self.close_tab(page)
+            if request_interceptor:
+                result.request_stats = request_interceptor.stats
+                self.record_request_stats(website_url, request_interceptor.stats)
+
+    def request_interceptor(self) -> Optional[RequestInterceptor]:
+        if self.blocklist or self.asset_cache:
+            return RequestInterceptor(self.blocklist, self.asset_cache)
+        return None
+
+    def record_request_stats(self, website_url: str, stats: Dict[str, int]):
+        logging.info(
+            f"🧮 {website_url}: {stats['allowed']} requests allowed, {stats['blocked']} blocked, "
+            f"{stats['from_cache']} served from cache, {stats['bytes_fetched'] / 1024:.0f} KB fetched"
+        )
+        self.request_counts.update(stats)
+
+    async def render_batch(self, pages: List[Tuple[str, Path]]) -> Dict[str, RenderResult]:
+        rendered = await asyncio.gather(*(self.render(website_url, output_file) for website_url, output_file in pages))
+        return {website_url: result for (website_url, _), result in zip(pages, rendered)}
+
+
+async def main():
+    args = parse_args()
+    setup_logging(args.verbose)
+    blocklist, asset_cache = request_interception_from(
+        args.block_requests, args.blocklist_file, args.asset_cache_dir, args.no_asset_cache
+    )
+    async with RenderService(
+        tabs=1, run_headless=args.headless, blocklist=blocklist, asset_cache=asset_cache
+    ) as render_service:
+        await render_service.render(
+            args.input_url, args.output_file_path, args.render_budget_in_secs, args.archive_format
+        )
 
 
 if __name__ == "__main__":